@@ -41,12 +41,21 @@ from qitensor.space import *
 from qitensor.atom import *
 from qitensor.array import *
 from qitensor.factory import *
+from qitensor.sparse import *
+from qitensor.diagonal import *
 from qitensor.circuit import *
 import qitensor.experimental
+import qitensor.cache
 from qitensor.arrayformatter import *
 from qitensor.subspace import *
 from qitensor.group import *
 from qitensor.superop import *
+from qitensor.batched import *
+from qitensor.contraction import *
+from qitensor.lazyarray import *
+from qitensor.mps import *
+from qitensor.clifford import *
+from qitensor.sampling import *
 
 __all__ = \
     qitensor.exceptions.__all__ + \
@@ -55,11 +64,19 @@ __all__ = \
     qitensor.atom.__all__ + \
     qitensor.array.__all__ + \
     qitensor.factory.__all__ + \
+    qitensor.sparse.__all__ + \
+    qitensor.diagonal.__all__ + \
     qitensor.circuit.__all__ + \
     qitensor.arrayformatter.__all__ + \
     qitensor.subspace.__all__ + \
     qitensor.group.__all__ + \
-    qitensor.superop.__all__
+    qitensor.superop.__all__ + \
+    qitensor.batched.__all__ + \
+    qitensor.contraction.__all__ + \
+    qitensor.lazyarray.__all__ + \
+    qitensor.mps.__all__ + \
+    qitensor.clifford.__all__ + \
+    qitensor.sampling.__all__
 
 def doctest():
     """Runs all doctests and unit tests."""
@@ -83,12 +100,21 @@ def doctest():
         qitensor.arrayformatter,
         qitensor.atom,
         qitensor.basefield,
+        qitensor.cache,
         qitensor.circuit,
         qitensor.exceptions,
         qitensor.factory,
         qitensor.space,
         qitensor.subspace,
         qitensor.superop,
+        qitensor.batched,
+        qitensor.contraction,
+        qitensor.lazyarray,
+        qitensor.sparse,
+        qitensor.diagonal,
+        qitensor.mps,
+        qitensor.clifford,
+        qitensor.sampling,
         qitensor.group,
         qitensor.sympybasefield,
         qitensor.experimental.cartan_decompose,
@@ -15,21 +15,25 @@ cdef class HilbertArray:
     cpdef assert_density_matrix(self, check_hermitian=*, check_normalized=*, check_positive=*)
     cpdef is_positive(self)
     cpdef set_data(self, new_data)
-    cpdef tensordot(self, HilbertArray other, contraction_spaces=*)
+    cpdef tensordot(self, HilbertArray other, contraction_spaces=*, HilbertArray out=*)
     cpdef tensor(self, HilbertArray other)
-    cpdef transpose(self, tpose_axes=*)
+    cpdef transpose(self, tpose_axes=*, HilbertArray out=*)
     cpdef relabel(self, from_spaces, to_spaces=*)
     cpdef relabel_prime(self)
     cpdef apply_map(self, fn)
     cpdef closeto(self, HilbertArray other, rtol=*, atol=*)
     cpdef lmul(self, HilbertArray other)
+    cpdef mul(self, other, HilbertArray out=*)
+    cpdef add(self, HilbertArray other, HilbertArray out=*)
+    cpdef sub(self, HilbertArray other, HilbertArray out=*)
     cpdef _index_key_to_map(self, key)
     cpdef _get_set_item(self, key, do_set=*, set_val=*)
     cpdef _space_string(self, spc_set)
     cpdef _get_row_col_spaces(self, row_space=*, col_space=*)
     cpdef diag(self, as_np=*)
     cpdef as_np_matrix(self, dtype=*, row_space=*, col_space=*)
-    cpdef np_matrix_transform(self, f, transpose_dims=*, row_space=*, col_space=*)
+    cpdef np_matrix_transform(self, f, transpose_dims=*, row_space=*, col_space=*, HilbertArray out=*)
+    cpdef adjoint(self, HilbertArray out=*)
     cpdef det(self)
     cpdef fill(self, val)
     cpdef norm(self, p=*)
@@ -39,7 +43,7 @@ cdef class HilbertArray:
     cpdef normalize(self)
     cpdef normalized(self)
     cpdef inv(self, row_space=*)
-    cpdef conj(self)
+    cpdef conj(self, HilbertArray out=*)
     cpdef conj_by(self, U)
     cpdef svd(self, full_matrices=*, inner_space=*)
     cpdef svd_list(self, row_space=*, col_space=*, thresh=*)
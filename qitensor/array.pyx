@@ -21,8 +21,10 @@ from qitensor.atom import HilbertAtom
 from qitensor.atom cimport HilbertAtom
 from qitensor.arrayformatter import FORMATTER
 from qitensor.subspace import TensorSubspace
+from qitensor.cache import LRUCache, SizedLRUCache
+from qitensor.cache cimport LRUCache, SizedLRUCache
 
-__all__ = ['HilbertArray']
+__all__ = ['HilbertArray', 'TENSORDOT_WISDOM', 'OPERATOR_CACHE']
 
 def _parse_space(s):
     if s is None:
@@ -39,15 +41,80 @@ def _unreduce_v1(space, nparray):
 
     return space.array(nparray)
 
+def _unreduce_wisdom_v1(contract_axes, out_num_axes, ret_space, transpose_axes, matmul_shape=None):
+    """
+    This is the function that handles restoring a pickled TensordotWisdom.
+    """
+
+    cdef TensordotWisdom wisdom = TensordotWisdom.__new__(TensordotWisdom)
+    wisdom.contract_axes = contract_axes
+    wisdom.out_num_axes = out_num_axes
+    wisdom.ret_space = ret_space
+    wisdom.transpose_axes = transpose_axes
+    wisdom.matmul_shape = matmul_shape
+    return wisdom
+
+cdef class TensordotWisdomCache(LRUCache):
+    """
+    The cache of :class:`TensordotWisdom` used by ``HilbertArray.tensordot``,
+    available as ``qitensor.TENSORDOT_WISDOM``.  It is bounded (least
+    recently used entries are evicted), keeps hit/miss/eviction statistics,
+    and can be pre-warmed or saved to disk and loaded by another process.
+
+    >>> import tempfile
+    >>> from qitensor import qubit, TENSORDOT_WISDOM
+    >>> ha = qubit('a')
+    >>> hb = qubit('b')
+    >>> TENSORDOT_WISDOM.clear()
+    >>> TENSORDOT_WISDOM.reset_stats()
+    >>> x = ha.O.random_array()
+    >>> y = x * x * x
+    >>> s = TENSORDOT_WISDOM.stats()
+    >>> (s['size'], s['hits'], s['misses'])
+    (1, 1, 1)
+    >>> TENSORDOT_WISDOM.prewarm([ (ha*hb.H, hb), (hb.O, ha.O, frozenset()) ])
+    >>> len(TENSORDOT_WISDOM)
+    3
+    >>> with tempfile.TemporaryFile() as f:
+    ...     TENSORDOT_WISDOM.dump(f)
+    ...     TENSORDOT_WISDOM.clear()
+    ...     _ = f.seek(0)
+    ...     TENSORDOT_WISDOM.load(f)
+    >>> len(TENSORDOT_WISDOM)
+    3
+    >>> TENSORDOT_WISDOM.reset_stats()
+    >>> (x * x).closeto(x.tensordot(x))
+    True
+    >>> TENSORDOT_WISDOM.misses
+    0
+    """
+
+    def prewarm(self, space_pairs):
+        """
+        Computes the wisdom for each given ``(space, other_space)`` or
+        ``(space, other_space, contraction_spaces)`` tuple.
+        """
+
+        for p in space_pairs:
+            p = tuple(p)
+            if len(p) == 2:
+                p = p + (None, )
+            _get_td_wisdom(p[0], p[1], p[2])
+
 # This holds the result of all the difficult thinking that HilbertArray.tensordot() needs.
-# It is cached for speed.
-cdef dict _td_wisdom_cache = dict()
+# It is cached for speed, but bounded since fresh spaces (e.g. randomly named
+# environment spaces) would otherwise make it grow without limit.
+cdef TensordotWisdomCache _td_wisdom_cache = TensordotWisdomCache(10000)
+TENSORDOT_WISDOM = _td_wisdom_cache
 #
 cdef class TensordotWisdom:
-    cdef tuple contract_axes
-    cdef int out_num_axes
-    cdef HilbertSpace ret_space
-    cdef tuple transpose_axes
+    cdef readonly tuple contract_axes
+    cdef readonly int out_num_axes
+    cdef readonly HilbertSpace ret_space
+    cdef readonly tuple transpose_axes
+    # (m, k, n) if the product is a plain (m,k)x(k,n) matrix product of the
+    # underlying arrays, otherwise None.
+    cdef readonly tuple matmul_shape
 
     def __init__(self, hs, ohs, contraction_spaces):
         cdef frozenset mul_space
@@ -109,6 +176,424 @@ cdef class TensordotWisdom:
             self.ret_space = create_space2(ket1 | ket2, bra1 | bra2)
             self.transpose_axes = tuple([td_axes.index(x) for x in self.ret_space.axes])
 
+            # If the contracted axes are the trailing axes of the first array
+            # and the leading axes of the second (in the same order), and the
+            # output needs no transpose, then np.dot can write the result
+            # directly into a preallocated output buffer.
+            nk = len(mul_space_sorted)
+            na = len(hs.axes)
+            if axes_self == list(range(na-nk, na)) and \
+                    axes_other == list(range(nk)) and \
+                    self.transpose_axes == tuple(range(self.out_num_axes)):
+                self.matmul_shape = (
+                    _shape_product(hs.shape[:na-nk]),
+                    _shape_product(hs.shape[na-nk:]),
+                    _shape_product(ohs.shape[nk:]))
+
+    def __reduce__(self):
+        """
+        Tells pickle how to store this object.
+        """
+
+        return _unreduce_wisdom_v1, (self.contract_axes, self.out_num_axes,
+            self.ret_space, self.transpose_axes, self.matmul_shape)
+
+cpdef TensordotWisdom _get_td_wisdom(HilbertSpace hs, HilbertSpace ohs, contraction_spaces):
+    """
+    Returns the (cached) axis bookkeeping for a tensordot between arrays on
+    spaces ``hs`` and ``ohs``.
+    """
+
+    wisdom_key = (hs, ohs, contraction_spaces)
+    cdef TensordotWisdom wisdom = _td_wisdom_cache.get(wisdom_key, None)
+    if wisdom is None:
+        wisdom = TensordotWisdom(hs, ohs, contraction_spaces)
+        _td_wisdom_cache.put(wisdom_key, wisdom)
+    return wisdom
+
+cdef np.ndarray _check_out(HilbertArray out, HilbertSpace space):
+    """
+    Verifies that ``out`` can receive a result on ``space`` and returns its
+    underlying numpy array.
+    """
+
+    if out.space != space:
+        raise MismatchedSpaceError('Mismatched HilbertSpaces: '+
+            repr(out.space)+' vs. '+repr(space))
+    if out.nparray.dtype != space.base_field.dtype:
+        raise HilbertError('out array has dtype '+repr(out.nparray.dtype)+
+            ', should be '+repr(space.base_field.dtype))
+    _copy_on_write(out)
+    return out.nparray
+
+cdef inline _copy_on_write(HilbertArray arr):
+    """
+    Gives ``arr`` a private, writeable copy of its data if it is sharing
+    read-only data, such as a memoized gate (see :func:`_cached_operator`).
+    Called before modifying an array in place.
+    """
+
+    if not arr.nparray.flags.writeable:
+        arr.nparray = arr.nparray.copy()
+
+# The read-only data of operators created by the gate constructors and by
+# methods such as HilbertSpace.eye(), keyed by the constructor and its
+# arguments.  It is bounded by memory use rather than by number of entries.
+cdef SizedLRUCache _operator_cache = SizedLRUCache(maxbytes=256*1024*1024)
+OPERATOR_CACHE = _operator_cache
+
+def _cached_operator(key, build, *args):
+    """
+    Returns the operator ``build(*args)``, memoized under ``key``.
+
+    The data of the cached operator is marked read-only and shared between
+    all arrays returned for the same key, so building a gate a second time
+    costs only a cache lookup.  Each call returns a new ``HilbertArray``
+    wrapping the shared data; modifying it in place first makes a private
+    copy.
+
+    The cache is available as ``qitensor.OPERATOR_CACHE``.  It holds at most
+    256MB by default, which can be changed using ``resize_bytes``, and its
+    ``stats()`` give the hit and miss counts.
+
+    >>> import numpy as np
+    >>> from qitensor import qubit, cnot
+    >>> ha = qubit('a')
+    >>> hb = qubit('b')
+    >>> U = cnot(ha, hb)
+    >>> V = cnot(ha, hb)
+    >>> U is V
+    False
+    >>> np.may_share_memory(U.nparray, V.nparray)
+    True
+    >>> U *= 2
+    >>> U[{ ha: 0, hb: 0, ha.H: 0, hb.H: 0 }] = 5
+    >>> V == cnot(ha, hb)
+    True
+    >>> U.closeto(V * 2)
+    False
+
+    >>> from qitensor import OPERATOR_CACHE
+    >>> OPERATOR_CACHE.reset_stats()
+    >>> for i in range(10):
+    ...     _ = ha.X
+    >>> (OPERATOR_CACHE.hits, OPERATOR_CACHE.misses) in [(9, 1), (10, 0)]
+    True
+    """
+
+    entry = _operator_cache.get(key, None)
+    if entry is None:
+        op = build(*args)
+        nd = op.nparray
+        if nd.base is not None or not nd.flags.c_contiguous:
+            nd = np.ascontiguousarray(nd).copy()
+        nd.flags.writeable = False
+        entry = (op.space, nd)
+        _operator_cache.put(key, entry)
+    return entry[0].array_from_buffer(entry[1])
+
+def _density_spectrum(HilbertArray rho, normalize, checks):
+    """
+    Returns the eigenvalues of the density operator ``rho``, performing the
+    validation requested by ``checks`` (see :func:`HilbertArray.entropy`).
+    The eigenvalues are used for the positivity and normalization checks, so
+    that only one eigensolve is done.
+    """
+
+    if not checks in (True, False, 'fast'):
+        raise HilbertError('checks must be True, False, or "fast": '+repr(checks))
+
+    if not rho.space.is_symmetric():
+        raise HilbertError("not a density matrix: "+str(rho.space))
+
+    if checks is True:
+        rho.assert_density_matrix(check_normalized=False, check_positive=False)
+
+    p = rho.eigvals(hermit=True)
+
+    if normalize:
+        p = p / abs(np.sum(p))
+
+    if checks:
+        tr = np.sum(p)
+        if abs(tr - 1) > 1e-9:
+            raise HilbertError('density matrix was not normalized: trace='+str(tr))
+        if not np.all(p >= -1e-9):
+            raise HilbertError('density matrix was not positive: '+str(p))
+
+    return p
+
+def _assert_disjoint_spaces(*spaces):
+    """
+    Raises an error unless the given spaces have no atoms in common (up to
+    taking the dual).
+    """
+
+    seen = frozenset()
+    for spc in spaces:
+        kets = frozenset([x.H if x.is_dual else x for x in spc.bra_ket_set])
+        if seen & kets:
+            raise MismatchedSpaceError('spaces are not disjoint: '+
+                ' vs. '.join([str(x) for x in spaces]))
+        seen = seen | kets
+
+cdef _conj_into(base_field, np.ndarray src, np.ndarray dst):
+    """
+    Writes the complex conjugate of ``src`` into ``dst`` (which may be the
+    same array).
+    """
+
+    if dst.dtype == object:
+        # symbolic base fields have their own notion of conjugation
+        np.copyto(dst, base_field.mat_conj(src))
+    else:
+        np.conjugate(src, out=dst)
+
+def _trace_axes_dict(HilbertSpace space, axes):
+    """
+    Converts the ``axes`` parameter of :func:`HilbertArray.trace` into a
+    dictionary mapping each traced atom to the atom it is paired with.
+    """
+
+    if isinstance(axes, HilbertSpace):
+        axes = axes.bra_ket_set
+        # and then process further in the next if block
+
+    if not isinstance(axes, dict):
+        axes_set = set()
+        for s in HilbertSpace._expand_list_to_atoms(list(axes)):
+            if not s in space.bra_ket_set:
+                raise HilbertError('not in ket set: '+repr(s))
+            axes_set.add(s.H if s.is_dual else s)
+        axes = dict((s, s.H) for s in axes_set)
+
+    assert isinstance(axes, dict)
+
+    HilbertSpace._assert_nodup_space(list(axes.keys())+list(axes.values()), "a space was listed twice")
+
+    for (k, v) in axes.items():
+        if not k in space.bra_ket_set:
+            raise HilbertError("not in this array's space: "+repr(k))
+        if not v in space.bra_ket_set:
+            raise HilbertError("not in this array's space: "+repr(v))
+
+    return axes
+
+# einsum only supports this many distinct subscripts
+DEF EINSUM_MAX_LABELS = 52
+
+# cache of partial trace plans, keyed by (space, axes)
+cdef LRUCache _trace_plan_cache = LRUCache(1000)
+
+def _get_trace_plan(HilbertSpace space, axes):
+    """
+    Returns the (cached) plan for tracing ``axes`` out of an array on
+    ``space``.  This is a tuple ``(axes_dict, in_labels, out_labels,
+    out_space)`` where ``axes_dict`` is as returned by
+    :func:`_trace_axes_dict`, the labels are einsum subscripts (paired axes
+    sharing a label), and ``out_space`` is None if the result is a scalar.
+    """
+
+    # Spaces are hashable and are the common case, so they can be looked up
+    # before being parsed.
+    key = (space, axes) if isinstance(axes, HilbertSpace) else None
+    if key is not None:
+        plan = _trace_plan_cache.get(key, None)
+        if plan is not None:
+            return plan
+
+    axes_dict = _trace_axes_dict(space, axes)
+    if key is None:
+        key = (space, frozenset(axes_dict.items()))
+        plan = _trace_plan_cache.get(key, None)
+        if plan is not None:
+            return plan
+
+    in_labels = list(range(len(space.axes)))
+    for (s1, s2) in axes_dict.items():
+        in_labels[space.axes_lookup[s2]] = in_labels[space.axes_lookup[s1]]
+
+    out_atoms = space.bra_ket_set - frozenset(list(axes_dict.keys())+list(axes_dict.values()))
+    if len(out_atoms):
+        out_space = create_space1(out_atoms)
+        out_labels = [in_labels[space.axes_lookup[x]] for x in out_space.axes]
+    else:
+        out_space = None
+        out_labels = []
+
+    plan = (axes_dict, in_labels, out_labels, out_space)
+    _trace_plan_cache.put(key, plan)
+    return plan
+
+# cache of local operator application plans, keyed by (space, op_space)
+cdef LRUCache _apply_plan_cache = LRUCache(1000)
+
+def _fwht_axis(np.ndarray nd, int axis):
+    """
+    Applies the unnormalized Walsh-Hadamard transform in place along an axis
+    whose length is a power of 2, using one butterfly pass per bit.
+    """
+
+    shape = np.shape(nd)
+    d = shape[axis]
+    x = nd.reshape(_shape_product(tuple(shape[:axis])), d,
+        _shape_product(tuple(shape[axis+1:])))
+    h = 1
+    while h < d:
+        v = x.reshape(x.shape[0], d // (2*h), 2, h, x.shape[2])
+        a = v[:, :, 0].copy()
+        v[:, :, 0] += v[:, :, 1]
+        v[:, :, 1] *= -1
+        v[:, :, 1] += a
+        h *= 2
+
+def _haar_rows(x):
+    """
+    Applies the Haar wavelet transform to each row of ``x``: the overall
+    average comes first, followed by the differences from coarsest to finest.
+    """
+
+    ret = np.empty_like(x)
+    end = x.shape[1]
+    r = np.sqrt(2)
+    while end > 1:
+        half = end // 2
+        pairs = x.reshape(x.shape[0], half, 2)
+        ret[:, half:end] = (pairs[:, :, 0] - pairs[:, :, 1]) / r
+        x = (pairs[:, :, 0] + pairs[:, :, 1]) / r
+        end = half
+    ret[:, 0] = x[:, 0]
+    return ret
+
+def _get_apply_plan(HilbertSpace space, HilbertSpace op_space):
+    """
+    Returns the (cached) plan for applying an operator on ``op_space`` (of
+    the form ``|x><x|``) to the kets of an array on ``space``.
+
+    The array is viewed as a block array with shape ``(r_0, d_1, r_1, ...,
+    d_k, r_k)``, where ``d_j`` are the dimensions of the operator's atoms and
+    the ``r_j`` are the (merged) dimensions of the axes between them.  The
+    plan is a tuple ``(block_shape, perm, op_shape, scratch_shape)``:
+    ``perm`` moves the ``d_j`` next to each other, just before ``r_k``, and
+    then the operator data reshaped to ``op_shape`` can be multiplied (using
+    ``np.matmul``) against the gathered data reshaped to ``scratch_shape``.
+    """
+
+    key = (space, op_space)
+    plan = _apply_plan_cache.get(key, None)
+    if plan is None:
+        atoms = op_space.sorted_kets
+        pos = sorted([ space.axes_lookup[x] for x in atoms ])
+        dims = [ space.shape[p] for p in pos ]
+        k = len(pos)
+        bounds = [-1] + pos + [len(space.axes)]
+        rest = [ _shape_product(space.shape[bounds[j]+1:bounds[j+1]]) for j in range(k+1) ]
+
+        block_shape = []
+        for j in range(k):
+            block_shape += [rest[j], dims[j]]
+        block_shape.append(rest[k])
+
+        perm = list(range(0, 2*k, 2)) + list(range(1, 2*k, 2)) + [2*k]
+        dim = _shape_product(dims)
+        op_shape = tuple(dims[:-1] + [dims[-1], dim])
+        scratch_shape = tuple(rest[:-1] + [1]*(k-1) + [dim, rest[k]])
+
+        plan = (tuple(block_shape), tuple(perm), op_shape, scratch_shape)
+        _apply_plan_cache.put(key, plan)
+    return plan
+
+# cache of relabel plans, keyed by (space, mapping)
+cdef LRUCache _relabel_plan_cache = LRUCache(1000)
+
+def _get_relabel_plan(HilbertSpace space, dict mapping, key=None):
+    """
+    Returns the (cached) result of relabeling ``space`` according to the
+    atom-to-atom ``mapping`` given by :func:`_relabel_mapping`.  This is a
+    tuple ``(new_space, xlate_list, permute)`` where ``xlate_list`` lists the
+    new atoms in the axis order of the original array and ``permute`` is the
+    transpose that brings the original array to the axis order of
+    ``new_space``.
+    """
+
+    if key is None:
+        key = (space, frozenset(mapping.items()))
+    plan = _relabel_plan_cache.get(key, None)
+    if plan is None:
+        xlate_list = [ mapping[x] if x in mapping else x for x in space.axes ]
+        HilbertSpace._assert_nodup_space(xlate_list, "relabling would cause a duplicated space")
+        new_space = create_space1(xlate_list)
+        permute = tuple([xlate_list.index(x) for x in new_space.axes])
+        plan = (new_space, xlate_list, permute)
+        _relabel_plan_cache.put(key, plan)
+    return plan
+
+def _relabel_mapping(HilbertSpace space, from_spaces, to_spaces):
+    """
+    Converts the arguments of :func:`HilbertArray.relabel` into a validated
+    dictionary mapping HilbertAtoms of ``space`` to their new HilbertAtoms.
+    """
+
+    ### Turn input into a mapping
+
+    if isinstance(from_spaces, HilbertSpace):
+        from_spaces = (from_spaces, )
+    if isinstance(to_spaces, HilbertSpace):
+        to_spaces = (to_spaces, )
+
+    if isinstance(from_spaces, dict):
+        assert to_spaces is None
+        mapping = from_spaces
+        HilbertSpace._assert_nodup_space(mapping.values(), "an output space was listed twice")
+    else:
+        # Cast to list, in case we were given a generator.  Throw error if not list-like.
+        from_spaces = list(from_spaces)
+        to_spaces = list(to_spaces)
+
+        for (a, b) in zip(from_spaces, to_spaces):
+            if not isinstance(a, HilbertSpace) or not isinstance(b, HilbertSpace):
+                raise HilbertError("expected a HilbertSpace")
+            if a.dim() != b.dim():
+                # dimension will be checked again below, but this guards against inputs
+                # like ((a*b,c), (x,y*z)).
+                raise HilbertShapeError(a.dim(), b.dim())
+
+        from_spaces = HilbertSpace._expand_list_to_atoms(from_spaces)
+        to_spaces   = HilbertSpace._expand_list_to_atoms(to_spaces)
+
+        if len(from_spaces) != len(to_spaces):
+            raise MismatchedSpaceError("Number of spaces does not match")
+
+        HilbertSpace._assert_nodup_space(from_spaces, "an input space was listed twice")
+        HilbertSpace._assert_nodup_space(to_spaces, "an output space was listed twice")
+        mapping = dict(zip(from_spaces, to_spaces))
+
+    ### Split up any HilbertSpace in the mapping into HilbertAtoms
+
+    m2 = {}
+    for (k,v) in mapping.items():
+        if not isinstance(k, HilbertSpace) or not isinstance(v, HilbertSpace):
+            raise HilbertError("expected a HilbertSpace")
+        atoms_k = sorted(k.ket_set) + sorted(k.bra_set)
+        atoms_v = sorted(v.ket_set) + sorted(v.bra_set)
+        if len(atoms_k) != len(atoms_v):
+            raise MismatchedSpaceError("Number of spaces does not match")
+        for (ak,av) in zip(atoms_k, atoms_v):
+            m2[ak] = av
+    mapping = m2
+
+    ### Validate
+
+    for (k,v) in mapping.items():
+        assert isinstance(k, HilbertAtom)
+        assert isinstance(v, HilbertAtom)
+        if not k in space.bra_ket_set:
+            raise MismatchedSpaceError("not in input space: "+repr(k))
+        if k.dim() != v.dim():
+            raise HilbertShapeError(k.dim(), v.dim())
+
+    return mapping
+
 cdef class HilbertArray:
     def __init__(self, HilbertSpace space, data, cpython.bool noinit_data, cpython.bool reshape, input_axes):
         """
@@ -171,8 +656,7 @@ cdef class HilbertArray:
                 self.nparray = self.nparray.transpose(shuffle)
 
         if self.nparray is not None:
-            cast_fn = space.base_field.input_cast_function()
-            self.nparray = np.vectorize(cast_fn)(self.nparray)
+            self.nparray = hs.base_field.cast_array(self.nparray)
 
     def __reduce__(self):
         """
@@ -203,6 +687,45 @@ cdef class HilbertArray:
         ret.nparray = self.nparray.copy()
         return ret
 
+    def lazy(self):
+        """
+        Returns a lazily evaluated version of this array.
+
+        Operations on the returned object build up an expression which is
+        only computed (in fused form) when ``eval()`` is called.  See
+        :mod:`qitensor.lazyarray`.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb).O.random_array()
+        >>> y = x.lazy() * x.H
+        >>> y
+        LazyHilbertArray(|a,b><a,b|)
+        >>> y.eval().closeto(x * x.H)
+        True
+        """
+
+        from qitensor.lazyarray import LazyHilbertArray
+        return LazyHilbertArray._leaf(self)
+
+    def to_sparse(self):
+        """
+        Returns a sparse copy of this array.  See :mod:`qitensor.sparse`.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb).eye().to_sparse()
+        >>> x
+        SparseHilbertArray(|a,b><a,b|, nnz=4)
+        >>> x.to_dense() == (ha*hb).eye()
+        True
+        """
+
+        from qitensor.sparse import SparseHilbertArray
+        return SparseHilbertArray.from_array(self)
+
     cpdef _reassign(self, HilbertArray other):
         """
         Used internally to change the contents of a HilbertArray without creating a new object.
@@ -304,8 +827,10 @@ cdef class HilbertArray:
         if not self.space.is_symmetric():
             raise HilbertError("not a density matrix: "+str(self.space))
 
-        if check_hermitian and not (self == self.H or self.closeto(self.H)):
-            raise HilbertError("not a density matrix: not Hermitian")
+        if check_hermitian:
+            h = self.H
+            if not (self == h or self.closeto(h)):
+                raise HilbertError("not a density matrix: not Hermitian")
 
         if check_normalized:
             tr = self.trace()
@@ -380,10 +905,11 @@ cdef class HilbertArray:
             self._assert_same_axes(new_data)
             self.set_data(new_data.nparray)
         else:
+            _copy_on_write(self)
             # This is needed to make slices work properly
             self.nparray[:] = new_data
 
-    cpdef tensordot(self, HilbertArray other, contraction_spaces=None):
+    cpdef tensordot(self, HilbertArray other, contraction_spaces=None, HilbertArray out=None):
         """
         Inner or outer product of two arrays.
 
@@ -392,6 +918,9 @@ cdef class HilbertArray:
         :param contraction_spaces: the spaces on which to do a tensor
             contraction
         :type other: None, frozenset, or HilbertSpace; default None
+        :param out: if given, the result is written into this array (which
+            must be on the result space) and it is returned
+        :type out: HilbertArray or None; default None
 
         If ``contraction_spaces`` is ``None`` (the default), contraction will
         be across the intersection of the bra space of this array and the ket
@@ -427,6 +956,19 @@ cdef class HilbertArray:
         |a,b><a,b|
         >>> ((xa*xa)*(xb*xb)).closeto((xa*xb)*(xa*xb))
         True
+
+        Writing into a preallocated output array avoids allocating memory
+        for the result:
+
+        >>> z = (ha * ha.H * hb.H).array()
+        >>> x.tensordot(y, out=z) is z
+        True
+        >>> z.closeto(x * y)
+        True
+        >>> x.tensordot(y, out=ha.O.array())
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'Mismatched HilbertSpaces: |a><a| vs. |a><a,b|'
         """
 
         #print str(self.space)+'*'+str(other.space)
@@ -438,13 +980,31 @@ cdef class HilbertArray:
         #if (contraction_spaces is None) and (self.space._is_simple_dyad) and (self.space == other.space) and (self.space == self.space.H):
         #    return self.space.array(np.dot(self.nparray, other.nparray))
 
-        wisdom_key = (self.space, other.space, contraction_spaces)
-        cdef TensordotWisdom wisdom = _td_wisdom_cache.get(wisdom_key, None)
-        if wisdom is None:
-            wisdom = TensordotWisdom(self.space, other.space, contraction_spaces)
-            _td_wisdom_cache[wisdom_key] = wisdom
+        cdef TensordotWisdom wisdom = _get_td_wisdom(self.space, other.space, contraction_spaces)
+
+        cdef np.ndarray out_nd
+        cdef np.ndarray td
+
+        if out is not None:
+            if wisdom.out_num_axes == 0:
+                raise HilbertError('out cannot be used when the result is a scalar')
+            out_nd = _check_out(out, wisdom.ret_space)
+            if wisdom.matmul_shape is not None and \
+                    self.nparray.flags.c_contiguous and \
+                    other.nparray.flags.c_contiguous and \
+                    out_nd.flags.c_contiguous and \
+                    not np.may_share_memory(out_nd, self.nparray) and \
+                    not np.may_share_memory(out_nd, other.nparray):
+                (m, k, n) = wisdom.matmul_shape
+                np.dot(self.nparray.reshape(m, k), other.nparray.reshape(k, n),
+                    out=out_nd.reshape(m, n))
+            else:
+                td = np.tensordot(self.nparray, other.nparray,
+                        axes=wisdom.contract_axes)
+                np.copyto(out_nd, td.transpose(wisdom.transpose_axes))
+            return out
 
-        cdef np.ndarray td = np.tensordot(self.nparray, other.nparray,
+        td = np.tensordot(self.nparray, other.nparray,
                 axes=wisdom.contract_axes)
         assert td.dtype == self.space.base_field.dtype
         assert wisdom.out_num_axes == td.ndim
@@ -464,12 +1024,15 @@ cdef class HilbertArray:
 
         return self.tensordot(other, contraction_spaces=frozenset())
 
-    cpdef transpose(self, tpose_axes=None):
+    cpdef transpose(self, tpose_axes=None, HilbertArray out=None):
         """
         Perform a transpose or partial transpose operation.
 
         :param tpose_axes: the space on which to transpose
         :type tpose_axes: HilbertSpace or None; default None
+        :param out: if given, the result is copied into this array (which
+            must be on the result space) and it is returned
+        :type out: HilbertArray or None; default None
 
         If ``tpose_axes`` is ``None`` a full transpose is performed.
         Otherwise, ``tpose_axes`` should be a ``HilbertSpace``.  The array will
@@ -496,6 +1059,11 @@ cdef class HilbertArray:
         |b><a|
         >>> y.transpose(ha) == y.transpose(ha.H)
         True
+        >>> z = (hb * ha.H).array()
+        >>> y.transpose(ha, out=z) is z
+        True
+        >>> z == y.transpose(ha)
+        True
         """
 
         if tpose_axes is None:
@@ -520,9 +1088,13 @@ cdef class HilbertArray:
                 in_space_dualled.append(x)
 
         out_space = create_space1(in_space_dualled)
+        permute = tuple([in_space_dualled.index(x) for x in out_space.axes])
+
+        if out is not None:
+            np.copyto(_check_out(out, out_space), self.nparray.transpose(permute))
+            return out
 
         ret = out_space.array(noinit_data=True)
-        permute = tuple([in_space_dualled.index(x) for x in ret.axes])
         ret.nparray = self.nparray.transpose(permute)
 
         return ret
@@ -551,7 +1123,10 @@ cdef class HilbertArray:
           list, and so on.
         * You can pass a dictionary of HilbertSpaces of the form {from_atom => to_atom, ...}.
 
-        FIXME - does it return a view? should it?
+        The returned array is a view: it shares data with this array, with
+        only the order of the axes changed.  Use ``relabel(...).copy()`` if an
+        independent array is needed.  (An exception is relabeling to spaces of
+        a different base field, which requires the data to be converted.)
 
         >>> import numpy
         >>> from qitensor import qubit
@@ -593,73 +1168,27 @@ cdef class HilbertArray:
         True
         >>> z.relabel({ hb.H*hc.H: ha.H*hb.H }) == z.relabel({ hb.H: ha.H, hc.H: hb.H })
         True
+        >>> # the result is a view
+        >>> numpy.may_share_memory(z1.nparray, z.nparray)
+        True
         """
 
-        ### Turn input into a mapping
-
-        if isinstance(from_spaces, HilbertSpace):
-            from_spaces = (from_spaces, )
-        if isinstance(to_spaces, HilbertSpace):
-            to_spaces = (to_spaces, )
+        mapping = _relabel_mapping(self.space, from_spaces, to_spaces)
+        return self._relabel_by_plan(_get_relabel_plan(self.space, mapping))
 
-        if isinstance(from_spaces, dict):
-            assert to_spaces is None
-            mapping = from_spaces
-            HilbertSpace._assert_nodup_space(mapping.values(), "an output space was listed twice")
-        else:
-            # Cast to list, in case we were given a generator.  Throw error if not list-like.
-            from_spaces = list(from_spaces)
-            to_spaces = list(to_spaces)
-
-            for (a, b) in zip(from_spaces, to_spaces):
-                if not isinstance(a, HilbertSpace) or not isinstance(b, HilbertSpace):
-                    raise HilbertError("expected a HilbertSpace")
-                if a.dim() != b.dim():
-                    # dimension will be checked again below, but this guards against inputs
-                    # like ((a*b,c), (x,y*z)).
-                    raise HilbertShapeError(a.dim(), b.dim())
-
-            from_spaces = HilbertSpace._expand_list_to_atoms(from_spaces)
-            to_spaces   = HilbertSpace._expand_list_to_atoms(to_spaces)
-
-            if len(from_spaces) != len(to_spaces):
-                raise MismatchedSpaceError("Number of spaces does not match")
+    def _relabel_by_plan(self, plan):
+        """
+        Applies a plan from :func:`_get_relabel_plan`.
+        """
 
-            HilbertSpace._assert_nodup_space(from_spaces, "an input space was listed twice")
-            HilbertSpace._assert_nodup_space(to_spaces, "an output space was listed twice")
-            mapping = dict(zip(from_spaces, to_spaces))
+        (new_space, xlate_list, permute) = plan
 
-        ### Split up any HilbertSpace in the mapping into HilbertAtoms
+        if new_space.base_field != self.space.base_field:
+            return new_space.array(data=self.nparray, input_axes=xlate_list)
 
-        m2 = {}
-        for (k,v) in mapping.items():
-            if not isinstance(k, HilbertSpace) or not isinstance(v, HilbertSpace):
-                raise HilbertError("expected a HilbertSpace")
-            atoms_k = sorted(k.ket_set) + sorted(k.bra_set)
-            atoms_v = sorted(v.ket_set) + sorted(v.bra_set)
-            if len(atoms_k) != len(atoms_v):
-                raise MismatchedSpaceError("Number of spaces does not match")
-            for (ak,av) in zip(atoms_k, atoms_v):
-                m2[ak] = av
-        mapping = m2
-
-        ### Validate
-
-        for (k,v) in mapping.items():
-            assert isinstance(k, HilbertAtom)
-            assert isinstance(v, HilbertAtom)
-            if not k in self.space.bra_ket_set:
-                raise MismatchedSpaceError("not in input space: "+repr(k))
-            if k.dim() != v.dim():
-                raise HilbertShapeError(k.dim(), v.dim())
-
-        ### Produce the result
-
-        xlate_list = [ mapping[x] if x in mapping else x for x in self.axes ]
-        HilbertSpace._assert_nodup_space(xlate_list, "relabling would cause a duplicated space")
-        new_space = create_space1(xlate_list)
-
-        return new_space.array(data=self.nparray, input_axes=xlate_list)
+        ret = new_space.array(None, True)
+        ret.nparray = self.nparray.transpose(permute)
+        return ret
 
     cpdef relabel_prime(self):
         """
@@ -675,9 +1204,17 @@ cdef class HilbertArray:
         |a',b'>
         >>> (x * x.relabel_prime()).space
         |a,a',b,b'>
+        >>> y = (ha*hb.H).random_array()
+        >>> y.relabel_prime() == y.relabel(ha*hb.H, ha.prime*hb.prime.H)
+        True
         """
 
-        return self.relabel(self.axes, [x.prime for x in self.axes])
+        key = ('prime', self.space)
+        plan = _relabel_plan_cache.get(key, None)
+        if plan is None:
+            mapping = dict([(x, x.prime) for x in self.axes])
+            plan = _get_relabel_plan(self.space, mapping, key)
+        return self._relabel_by_plan(plan)
 
     cpdef apply_map(self, fn):
         """
@@ -693,7 +1230,7 @@ cdef class HilbertArray:
 
         dtype = self.space.base_field.dtype
         arr = np.vectorize(fn, otypes=[dtype])(self.nparray)
-        return self.space.array(arr)
+        return self.space.array_from_buffer(arr)
 
     cpdef closeto(self, HilbertArray other, rtol=1e-05, atol=1e-08):
         """
@@ -855,6 +1392,7 @@ cdef class HilbertArray:
                 x = cast_fn(other)
             except TypeError:
                 return NotImplemented
+            _copy_on_write(self)
             self.nparray *= x
         return self
 
@@ -906,6 +1444,7 @@ cdef class HilbertArray:
             return NotImplemented
 
         self._assert_same_axes(other)
+        _copy_on_write(self)
         self.nparray += other.nparray
         return self
 
@@ -970,9 +1509,331 @@ cdef class HilbertArray:
             return NotImplemented
 
         self._assert_same_axes(other)
+        _copy_on_write(self)
         self.nparray -= other.nparray
         return self
 
+    cpdef mul(self, other, HilbertArray out=None):
+        """
+        Multiplies this array by another array or by a scalar, the same as
+        ``self * other``.
+
+        If ``out`` is given, the result is written into it and it is
+        returned, so that no new array is allocated.  It must be on the
+        space of the result and must not be one of the operands in order to
+        avoid a temporary copy.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb).random_unitary()
+        >>> y = (ha*hb).random_unitary()
+        >>> z = (ha*hb).O.array()
+        >>> x.mul(y, out=z) is z
+        True
+        >>> z.closeto(x*y)
+        True
+        >>> x.mul(2, out=z).closeto(2*x)
+        True
+        >>> x.mul(y).closeto(x*y)
+        True
+        >>> x.mul(ha.array(), out=z)
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'Mismatched HilbertSpaces: |a,b><a,b| vs. |a,b><b|'
+        """
+
+        if isinstance(other, HilbertArray):
+            return self.tensordot(other, out=out)
+
+        if out is None:
+            return self * other
+
+        cast_fn = self.space.base_field.input_cast_function()
+        np.multiply(self.nparray, cast_fn(other), out=_check_out(out, self.space))
+        return out
+
+    cpdef add(self, HilbertArray other, HilbertArray out=None):
+        """
+        Adds two arrays, the same as ``self + other``.  If ``out`` is given,
+        the result is written into it and it is returned.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> x = ha.random_array()
+        >>> y = ha.random_array()
+        >>> z = ha.array()
+        >>> x.add(y, out=z) is z
+        True
+        >>> z.closeto(x+y)
+        True
+        >>> x.add(y).closeto(x+y)
+        True
+        """
+
+        if out is None:
+            return self + other
+
+        self._assert_same_axes(other)
+        np.add(self.nparray, other.nparray, out=_check_out(out, self.space))
+        return out
+
+    cpdef sub(self, HilbertArray other, HilbertArray out=None):
+        """
+        Subtracts two arrays, the same as ``self - other``.  If ``out`` is
+        given, the result is written into it and it is returned.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> x = ha.random_array()
+        >>> y = ha.random_array()
+        >>> z = ha.array()
+        >>> x.sub(y, out=z) is z
+        True
+        >>> z.closeto(x-y)
+        True
+        >>> x.sub(y).closeto(x-y)
+        True
+        """
+
+        if out is None:
+            return self - other
+
+        self._assert_same_axes(other)
+        np.subtract(self.nparray, other.nparray, out=_check_out(out, self.space))
+        return out
+
+    def apply(self, op, inplace=False, scratch=None):
+        """
+        Applies an operator acting on some of the kets of this array, giving
+        the same result as ``op * self``.
+
+        The operator must be of the form ``|x><x|`` where ``x`` is a subset of
+        the kets of this array, so the result is on the same space as this
+        array and keeps its axis layout.  Rather than a general tensordot and
+        transpose, this gathers the data into a single scratch buffer and
+        multiplies it by the operator in one strided ``matmul``, writing the
+        result directly into place.  This is the core operation of circuit
+        simulation.
+
+        :param op: the operator to apply
+        :type op: HilbertArray, DiagonalHilbertArray, or SparseHilbertArray
+        :param inplace: if True, this array is overwritten with the result and
+            returned, otherwise a new array is returned
+        :param scratch: an optional numpy array, with the same size and dtype
+            as this array, to use as the scratch buffer.  Reusing a scratch
+            buffer across calls avoids allocating one each time.
+
+        Diagonal operators are multiplied in place directly, with no scratch
+        buffer.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, cnot, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> psi = (ha*hb*hc).random_array()
+        >>> U = cnot(hc, ha)
+        >>> psi.apply(U).closeto(U * psi)
+        True
+        >>> phi = psi.copy()
+        >>> scratch = np.empty(8, dtype=complex)
+        >>> phi.apply(U, inplace=True, scratch=scratch) is phi
+        True
+        >>> phi.closeto(U * psi)
+        True
+        >>> D = DiagonalHilbertArray(hb.O, [1, -1])
+        >>> psi.apply(D).closeto(hb.Z * psi)
+        True
+        >>> rho = (ha*hb).O.random_array()
+        >>> rho.apply(hb.X).closeto(hb.X * rho)
+        True
+        >>> psi.apply(ha.ket(0) * hb.bra(1))
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'apply needs an operator of the form |x><x|, not |a><b|'
+        """
+
+        from qitensor.diagonal import DiagonalHilbertArray, _expand
+
+        cdef HilbertSpace op_space = op.space
+        cdef HilbertSpace op_kets = op_space.ket_space()
+        if op_space != op_kets.O:
+            raise HilbertError('apply needs an operator of the form |x><x|, not '+
+                repr(op_space))
+        if not op_kets.ket_set <= self.space.ket_set:
+            raise MismatchedSpaceError('operator acts outside of the array: '+
+                repr(op_space)+' vs. '+repr(self.space))
+        self.space.base_field.assert_same(op_space.base_field)
+
+        cdef HilbertArray ret
+
+        if isinstance(op, DiagonalHilbertArray):
+            ret = self if inplace else self.copy()
+            _copy_on_write(ret)
+            ret.nparray *= _expand(op._diag, op._kets, list(self.axes))
+            return ret
+        if not isinstance(op, HilbertArray):
+            op = op.to_dense()
+
+        (block_shape, perm, op_shape, scratch_shape) = _get_apply_plan(self.space, op_space)
+
+        cdef np.ndarray src = self.nparray
+        if not src.flags.c_contiguous:
+            src = np.ascontiguousarray(src)
+
+        if scratch is None:
+            scratch = np.empty_like(src)
+        elif not isinstance(scratch, np.ndarray) or scratch.size != src.size or \
+                scratch.dtype != src.dtype or not scratch.flags.c_contiguous:
+            raise HilbertError('scratch must be a contiguous numpy array of size '+
+                str(src.size)+' and dtype '+repr(src.dtype))
+
+        gathered = scratch.reshape(src.reshape(block_shape).transpose(perm).shape)
+        np.copyto(gathered, src.reshape(block_shape).transpose(perm))
+
+        if inplace:
+            _copy_on_write(self)
+            ret = self
+        else:
+            ret = self.space.array_from_buffer(np.empty_like(src))
+
+        cdef np.ndarray dst = ret.nparray
+        if dst.flags.c_contiguous:
+            out = dst.reshape(block_shape).transpose(perm)
+            np.matmul(op.nparray.reshape(op_shape), gathered.reshape(scratch_shape), out=out)
+        else:
+            # a non-contiguous view, such as the result of relabel
+            res = np.matmul(op.nparray.reshape(op_shape), gathered.reshape(scratch_shape))
+            res = res.reshape(gathered.shape).transpose(np.argsort(perm)).reshape(np.shape(dst))
+            np.copyto(dst, res)
+        return ret
+
+    def _transform_axes(self, spc, name):
+        """
+        Returns the axes of this array holding the kets of ``spc``, in the
+        order in which they make up the combined index of ``spc``.
+        """
+
+        kets = spc.ket_space()
+        if len(kets.ket_set) == 0 or (spc != kets and spc != kets.O):
+            raise HilbertError(name+' needs a ket space, not '+repr(spc))
+        if not kets.ket_set <= self.space.ket_set:
+            raise MismatchedSpaceError(name+' acts outside of the array: '+
+                repr(kets)+' vs. '+repr(self.space))
+        return [ self.axes.index(h) for h in kets.sorted_kets ]
+
+    def _transform_combined(self, axes, fn):
+        """
+        Moves ``axes`` to the end, flattens them into one index, applies
+        ``fn`` to the resulting two dimensional array and returns the result
+        in the layout of this array.
+        """
+
+        nd = self.nparray
+        perm = [ i for i in range(nd.ndim) if i not in axes ] + axes
+        moved = nd.transpose(perm)
+        N = _shape_product(tuple([ nd.shape[i] for i in axes ]))
+        out = fn(moved.reshape(-1, N)).reshape(moved.shape)
+        out = np.ascontiguousarray(out.transpose(np.argsort(perm)), dtype=nd.dtype)
+        return self.space.array_from_buffer(out)
+
+    def apply_fourier(self, spc, inverse=False):
+        """
+        Applies the Fourier transform on the kets ``spc``, giving the same
+        result as ``spc.fourier() * self`` (or ``spc.fourier().H * self`` if
+        ``inverse`` is true) but using an FFT, in ``O(N log N)`` time and
+        without forming the ``N x N`` matrix.
+
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> hc = qudit('c', 5)
+        >>> psi = (ha*hb*hc).random_array()
+        >>> psi.apply_fourier(ha*hc).closeto((ha*hc).fourier() * psi)
+        True
+        >>> psi.apply_fourier(hb, inverse=True).closeto(hb.fourier().H * psi)
+        True
+        >>> rho = (ha*hb).O.random_array()
+        >>> rho.apply_fourier(hb).closeto(hb.fourier() * rho)
+        True
+        """
+
+        axes = self._transform_axes(spc, 'apply_fourier')
+        if self.nparray.dtype == object:
+            U = spc.ket_space().fourier()
+            return (U.H if inverse else U) * self
+        fft = np.fft.ifft if inverse else np.fft.fft
+        return self._transform_combined(axes, lambda x: fft(x, axis=1, norm='ortho'))
+
+    def apply_hadamard(self, spc):
+        """
+        Applies the Hadamard transform on the kets ``spc``, giving the same
+        result as ``spc.hadamard() * self`` but using a fast Walsh-Hadamard
+        transform, in ``O(N log N)`` time.  Only applies if the dimension of
+        ``spc`` is a power of 2.
+
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 8)
+        >>> hc = qudit('c', 3)
+        >>> psi = (ha*hb*hc).random_array()
+        >>> psi.apply_hadamard(ha*hb).closeto((ha*hb).hadamard() * psi)
+        True
+        >>> psi.apply_hadamard(hc)
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'Hadamard matrix only defined if dimension is a power of 2'
+        """
+
+        axes = self._transform_axes(spc, 'apply_hadamard')
+        kets = spc.ket_space()
+        N = kets.dim()
+        if N & (N-1):
+            raise HilbertError("Hadamard matrix only defined if dimension is a power of 2")
+        if self.nparray.dtype == object:
+            return kets.hadamard() * self
+
+        # The Hadamard matrix is the tensor product of the 2x2 Hadamard
+        # matrices of the bits of the index, so it acts on each axis
+        # separately.
+        ret = self.space.array_from_buffer(np.array(self.nparray, order='C'))
+        for axis in axes:
+            _fwht_axis(ret.nparray, axis)
+        ret.nparray /= np.sqrt(N)
+        return ret
+
+    def apply_haar(self, spc):
+        """
+        Applies the Haar wavelet transform on the kets ``spc``, giving the
+        same result as ``spc.haar_matrix() * self`` but using the ``O(N)``
+        pyramid algorithm.  Only applies if the dimension of ``spc`` is a
+        power of 2.
+
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 4)
+        >>> hc = qudit('c', 3)
+        >>> psi = (ha*hb*hc).random_array()
+        >>> psi.apply_haar(ha*hb).closeto((ha*hb).haar_matrix() * psi)
+        True
+        >>> psi.apply_haar(hb).closeto(hb.haar_matrix() * psi)
+        True
+        >>> psi.apply_haar(hc)
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'Haar matrix only defined if dimension is a power of 2'
+        """
+
+        axes = self._transform_axes(spc, 'apply_haar')
+        kets = spc.ket_space()
+        N = kets.dim()
+        if N & (N-1):
+            raise HilbertError("Haar matrix only defined if dimension is a power of 2")
+        if self.nparray.dtype == object:
+            return kets.haar_matrix() * self
+        return self._transform_combined(axes, _haar_rows)
+
     def _mydiv(self, other):
         """
         Divide by a scalar.
@@ -1033,6 +1894,7 @@ cdef class HilbertArray:
         except TypeError:
             return NotImplemented
 
+        _copy_on_write(self)
         self.nparray /= x
         return self
 
@@ -1051,6 +1913,7 @@ cdef class HilbertArray:
             lambda x: self.space.base_field.mat_pow(x, other))
 
     def __ipow__(self, other):
+        _copy_on_write(self)
         self.nparray[:] = self.__pow__(other).nparray
         return self
 
@@ -1143,17 +2006,19 @@ cdef class HilbertArray:
         """
 
         index_map = self._index_key_to_map(key)
+        if do_set:
+            _copy_on_write(self)
+
+        cdef HilbertAtom x
+        for v in index_map.values():
+            if isinstance(v, (list, np.ndarray)):
+                return self._get_set_fancy(index_map, do_set, set_val)
 
         out_axes = []
         slice_list = []
         for x in self.axes:
             if x in index_map:
-                try:
-                    idx_n = x.indices.index(index_map[x])
-                except ValueError:
-                    raise HilbertIndexError('Index set for '+repr(x)+' does '+
-                        'not contain '+repr(index_map[x]))
-                slice_list.append(idx_n)
+                slice_list.append(x.index_position(index_map[x]))
             else:
                 slice_list.append(slice(None))
                 out_axes.append(x)
@@ -1182,6 +2047,44 @@ cdef class HilbertArray:
 
             return ret
 
+    def _get_set_fancy(self, index_map, do_set, set_val):
+        """
+        Handles indexing with lists or arrays of indices.  The indexed axes
+        are moved to the front and the index arrays are broadcast together, so
+        the result is a numpy array whose shape is the broadcast shape
+        followed by the shape of the remaining axes.  A ``HilbertArray``
+        being assigned must be on the space of the remaining axes, and is
+        broadcast over the indexed entries.
+        """
+
+        cdef HilbertAtom x
+        front = []
+        rest = []
+        idx = []
+        for (i, x) in enumerate(self.axes):
+            if x in index_map:
+                v = index_map[x]
+                front.append(i)
+                if isinstance(v, (list, np.ndarray)):
+                    idx.append(x.index_positions(v))
+                else:
+                    idx.append(x.index_position(v))
+            else:
+                rest.append(i)
+
+        view = self.nparray.transpose(front + rest)
+        if do_set:
+            if isinstance(set_val, HilbertArray):
+                rest_axes = [ self.axes[i] for i in rest ]
+                if set_val.axes != rest_axes:
+                    raise MismatchedSpaceError('Mismatched HilbertSpaces: '+
+                        self._space_string(frozenset(rest_axes))+' vs. '+
+                        repr(set_val.space))
+                set_val = set_val.nparray
+            view[tuple(idx)] = set_val
+        else:
+            return view[tuple(idx)]
+
     def __getitem__(self, key):
         """
         Gets an item or slice.
@@ -1358,7 +2261,7 @@ cdef class HilbertArray:
         v = self.nparray.transpose(axes).reshape(col_size, row_size)
         return np.matrix(v, dtype=dtype)
 
-    cpdef np_matrix_transform(self, f, transpose_dims=False, row_space=None, col_space=None):
+    cpdef np_matrix_transform(self, f, transpose_dims=False, row_space=None, col_space=None, HilbertArray out=None):
         """
         Performs a numpy matrix operation.
 
@@ -1373,6 +2276,9 @@ cdef class HilbertArray:
         :param col_space: the HilbertSpace to use for the column space of the matrix,
             default is the ket space of the input array.
         :type col_space: HilbertSpace, list, or tuple
+        :param out: if given, the result is copied into this array (which
+            must be on the result space) and it is returned
+        :type out: HilbertArray or None; default None
 
         >>> from qitensor import qubit, qudit
         >>> import numpy.linalg
@@ -1397,6 +2303,11 @@ cdef class HilbertArray:
         >>> wi = w.np_matrix_transform(numpy.linalg.inv, transpose_dims=True, row_space=hc)
         >>> wi == w.inv(hc)
         True
+        >>> z = (hb * ha.H).array()
+        >>> x.np_matrix_transform(numpy.linalg.inv, transpose_dims=True, out=z) is z
+        True
+        >>> z == x.I
+        True
         """
 
         #m = self.as_np_matrix()
@@ -1421,8 +2332,41 @@ cdef class HilbertArray:
             out_hilb = self.space
             out_axes = col_space+row_space
 
+        if out is not None:
+            out_nd = _check_out(out, out_hilb)
+            perm = [out_hilb.axes.index(x) for x in out_axes]
+            np.copyto(out_nd.transpose(perm),
+                np.asarray(m).reshape([x.dim() for x in out_axes]))
+            return out
+
         return out_hilb.array(m, reshape=True, input_axes=out_axes)
 
+    cpdef adjoint(self, HilbertArray out=None):
+        """
+        Returns the adjoint (Hermitian conjugate) of this array, the same as
+        ``self.H``.  If ``out`` is given, the result is written into it and
+        it is returned.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha * hb.H).random_array()
+        >>> z = (hb * ha.H).array()
+        >>> x.adjoint(out=z) is z
+        True
+        >>> z == x.H
+        True
+        >>> x.adjoint() == x.H
+        True
+        """
+
+        if out is None:
+            return self.H
+
+        self.transpose(out=out)
+        _conj_into(self.space.base_field, out.nparray, out.nparray)
+        return out
+
     @property
     def H(self):
         """
@@ -1562,6 +2506,7 @@ cdef class HilbertArray:
         array([ 2.+0.j,  2.+0.j]))
         """
 
+        _copy_on_write(self)
         # fill should be the same for all base_field's
         self.nparray.fill(val)
 
@@ -1766,9 +2711,10 @@ cdef class HilbertArray:
             lambda x: self.space.base_field.mat_pinv(x, rcond), \
             transpose_dims=True)
 
-    cpdef conj(self):
+    cpdef conj(self, HilbertArray out=None):
         """
-        Returns the complex conjugate of this array.
+        Returns the complex conjugate of this array.  If ``out`` is given,
+        the result is written into it and it is returned.
 
         >>> from qitensor import qubit
         >>> ha = qubit('a')
@@ -1786,8 +2732,17 @@ cdef class HilbertArray:
         HilbertArray(|a><a|,
         array([[ 1.-2.j,  3.-4.j],
                [ 5.-6.j,  7.-8.j]]))
+        >>> z = ha.O.array()
+        >>> y.conj(out=z) is z
+        True
+        >>> z == y.conj()
+        True
         """
 
+        if out is not None:
+            _conj_into(self.space.base_field, self.nparray, _check_out(out, self.space))
+            return out
+
         cdef object xxx = self.space.base_field # FIXME - need to forget type to avoid Cython error
         return self.np_matrix_transform( \
             xxx.mat_conj)
@@ -1809,11 +2764,12 @@ cdef class HilbertArray:
         """
         Returns the (full or partial) trace of this array.
 
-        FIXME - update docs with advanced trace features
-
         :param axes: axes to trace over, all axes if None (in which case the bra
             space must be the same as the ket space)
-        :type axes: HilbertSpace; default None
+        :type axes: HilbertSpace, list of HilbertAtoms, or dict; default None
+
+        If ``axes`` is a dict, each key is traced against its value, which
+        allows tracing a ket space against another ket space.
 
         >>> from qitensor import qubit, qudit
         >>> ha = qubit('a')
@@ -1866,6 +2822,17 @@ cdef class HilbertArray:
         |c>
         >>> v.trace({ hb: hb.prime, hc.H: ha }).closeto(z)
         True
+
+        >>> # all traced pairs are summed in a single pass
+        >>> hd = qubit('d')
+        >>> r = (ha*hb*hc*hd).random_density()
+        >>> r.trace(hb*hd).space
+        |a,c><a,c|
+        >>> r.trace(hb*hd).closeto(r.trace(hb).trace(hd))
+        True
+        >>> u = n.H.relabel({ hb.H: hb.prime }) * n
+        >>> abs( u.trace({ hb: hb.prime }) - 1 ) < 1e-14
+        True
         """
 
         if axes is None:
@@ -1875,31 +2842,19 @@ cdef class HilbertArray:
             # The full trace is handled specially here, for efficiency.
             return np.trace( self.as_np_matrix() )
 
-        if isinstance(axes, HilbertSpace):
-            axes = axes.bra_ket_set
-            # and then process further in the next if block
-
-        if not isinstance(axes, dict):
-            axes_set = set()
-            for s in HilbertSpace._expand_list_to_atoms(list(axes)):
-                if not s in self.space.bra_ket_set:
-                    raise HilbertError('not in ket set: '+repr(s))
-                axes_set.add(s.H if s.is_dual else s)
-            axes = dict((s, s.H) for s in axes_set)
-
-        assert isinstance(axes, dict)
+        (axes, in_labels, out_labels, out_space) = _get_trace_plan(self.space, axes)
 
-        HilbertSpace._assert_nodup_space(list(axes.keys())+list(axes.values()), "a space was listed twice")
-
-        for (k, v) in axes.items():
-            if not k in self.space.bra_ket_set:
-                raise HilbertError("not in this array's space: "+repr(k))
-            if not v in self.space.bra_ket_set:
-                raise HilbertError("not in this array's space: "+repr(v))
+        if len(in_labels) <= EINSUM_MAX_LABELS and self.nparray.dtype != object:
+            # All traced pairs are summed in a single pass, and the result
+            # comes out contiguous and in the axis order of out_space.
+            arr = np.einsum(self.nparray, in_labels, out_labels)
+            if out_space is None:
+                return arr[()]
+            else:
+                return out_space.array_from_buffer(arr)
 
-        # The full trace is handled specially here, for efficiency.
-        if frozenset(list(axes.keys())+list(axes.values())) == self.space.bra_ket_set:
-            return np.trace( self.as_np_matrix() )
+        # Fallback for arrays with too many axes for einsum, or which hold
+        # python objects (not supported by einsum).
 
         working = self
 
@@ -1916,7 +2871,7 @@ cdef class HilbertArray:
                 working = arr
             else:
                 out_space = create_space1(out_space)
-                working = out_space.array(arr)
+                working = out_space.array_from_buffer(arr)
 
         return working
 
@@ -2472,11 +3427,14 @@ cdef class HilbertArray:
         if not self.closeto(self.H):
             raise HilbertError('matrix was not Hermitian')
 
+        from qitensor.diagonal import DiagonalHilbertArray
+
         (W, V) = self.eig(hermit=True)
         W = np.diag(W.as_np_matrix())
         if not np.all(W >= -1e-12):
             raise HilbertError('matrix was not positive')
-        W = self.space.diag(np.sqrt(np.where(W >= 0, W, 0)))
+        # V * W only needs to scale the columns of V
+        W = DiagonalHilbertArray(self.space, np.sqrt(np.where(W >= 0, W, 0)))
         return V * W * V.H
 
     cpdef entropy(self, normalize=False, checks=True):
@@ -2489,8 +3447,10 @@ cdef class HilbertArray:
         :type normalize: bool; default False
         :param checks: if False, don't check that the input is a valid density
             matrix or Hermitian.  This is sometimes needed for symbolic
-            computations.
-        :type checks: bool; default True
+            computations.  If "fast", skip the Hermiticity check (which costs
+            as much as forming the adjoint) but still check the trace and
+            positivity using the eigenvalues.
+        :type checks: bool or "fast"; default True
 
         >>> import numpy as np
         >>> from qitensor import qubit, qudit
@@ -2519,45 +3479,87 @@ cdef class HilbertArray:
         >>> s = (ha*hb).random_array().normalized().O
         >>> abs(s.trace(ha).entropy() - s.trace(hb).entropy()) < 1e-10
         True
+        >>> abs(s.trace(ha).entropy(checks='fast') - s.trace(hb).entropy()) < 1e-10
+        True
+        >>> (ha.eye()*2).entropy(checks='fast')
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'density matrix was not normalized: trace=4.0'
         """
 
-        self.assert_density_matrix(
-            check_hermitian=checks,
-            check_normalized=(checks and not normalize),
-            # we do our own positivity check
-            check_positive=False,
-        )
+        p = _density_spectrum(self, normalize, checks)
+        return self.space.base_field.spectrum_entropy(p)
 
-        schmidt = self.eigvals(hermit=True)
+    def renyi_entropy(self, alpha, normalize=False, checks=True):
+        """
+        Returns the Renyi entropy of order ``alpha`` of a density operator, in
+        bits.
 
-        if normalize:
-            schmidt /= abs(self.trace())
+        The cases ``alpha=0`` (log of the rank), ``alpha=1`` (von Neumann
+        entropy), and ``alpha=numpy.inf`` (min-entropy) are handled as the
+        corresponding limits.
 
-        if checks:
-            # should have been taken care of by normalization above
-            assert abs(sum(schmidt)-1) < 1e-9
+        :param alpha: the order of the entropy
+        :type alpha: non-negative number
+        :param normalize: see :func:`entropy`
+        :param checks: see :func:`entropy`
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> rho = hb.diag([0.5, 0.25, 0.25])
+        >>> rho.renyi_entropy(0) == np.log2(3)
+        True
+        >>> rho.renyi_entropy(1) == rho.entropy()
+        True
+        >>> rho.renyi_entropy(2) == -np.log2(rho.purity())
+        True
+        >>> rho.renyi_entropy(np.inf)
+        1.0
+        >>> rho.renyi_entropy(1.0000001) - rho.entropy() < 1e-6
+        True
+        >>> abs((ha.eye()/2).renyi_entropy(3) - 1) < 1e-14
+        True
+        """
 
-            if not np.all(schmidt >= -1e-9):
-                raise HilbertError('density matrix was not positive: '+str(schmidt))
+        if alpha < 0:
+            raise HilbertError('alpha must be non-negative: '+repr(alpha))
+        if alpha == 1:
+            return self.entropy(normalize=normalize, checks=checks)
 
-        return sum([-self.space.base_field.xlog2x(x) for x in schmidt])
+        bf = self.space.base_field
+        p = _density_spectrum(self, normalize, checks)
+        if p.dtype != object:
+            p = p[p > 1e-12] if alpha == 0 else p[p > 0]
+
+        if alpha == 0:
+            return bf.log2(len(p))
+        elif alpha == np.inf:
+            return -bf.log2(np.max(p))
+        else:
+            return bf.log2(np.sum(p ** alpha)) / (1 - alpha)
 
     cpdef purity(self, normalize=False, checks=True):
         """
         Returns the purity of a density operator, ``(self*self).trace()``.
 
+        This is computed in time linear in the size of the array, without
+        forming the product.
+
         :param normalize: if True, the input is automatically normalized to
             trace one.  If false, an exception is raised if the trace is not
             one.
         :type normalize: bool; default False
         :param checks: if False, don't check that the input is a valid density
             matrix or Hermitian.  This is sometimes needed for symbolic
-            computations.
-        :type checks: bool; default True
+            computations.  If "fast", only the trace is checked.
+        :type checks: bool or "fast"; default True
 
         >>> import numpy as np
         >>> from qitensor import qubit, qudit
         >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
         >>> # purity of a pure state is one
         >>> ha.ket(0).O.purity()
         1.0
@@ -2567,47 +3569,131 @@ cdef class HilbertArray:
         >>> # automatic normalization
         >>> ha.eye().purity(normalize=True)
         0.5
+        >>> rho = (ha*hb).random_density()
+        >>> abs(rho.purity() - (rho*rho).trace()) < 1e-14
+        True
         """
 
+        if not checks in (True, False, 'fast'):
+            raise HilbertError('checks must be True, False, or "fast": '+repr(checks))
+
         self.assert_density_matrix(
-            check_hermitian=checks,
+            check_hermitian=(checks is True),
             check_normalized=(checks and not normalize),
             # positivity doesn't really matter
             check_positive=False,
         )
 
-        purity = (self*self).trace()
+        m = np.asarray(self.as_np_matrix())
+        # tr(m*m) = sum_ij m_ij m_ji
+        purity = np.sum(m * m.T)
 
         if normalize:
-            purity /= self.trace() ** 2
+            purity /= np.trace(m) ** 2
 
         assert abs(purity.imag) < 1e-12
         return purity.real
 
-    def mutual_info(self, ha, hb):
+    def _entropies_of_marginals(self, spaces, checks):
         """
-        FIXME - docs
+        Returns the entropies of the reduced states of this density operator
+        on each of the given spaces.  The density operator is validated only
+        once since reduced states of a density operator are density
+        operators.
         """
 
-        self.assert_density_matrix()
+        spaces = [spc.ket_space() if spc == spc.H else spc for spc in spaces]
+        for spc in spaces:
+            spc.assert_ket_space()
+        is_full = [spc.ket_set == self.space.ket_set for spc in spaces]
 
-        if ha == ha.H:
-            ha = ha.ket_space()
-        if hb == hb.H:
-            hb = hb.ket_space()
+        if checks and not any(is_full):
+            _density_spectrum(self, False, checks)
 
-        ha.assert_ket_space()
-        hb.assert_ket_space()
+        return [
+            self.entropy(checks=checks) if full else
+            self.tracekeep(spc).entropy(checks=False)
+            for (spc, full) in zip(spaces, is_full)
+        ]
 
-        if ha.ket_set & hb.ket_set:
-            raise MismatchedSpaceError('spaces are not disjoint: '+str(ha)+' vs. '+str(hb))
+    def mutual_info(self, ha, hb, checks=True):
+        """
+        Returns the mutual information ``S(A) + S(B) - S(AB)`` between the
+        given subsystems of a density operator, in bits.
 
-        Sa = self.tracekeep(ha).entropy()
-        Sb = self.tracekeep(hb).entropy()
-        Sab = self.tracekeep(ha*hb).entropy()
+        The density operator is validated once (according to ``checks``, see
+        :func:`entropy`), after which each reduced state costs one
+        eigensolve.
 
+        >>> import numpy as np
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> # a maximally entangled state has two bits of mutual information
+        >>> psi = (ha*hb).array([[1, 0], [0, 1]]) / np.sqrt(2)
+        >>> abs(psi.O.mutual_info(ha, hb) - 2) < 1e-12
+        True
+        >>> # product states have none
+        >>> rho = ha.random_density() * hb.random_density()
+        >>> abs(rho.mutual_info(ha, hb)) < 1e-12
+        True
+        >>> rho.mutual_info(ha, ha*hb)
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'spaces are not disjoint: |a> vs. |a,b>'
+        """
+
+        _assert_disjoint_spaces(ha, hb)
+        (Sa, Sb, Sab) = self._entropies_of_marginals([ha, hb, ha*hb], checks)
         return Sa + Sb - Sab
 
+    def conditional_entropy(self, ha, hb, checks=True):
+        """
+        Returns the conditional entropy ``S(A|B) = S(AB) - S(B)`` of a density
+        operator, in bits.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> psi = (ha*hb).array([[1, 0], [0, 1]]) / np.sqrt(2)
+        >>> abs(psi.O.conditional_entropy(ha, hb) + 1) < 1e-12
+        True
+        >>> rho = (ha*hb).random_density()
+        >>> abs(rho.conditional_entropy(ha, hb) -
+        ...     (rho.entropy() - rho.trace(ha).entropy())) < 1e-12
+        True
+        """
+
+        _assert_disjoint_spaces(ha, hb)
+        (Sab, Sb) = self._entropies_of_marginals([ha*hb, hb], checks)
+        return Sab - Sb
+
+    def conditional_mutual_info(self, ha, hb, hc, checks=True):
+        """
+        Returns the conditional mutual information
+        ``I(A;B|C) = S(AC) + S(BC) - S(ABC) - S(C)`` of a density operator, in
+        bits.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> rho = (ha*hb*hc).random_density()
+        >>> # strong subadditivity
+        >>> rho.conditional_mutual_info(ha, hb, hc) > -1e-12
+        True
+        >>> rho = (ha*hb).random_density() * hc.random_density()
+        >>> abs(rho.conditional_mutual_info(ha, hb, hc) - rho.mutual_info(ha, hb)) < 1e-12
+        True
+        """
+
+        _assert_disjoint_spaces(ha, hb, hc)
+        (Sac, Sbc, Sabc, Sc) = self._entropies_of_marginals(
+            [ha*hc, hb*hc, ha*hb*hc, hc], checks)
+        return Sac + Sbc - Sabc - Sc
+
     def relative_entropy(self, other, toler=1e-12):
         """
         FIXME - docs
@@ -2657,7 +3743,7 @@ cdef class HilbertArray:
             -bf.infty() if y<=toler else \
             x*bf.log2(y) for (x, y) in zip(arr1, arr2) \
         ])
-        ret = -q-self.entropy()
+        ret = -q-self.entropy(checks=False)
 
         assert abs(ret.imag) < toler
         ret = ret.real
@@ -2748,53 +3834,169 @@ cdef class HilbertArray:
         the second element being the density operator corresponding to the
         state of the remaining subsystems (or the value 1 if there are none).
 
+        To draw many outcomes, use :func:`sample`, which computes the
+        probabilities only once.
+
         FIXME - this function is under development and the usage will change.
         For example, for a ket input, the "remaining subsystems" state
         should be returned as a ket rather than a density operator.
 
-        FIXME - doctests
-        #>>> from qitensor import qudit
-        #>>> ha=qudit('a', 3); hb=qudit('b', 4); x = (ha*hb).random_array()
-        #>>> x.measure()
+        >>> from qitensor import qubit, indexed_space
+        >>> ha = qubit('a')
+        >>> hb = indexed_space('b', ['x', 'y'])
+        >>> psi = ha.ket(1) * hb.ket('y')
+        >>> (idx, rho) = psi.measure(hb)
+        >>> idx
+        'y'
+        >>> rho == ha.ket(1).O
+        True
+        >>> psi == ha.ket(1) * hb.ket('y')
+        True
         """
 
         if len(self.space.ket_set) == 0:
             raise HilbertError("measure doesn't apply to a bra space")
         if len(self.space.bra_set) == 0:
-            return self.O.measure(spc)
-        if self.space != self.space.H:
-            raise HilbertError("measure only applies to kets or density operators")
+            return self.O.measure(spc, normalize)
+
+        (spc, prob) = self._outcome_probs(spc, normalize)
+
+        flatidx = np.argmax(np.cumsum(prob.flatten()) > np.random.rand())
+        idx = self._outcome_index(spc, flatidx)
+        remaining = self._post_measurement(spc, idx)
+
+        if len(idx) == 1:
+            idx = idx[0]
+
+        return (idx, remaining)
+
+    def sample(self, spc=None, shots=1, rng=None, normalize=False, states=False):
+        """
+        Samples the outcomes of measuring a quantum state (ket or density
+        operator) in the computational basis of ``spc`` (by default all of the
+        kets) ``shots`` times.  The probability distribution is computed
+        once, and all of the outcomes are drawn at once using a binary search
+        of its cumulative sum.
+
+        Returns a dictionary mapping each observed outcome, as a tuple of
+        indices like those of :func:`HilbertSpace.index_iter`, to the number
+        of times it was seen.  If ``states`` is true then a second dictionary
+        is also returned, mapping each observed outcome to the normalized
+        state of the remaining subsystems after that outcome (a ket for a ket
+        input, a density operator for a density operator input, or 1 if there
+        are no remaining subsystems).
+
+        :param spc: the space to measure
+        :param shots: the number of outcomes to draw
+        :param rng: a numpy random Generator, or a seed for one
+        :param normalize: if true, the state is normalized first rather than
+            raising an error if it is not normalized
+        :param states: if true, also return the post-measurement states
+
+        >>> from qitensor import qubit, cnot
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> psi = cnot(ha, hb) * (ha.x_plus() * hb.ket(0) * hc.x_plus())
+        >>> counts = psi.sample(ha*hb, shots=1000, rng=0)
+        >>> sorted(counts.keys())
+        [(0, 0), (1, 1)]
+        >>> sum(counts.values())
+        1000
+        >>> 400 < counts[(0, 0)] < 600
+        True
+        >>> (counts, states) = psi.sample(ha, shots=10, rng=0, states=True)
+        >>> states[(1,)].closeto(hb.ket(1) * hc.x_plus())
+        True
+        >>> (counts, states) = psi.O.sample(ha, shots=10, rng=0, states=True)
+        >>> states[(0,)].closeto((hb.ket(0) * hc.x_plus()).O)
+        True
+        """
+
+        if len(self.space.ket_set) == 0:
+            raise HilbertError("sample doesn't apply to a bra space")
+
+        (spc, prob) = self._outcome_probs(spc, normalize)
+
+        rng = np.random.default_rng(rng)
+        cdf = np.cumsum(prob.ravel())
+        flat = np.searchsorted(cdf, rng.random(shots) * cdf[-1], side='right')
+        flat = np.minimum(flat, cdf.size-1)
+        hist = np.bincount(flat, minlength=cdf.size)
+
+        counts = {}
+        post = {}
+        for flatidx in np.nonzero(hist)[0]:
+            idx = self._outcome_index(spc, flatidx)
+            counts[idx] = int(hist[flatidx])
+            if states:
+                post[idx] = self._post_measurement(spc, idx)
+
+        if states:
+            return (counts, post)
+        else:
+            return counts
+
+    def _outcome_probs(self, spc, normalize):
+        """
+        Returns the measured space (by default all of the kets) and the
+        probabilities of the outcomes of measuring it, as a real numpy array
+        with the shape of that space.  Used by :func:`measure` and
+        :func:`sample`.
+        """
 
         if spc is None:
             spc = self.space.ket_space()
+        if spc != spc.ket_space():
+            raise HilbertError('can only measure a ket space, not '+repr(spc))
+        if not spc.ket_set <= self.space.ket_set:
+            raise MismatchedSpaceError('space not part of the state: '+repr(spc))
 
-        if spc.O == self.space:
-            reduced = self
+        if len(self.space.bra_set) == 0:
+            keep = [ self.axes.index(h) for h in spc.sorted_kets ]
+            others = tuple([ i for i in range(len(self.axes)) if i not in keep ])
+            prob = np.sum(np.abs(self.nparray)**2, axis=others)
         else:
-            reduced = self.trace(self.space / spc.O)
+            if self.space != self.space.H:
+                raise HilbertError("measure only applies to kets or density operators")
+            if spc.O == self.space:
+                reduced = self
+            else:
+                reduced = self.trace(self.space / spc.O)
+            prob = np.real(reduced.diag().nparray)
 
-        prob = reduced.diag().nparray
         sum_prob = np.sum(prob)
         if sum_prob == 0:
             raise HilbertError("state was equal to zero")
         if not normalize:
             if abs(sum_prob - 1) > 1e-12:
                 raise HilbertError("state was not normalized")
-        prob /= sum_prob
+        return (spc, prob / sum_prob)
 
-        flatidx = np.argmax(np.cumsum(prob.flatten()) > np.random.rand())
-        idx = np.unravel_index(flatidx, prob.shape)
+    def _outcome_index(self, spc, flatidx):
+        """
+        Converts a flat outcome position into a tuple of indices of ``spc``.
+        """
 
-        if spc.O == self.space:
-            remaining = 1
-        else:
-            remaining = self[dict(zip(spc.sorted_kets, idx) + zip(spc.H.sorted_bras, idx))]
-            remaining /= remaining.trace()
+        pos = np.unravel_index(flatidx, spc.shape)
+        return tuple([ h.indices[i] for (h, i) in zip(spc.sorted_kets, pos) ])
 
-        if len(idx) == 1:
-            idx = idx[0]
+    def _post_measurement(self, spc, idx):
+        """
+        Returns the normalized state of the remaining subsystems after
+        measuring outcome ``idx`` of ``spc``, or 1 if there are none.
+        """
 
-        return (idx, remaining)
+        if spc.ket_set == self.space.ket_set:
+            return 1
+        index_map = dict(zip(spc.sorted_kets, idx))
+        if len(self.space.bra_set) == 0:
+            remaining = self[index_map]
+            return remaining / remaining.norm()
+        else:
+            index_map.update(zip(spc.H.sorted_bras, idx))
+            remaining = self[index_map]
+            return remaining / remaining.trace()
 
     cpdef span(self, axes='all'):
         """
@@ -13,9 +13,12 @@ cdef class HilbertAtom(HilbertSpace):
     cdef readonly cpython.bool is_dual
     cdef readonly tuple key
     cdef readonly long _hashval
+    cdef readonly dict _index_pos
+    cdef readonly cpython.bool _range_indices
 
     cpdef _mycmp(self, other)
     cpdef _assert_compatible(self, HilbertAtom other)
+    cpdef long index_position(self, idx) except -1
     cpdef ket(self, idx)
     cpdef bra(self, idx)
     cpdef x_plus(self)
@@ -25,9 +28,9 @@ cdef class HilbertAtom(HilbertSpace):
     cpdef z_plus(self)
     cpdef z_minus(self)
     cpdef bloch(self, theta, phi)
-    cpdef pauliX(self, h=*, left=*)
+    cpdef pauliX(self, h=*, left=*, sparse=*)
     cpdef pauliY(self)
-    cpdef pauliZ(self, int order=*)
+    cpdef pauliZ(self, int order=*, sparse=*)
     cpdef gateS(self)
     cpdef gateT(self)
     cpdef _create_addend_isoms(self)
@@ -10,7 +10,7 @@ functions in :mod:`qitensor.factory`.
 import numpy as np
 
 import qitensor
-from qitensor.exceptions import MismatchedSpaceError,HilbertError
+from qitensor.exceptions import MismatchedSpaceError,HilbertError,HilbertIndexError
 from qitensor.space import HilbertSpace
 from qitensor.space cimport HilbertSpace
 
@@ -120,6 +120,11 @@ cdef class HilbertAtom(HilbertSpace):
         #: A tuple of the tokens used as indices for this space.  By default this consists of
         #: the integers ``0..dim-1``.
         self.indices = indices
+        # map from index to position, for index_position
+        self._index_pos = {}
+        for (i, idx) in enumerate(indices):
+            self._index_pos.setdefault(idx, i)
+        self._range_indices = indices == tuple(range(len(indices)))
         #: The group operation associated with the indices.  This is relevant to the
         #: ``self.pauliX`` operator.  Typically this is modular addition.
         self.group_op = group_op
@@ -166,6 +171,65 @@ cdef class HilbertAtom(HilbertSpace):
         #return cmp(self.key, other.key)
         return (self.key > other.key) - (self.key < other.key)
 
+    cpdef long index_position(self, idx) except -1:
+        """
+        Returns the position of ``idx`` in ``self.indices``, in constant time.
+
+        >>> from qitensor import qubit, indexed_space
+        >>> qubit('a').index_position(1)
+        1
+        >>> hd = indexed_space('d', ['up', 'down'])
+        >>> hd.index_position('down')
+        1
+        >>> hd.index_position('left')
+        Traceback (most recent call last):
+            ...
+        HilbertIndexError: "Index set for |d> does not contain 'left'"
+        """
+
+        if self._range_indices and isinstance(idx, int) and 0 <= idx < len(self.indices):
+            return idx
+        try:
+            return self._index_pos[idx]
+        except (KeyError, TypeError):
+            raise HilbertIndexError('Index set for '+repr(self)+' does '+
+                'not contain '+repr(idx))
+
+    def index_positions(self, idx):
+        """
+        Returns the positions of a list or array of indices, as an integer
+        array of the same shape.  Integer arrays are handled without a Python
+        loop when the indices of this atom are ``0..dim-1``.
+
+        >>> import numpy as np
+        >>> from qitensor import qudit, indexed_space
+        >>> qudit('a', 3).index_positions(np.array([[2, 0], [1, 1]]))
+        array([[2, 0],
+               [1, 1]])
+        >>> qudit('a', 3).index_positions([0, 3])
+        Traceback (most recent call last):
+            ...
+        HilbertIndexError: 'Index set for |a> does not contain 3'
+        >>> indexed_space('d', ['up', 'down']).index_positions(['down', 'down', 'up'])
+        array([1, 1, 0])
+        """
+
+        cdef int d = len(self.indices)
+        if self._range_indices:
+            arr = np.asarray(idx)
+            if arr.dtype.kind in 'iu':
+                bad = (arr < 0) | (arr >= d)
+                if np.any(bad):
+                    raise HilbertIndexError('Index set for '+repr(self)+' does '+
+                        'not contain '+repr(int(arr[bad].flat[0])))
+                return arr.astype(np.intp)
+
+        if isinstance(idx, np.ndarray):
+            return np.array([ self.index_position(i) for i in idx.ravel().tolist() ],
+                dtype=np.intp).reshape(idx.shape)
+        else:
+            return np.array([ self.index_position(i) for i in idx ], dtype=np.intp)
+
     cpdef _assert_compatible(self, HilbertAtom other):
         """
         It is not allowed for HilbertAtom's with the same name but other
@@ -355,7 +419,7 @@ cdef class HilbertAtom(HilbertSpace):
         if len(self.indices) != 2:
             return self.fourier_basis_state(0)
         else:
-            return self.array([1, 1]) / self.base_field.sqrt(2)
+            return self._special_state('x_plus')
 
     cpdef x_minus(self):
         """
@@ -371,7 +435,7 @@ cdef class HilbertAtom(HilbertSpace):
 
         if len(self.indices) != 2:
             raise HilbertError('x_minus only available for qubits')
-        return self.array([1, -1]) / self.base_field.sqrt(2)
+        return self._special_state('x_minus')
 
     cpdef y_plus(self):
         """
@@ -387,8 +451,7 @@ cdef class HilbertAtom(HilbertSpace):
 
         if len(self.indices) != 2:
             raise HilbertError('y_plus only available for qubits')
-        i = self.base_field.complex_unit()
-        return self.array([1, i]) / self.base_field.sqrt(2)
+        return self._special_state('y_plus')
 
     cpdef y_minus(self):
         """
@@ -404,8 +467,7 @@ cdef class HilbertAtom(HilbertSpace):
 
         if len(self.indices) != 2:
             raise HilbertError('y_minus only available for qubits')
-        i = self.base_field.complex_unit()
-        return self.array([1, -i]) / self.base_field.sqrt(2)
+        return self._special_state('y_minus')
 
     cpdef z_plus(self):
         """
@@ -421,7 +483,7 @@ cdef class HilbertAtom(HilbertSpace):
 
         if len(self.indices) != 2:
             raise HilbertError('z_plus only available for qubits')
-        return self.array([1, 0])
+        return self._special_state('z_plus')
 
     cpdef z_minus(self):
         """
@@ -437,7 +499,24 @@ cdef class HilbertAtom(HilbertSpace):
 
         if len(self.indices) != 2:
             raise HilbertError('z_minus only available for qubits')
-        return self.array([0, 1])
+        return self._special_state('z_minus')
+
+    def _special_state(self, name):
+        return qitensor.array._cached_operator((name, self), self._build_special_state, name)
+
+    def _build_special_state(self, name):
+        i = self.base_field.complex_unit()
+        (vec, norm) = {
+            'x_plus':  ([1,  1], 2),
+            'x_minus': ([1, -1], 2),
+            'y_plus':  ([1,  i], 2),
+            'y_minus': ([1, -i], 2),
+            'z_plus':  ([1,  0], 1),
+            'z_minus': ([0,  1], 1),
+        }[name]
+        if norm == 1:
+            return self.array(vec)
+        return self.array(vec) / self.base_field.sqrt(norm)
 
     cpdef bloch(self, theta, phi):
         """
@@ -462,7 +541,7 @@ cdef class HilbertAtom(HilbertSpace):
 
     # Special operators
 
-    cpdef pauliX(self, h=None, left=True):
+    cpdef pauliX(self, h=None, left=True, sparse=False):
         """
         Returns the Pauli X operator.
 
@@ -478,6 +557,9 @@ cdef class HilbertAtom(HilbertSpace):
 
         NOTE: some people use a convention that is a transpose of this!
 
+        If ``sparse`` is True, a :class:`qitensor.sparse.SparseHilbertArray` is
+        returned.
+
         See also: :func:`X`
 
         >>> import numpy as np
@@ -508,22 +590,68 @@ cdef class HilbertAtom(HilbertSpace):
         True
         >>> np.all([hc.pauliX(f, left=False) * hc.ket(g*f) == hc.ket(g) for f in S3.elements for g in S3.elements])
         True
+        >>> hb.pauliX(2, sparse=True)
+        SparseHilbertArray(|b><b|, nnz=3)
         """
 
+        if sparse:
+            return self.pauliX(h, left).to_sparse()
+
         if h is None:
             if len(self.indices) == 2:
-                return self.O.array([[0, 1], [1, 0]])
+                return qitensor.array._cached_operator(('pauliX', self, None, True),
+                    self.O.array, [[0, 1], [1, 0]])
             if self.group_op.__class__ == qitensor.factory.GroupOpCyclic_impl:
                 h = 1
             else:
                 raise NotImplementedError("h param is required for pauliX when groups are used")
 
-        ret = self.O.array()
+        return qitensor.array._cached_operator(('pauliX', self, h, left),
+            self._build_pauliX, h, left)
+
+    def _build_pauliX(self, h, left):
+        cdef int d = len(self.indices)
+        arr = np.zeros((d, d), dtype=self.base_field.dtype)
+        arr[np.arange(d), self._group_table([h], left)[0]] = 1
+        return self.O.array(arr)
+
+    def _group_table(self, elements, left=True):
+        """
+        Returns an integer array ``T`` such that ``T[k, i]`` is the position
+        in ``self.indices`` of ``h*g`` (or ``g*h`` if ``left`` is False), where
+        ``h = elements[k]`` and ``g = self.indices[i]``.  This is the
+        permutation performed by ``pauliX(h)``.
+
+        >>> from qitensor import qudit
+        >>> qudit('a', 3)._group_table([0, 1, 2])
+        array([[0, 1, 2],
+               [1, 2, 0],
+               [2, 0, 1]])
+        """
+
+        cdef int d = len(self.indices)
         gop = self.group_op
-        for g in self.indices:
-            bra = gop.op(h, g) if left else gop.op(g, h)
-            ret[{ self: g, self.H: bra }] = 1
-        return ret
+        if gop.__class__ == qitensor.factory.GroupOpCyclic_impl and \
+                self.indices == tuple(range(d)):
+            # modular addition works elementwise on integer arrays, and the
+            # indices are their own positions
+            try:
+                hs = np.array(elements, dtype=np.intp)[:, np.newaxis]
+            except (TypeError, ValueError):
+                hs = None
+            if hs is not None:
+                gs = np.arange(d, dtype=np.intp)[np.newaxis, :]
+                ret = gop.op(hs, gs) if left else gop.op(gs, hs)
+                if np.all(ret < d):
+                    return ret
+
+        lookup = self._index_pos
+        try:
+            return np.array([ [ lookup[gop.op(h, g) if left else gop.op(g, h)]
+                for g in self.indices ] for h in elements ], dtype=np.intp)
+        except KeyError as e:
+            raise HilbertError('index set is not closed under the group operation: '+
+                repr(e.args[0]))
 
     cpdef pauliY(self):
         """
@@ -544,10 +672,13 @@ cdef class HilbertAtom(HilbertSpace):
         if len(self.indices) != 2:
             raise NotImplementedError("pauliY is only implemented for qubits")
         else:
-            j = self.base_field.complex_unit()
-            return self.O.array([[0, -j], [j, 0]])
+            return qitensor.array._cached_operator(('pauliY', self), self._build_pauliY)
 
-    cpdef pauliZ(self, int order=1):
+    def _build_pauliY(self):
+        j = self.base_field.complex_unit()
+        return self.O.array([[0, -j], [j, 0]])
+
+    cpdef pauliZ(self, int order=1, sparse=False):
         r"""
         Returns the generalized Pauli Z operator.
 
@@ -555,7 +686,9 @@ cdef class HilbertAtom(HilbertSpace):
             only useful for spaces that are larger than qubits.
         :type order: integer; default 1
 
-        The return value is :math:`\sum_k e^{2 \pi i k / d} |k><k|`.
+        The return value is :math:`\sum_k e^{2 \pi i k / d} |k><k|`.  If
+        ``sparse`` is True, a :class:`qitensor.sparse.SparseHilbertArray` is
+        returned.
 
         See also: :func:`Z`
 
@@ -583,14 +716,18 @@ cdef class HilbertAtom(HilbertSpace):
                [ 0.+0.j,  0.+0.j,  0.+0.j, -1.+0.j]]))
         """
 
+        if sparse:
+            return self.pauliZ(order).to_sparse()
+
+        return qitensor.array._cached_operator(('pauliZ', self, order),
+            self._build_pauliZ, order)
+
+    def _build_pauliZ(self, int order):
         if len(self.indices) == 2 and order == 1:
             return self.O.array([[1, 0], [0, -1]])
-        else:
-            ret = self.O.array()
-            N = len(self.indices)
-            for (i, k) in enumerate(self.indices):
-                ret[k, k] = self.base_field.fractional_phase(i*order, N)
-            return ret
+        cdef int N = len(self.indices)
+        phases = [ self.base_field.fractional_phase(i*order, N) for i in range(N) ]
+        return self.O.array(np.diag(np.array(phases, dtype=self.base_field.dtype)))
 
     @property
     def X(self):
@@ -670,8 +807,11 @@ cdef class HilbertAtom(HilbertSpace):
         if len(self.indices) != 2:
             raise NotImplementedError("gateS is only implemented for qubits")
         else:
-            j = self.base_field.complex_unit()
-            return self.O.array([[1, 0], [0, j]])
+            return qitensor.array._cached_operator(('gateS', self), self._build_gateS)
+
+    def _build_gateS(self):
+        j = self.base_field.complex_unit()
+        return self.O.array([[1, 0], [0, j]])
 
     cpdef gateT(self):
         """
@@ -691,8 +831,11 @@ cdef class HilbertAtom(HilbertSpace):
         if len(self.indices) != 2:
             raise NotImplementedError("gateT is only implemented for qubits")
         else:
-            ph = self.base_field.fractional_phase(1, 8)
-            return self.O.array([[1, 0], [0, ph]])
+            return qitensor.array._cached_operator(('gateT', self), self._build_gateT)
+
+    def _build_gateT(self):
+        ph = self.base_field.fractional_phase(1, 8)
+        return self.O.array([[1, 0], [0, ph]])
 
     @classmethod
     def direct_sum(cls, kets):
@@ -13,6 +13,7 @@ cdef class HilbertBaseField:
     cpdef np.ndarray matrix_sage_to_np(self, sage_mat)
     cpdef latex_formatter(self, data, dollar_if_tex)
     cpdef input_cast_function(self)
+    cpdef np.ndarray cast_array(self, np.ndarray arr)
     cpdef complex_unit(self)
     cpdef infty(self)
     cpdef fractional_phase(self, int a, int b)
@@ -20,6 +21,7 @@ cdef class HilbertBaseField:
     cpdef sqrt(self, x)
     cpdef log2(self, x)
     cpdef xlog2x(self, x)
+    cpdef spectrum_entropy(self, np.ndarray p)
     cpdef np.ndarray random_array(self, shape)
     cpdef np.ndarray eye(self, long size)
     cpdef np.ndarray mat_adjoint(self, np.ndarray mat)
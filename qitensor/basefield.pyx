@@ -93,6 +93,26 @@ cdef class HilbertBaseField:
     cpdef input_cast_function(self):
         return self.dtype
 
+    cpdef np.ndarray cast_array(self, np.ndarray arr):
+        """
+        Casts every element of ``arr`` to this base field, all at once.
+
+        For numeric base fields this is just a dtype conversion, and the input
+        is returned unchanged (not copied) if it already has the right dtype.
+        Symbolic base fields override this to cast elementwise.
+
+        >>> import numpy
+        >>> from qitensor import base_field_lookup
+        >>> bf = base_field_lookup(complex)
+        >>> arr = numpy.array([1, 2], dtype=complex)
+        >>> bf.cast_array(arr) is arr
+        True
+        >>> bf.cast_array(numpy.array([1, 2]))
+        array([ 1.+0.j,  2.+0.j])
+        """
+
+        return np.asarray(arr, dtype=self.dtype)
+
     cpdef complex_unit(self):
         return 1j
 
@@ -114,6 +134,21 @@ cdef class HilbertBaseField:
     cpdef xlog2x(self, x):
         return 0 if x<=0 else x*np.log2(x)
 
+    cpdef spectrum_entropy(self, np.ndarray p):
+        """
+        Returns the Shannon entropy (in bits) of the given list of
+        probabilities (e.g. the eigenvalues of a density operator).
+        Non-positive values are ignored.
+
+        >>> import numpy as np
+        >>> from qitensor import base_field_lookup
+        >>> base_field_lookup(complex).spectrum_entropy(np.array([0.5, 0.5, 0]))
+        1.0
+        """
+
+        p = p[p > 0]
+        return np.dot(p, np.log2(1/p))
+
     cpdef np.ndarray random_array(self, shape):
         """Returns random array with standard normal distribution"""
         return (
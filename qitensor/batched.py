@@ -0,0 +1,644 @@
+"""
+A BatchedHilbertArray holds a stack of arrays that all live on the same
+HilbertSpace.  The data is stored in a single numpy array whose first axis
+indexes the batch, followed by the axes of the space (in the same order as
+:attr:`HilbertArray.nparray`).  Operations are carried out for the whole batch
+at once using stacked numpy/LAPACK calls, so the space bookkeeping is paid once
+per operation rather than once per sample.  This is useful for Monte-Carlo
+style computations involving many random states or channels.
+
+>>> import numpy as np
+>>> from qitensor import qubit, BatchedHilbertArray
+>>> ha = qubit('a')
+>>> hb = qubit('b')
+>>> rhos = BatchedHilbertArray.stack([ (ha*hb).random_density() for i in range(5) ])
+>>> rhos
+BatchedHilbertArray(5, |a,b><a,b|)
+>>> ents = rhos.trace(hb).entropy()
+>>> ents.shape
+(5,)
+>>> all(abs(ents[i] - rhos[i].trace(hb).entropy()) < 1e-12 for i in range(5))
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertSpace, HilbertArray, HilbertError, \
+    HilbertShapeError, MismatchedSpaceError
+from qitensor.array import _get_td_wisdom, _trace_axes_dict
+from qitensor.space import create_space1
+
+__all__ = ['BatchedHilbertArray']
+
+toler = 1e-9
+
+class BatchedHilbertArray(object):
+    """
+    A stack of ``HilbertArray`` objects sharing one ``HilbertSpace``.
+
+    Don't call the constructor directly unless you already have an ndarray in
+    the right layout; use :func:`stack` or :func:`zeros` instead.
+    """
+
+    # make numpy defer to our reflected operators
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, space, nparray):
+        """
+        Wraps an ndarray whose first axis is the batch axis and whose
+        remaining axes are laid out as in ``space.array().nparray``.  No copy
+        is made if the dtype already matches the base field.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> x = BatchedHilbertArray(ha, np.array([[1, 0], [0, 1], [1, 1]]))
+        >>> x[2]
+        HilbertArray(|a>,
+        array([ 1.+0.j,  1.+0.j]))
+        >>> BatchedHilbertArray(ha, np.zeros((3, 4)))
+        Traceback (most recent call last):
+            ...
+        HilbertShapeError: '(4,) vs. (2,)'
+        """
+
+        if not isinstance(space, HilbertSpace):
+            raise TypeError('space must be a HilbertSpace')
+        nparray = space.base_field.cast_array(np.asarray(nparray))
+        if nparray.ndim < 1:
+            raise HilbertError('batched array needs a batch axis')
+        if nparray.shape[1:] != space.shape:
+            raise HilbertShapeError(nparray.shape[1:], space.shape)
+
+        self._space = space
+        self._nparray = nparray
+
+    @classmethod
+    def stack(cls, arrays):
+        """
+        Creates a batch from a sequence of ``HilbertArray`` objects.
+
+        The arrays must all be on the same space.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> BatchedHilbertArray.stack([ ha.ket(0), ha.ket(1) ])
+        BatchedHilbertArray(2, |a>)
+        >>> BatchedHilbertArray.stack([ ha.ket(0), hb.ket(1) ])
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'Arrays not all on the same space: |a> vs. |b>'
+        """
+
+        arrays = list(arrays)
+        if not arrays:
+            raise HilbertError('need at least one array')
+        space = arrays[0].space
+        for x in arrays:
+            if x.space != space:
+                raise MismatchedSpaceError('Arrays not all on the same space: '+
+                    repr(space)+' vs. '+repr(x.space))
+        return cls(space, np.array([ x.nparray for x in arrays ]))
+
+    @classmethod
+    def zeros(cls, space, n):
+        """
+        Returns a batch of ``n`` zero arrays on the given space.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> BatchedHilbertArray.zeros(ha.O, 10)
+        BatchedHilbertArray(10, |a><a|)
+        """
+
+        return cls(space, np.zeros((n,)+space.shape, dtype=space.base_field.dtype))
+
+    @classmethod
+    def diag(cls, space, v):
+        """
+        Returns a batch of diagonal operators, one for each row of ``v``.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> d = BatchedHilbertArray.diag(ha.O, [[1, 2], [3, 4]])
+        >>> d[1] == ha.diag([3, 4])
+        True
+        """
+
+        D = space.assert_square()
+        v = np.asarray(v)
+        if v.ndim != 2 or v.shape[1] != D:
+            raise HilbertShapeError(v.shape[1:], (D,))
+        ret = cls.zeros(space, v.shape[0])
+        mat = ret._nparray.reshape(v.shape[0], D, D)
+        mat[:, np.arange(D), np.arange(D)] = v
+        return ret
+
+    @property
+    def space(self):
+        """The HilbertSpace shared by all arrays of the batch."""
+        return self._space
+
+    @property
+    def nparray(self):
+        """The underlying numpy array, with the batch on the first axis."""
+        return self._nparray
+
+    def __len__(self):
+        return self._nparray.shape[0]
+
+    def __getitem__(self, key):
+        """
+        An integer index returns a single ``HilbertArray`` (a view into the
+        batch), anything else selects a sub-batch.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> x = BatchedHilbertArray(ha, np.arange(8).reshape(4, 2))
+        >>> x[1:3]
+        BatchedHilbertArray(2, |a>)
+        >>> x[-1]
+        HilbertArray(|a>,
+        array([ 6.+0.j,  7.+0.j]))
+        """
+
+        if isinstance(key, (int, np.integer)):
+            return self._space.array_from_buffer(self._nparray[key])
+        return BatchedHilbertArray(self._space, self._nparray[key])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'BatchedHilbertArray('+repr(len(self))+', '+repr(self._space)+')'
+
+    def _wrap(self, space, nparray):
+        return BatchedHilbertArray(space, nparray)
+
+    def copy(self):
+        """
+        Returns a copy (not a view) of this batch.
+        """
+
+        return self._wrap(self._space, self._nparray.copy())
+
+    def mean(self):
+        """
+        Returns the average of the arrays in the batch, as a ``HilbertArray``.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> BatchedHilbertArray.stack([ ha.ket(0), ha.ket(1) ]).mean()
+        HilbertArray(|a>,
+        array([ 0.5+0.j,  0.5+0.j]))
+        """
+
+        return self._space.array_from_buffer(np.mean(self._nparray, axis=0))
+
+    def sum(self):
+        """
+        Returns the sum of the arrays in the batch, as a ``HilbertArray``.
+        """
+
+        return self._space.array_from_buffer(np.sum(self._nparray, axis=0))
+
+    def closeto(self, other, rtol=1e-05, atol=1e-08):
+        """
+        Checks whether two batches are equal to within some tolerance.
+        """
+
+        if self._space != other.space:
+            raise MismatchedSpaceError("Mismatched spaces: "+
+                repr(self._space)+' vs. '+repr(other.space))
+        return np.allclose(self._nparray, other.nparray, rtol=rtol, atol=atol)
+
+    ########## arithmetic ##########
+
+    def _scalars(self, x):
+        """
+        Casts a scalar, or a vector with one scalar per batch entry, to
+        something that broadcasts against ``self.nparray``.
+        """
+
+        if isinstance(x, (HilbertArray, BatchedHilbertArray)):
+            return None
+        x = np.asarray(x)
+        if x.ndim == 0:
+            return x
+        if x.shape != (len(self),):
+            raise HilbertShapeError(x.shape, (len(self),))
+        return x.reshape((len(self),) + (1,)*len(self._space.shape))
+
+    def _same_space_data(self, other):
+        if isinstance(other, HilbertArray):
+            if other.space != self._space:
+                raise MismatchedSpaceError("Mismatched spaces: "+
+                    repr(self._space)+' vs. '+repr(other.space))
+            return other.nparray
+        elif isinstance(other, BatchedHilbertArray):
+            if other.space != self._space:
+                raise MismatchedSpaceError("Mismatched spaces: "+
+                    repr(self._space)+' vs. '+repr(other.space))
+            if len(other) != len(self):
+                raise HilbertShapeError(len(other), len(self))
+            return other.nparray
+        else:
+            return None
+
+    def __add__(self, other):
+        """
+        Adds two batches, or adds a single array to each element of a batch.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> x = BatchedHilbertArray.stack([ ha.ket(0), ha.ket(1) ])
+        >>> (x + x).closeto(2 * x)
+        True
+        >>> (x + ha.ket(0))[1]
+        HilbertArray(|a>,
+        array([ 1.+0.j,  1.+0.j]))
+        """
+
+        data = self._same_space_data(other)
+        if data is None:
+            return NotImplemented
+        return self._wrap(self._space, self._nparray + data)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        data = self._same_space_data(other)
+        if data is None:
+            return NotImplemented
+        return self._wrap(self._space, self._nparray - data)
+
+    def __rsub__(self, other):
+        data = self._same_space_data(other)
+        if data is None:
+            return NotImplemented
+        return self._wrap(self._space, data - self._nparray)
+
+    def __neg__(self):
+        return self._wrap(self._space, -self._nparray)
+
+    def __mul__(self, other):
+        """
+        Multiplies by an array, a batch, a scalar, or a vector of scalars
+        (one per element of the batch).
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> U = BatchedHilbertArray.stack([ ha.random_unitary() for i in range(3) ])
+        >>> K = (hb*ha.H).random_isometry()
+        >>> (K * U).space
+        |b><a|
+        >>> (K * U)[2].closeto(K * U[2])
+        True
+        >>> (U * U.H)[0].closeto(ha.eye())
+        True
+        >>> (U * np.array([1, 2, 3]))[2].closeto(U[2] * 3)
+        True
+        """
+
+        if isinstance(other, (HilbertArray, BatchedHilbertArray)):
+            return self.tensordot(other)
+        x = self._scalars(other)
+        if x is None:
+            return NotImplemented
+        return self._wrap(self._space, self._nparray * x)
+
+    def __rmul__(self, other):
+        if isinstance(other, HilbertArray):
+            return _batched_tensordot(other, self, None)
+        x = self._scalars(other)
+        if x is None:
+            return NotImplemented
+        return self._wrap(self._space, x * self._nparray)
+
+    def __truediv__(self, other):
+        x = self._scalars(other)
+        if x is None:
+            return NotImplemented
+        return self._wrap(self._space, self._nparray / x)
+
+    __div__ = __truediv__
+
+    def tensordot(self, other, contraction_spaces=None):
+        """
+        Batched version of :func:`HilbertArray.tensordot`.
+
+        Either operand can be a single ``HilbertArray``, in which case it is
+        used for every element of the batch.  The result of contracting over
+        all axes is an ndarray with one scalar per batch element.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> x = BatchedHilbertArray.stack([ (ha*hb).random_array() for i in range(4) ])
+        >>> y = BatchedHilbertArray.stack([ (hc*hb.H).random_array() for i in range(4) ])
+        >>> (y * x).space
+        |a,c>
+        >>> (y * x)[3].closeto(y[3] * x[3])
+        True
+        >>> (x.H * y.H).space
+        <a,c|
+        >>> (x.tensordot(y, frozenset()))[1].closeto(x[1].tensor(y[1]))
+        True
+        >>> w = (x.H * x)
+        >>> w.shape
+        (4,)
+        >>> abs(w[3] - x[3].H * x[3]) < 1e-12
+        True
+        """
+
+        return _batched_tensordot(self, other, contraction_spaces)
+
+    ########## structural operations ##########
+
+    @property
+    def H(self):
+        """
+        The adjoint of every array in the batch.
+
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = BatchedHilbertArray.stack([ (ha*hb.H).random_array() for i in range(3) ])
+        >>> x.H.space
+        |b><a|
+        >>> x.H[1] == x[1].H
+        True
+        """
+
+        in_space = self._space
+        out_space = in_space.H
+        perm = [0] + [ 1+in_space.axes_lookup[x.H] for x in out_space.axes ]
+        arr = in_space.base_field.mat_conj(self._nparray).transpose(perm)
+        return self._wrap(out_space, arr)
+
+    def conj(self):
+        """
+        The complex conjugate of every array in the batch.
+        """
+
+        return self._wrap(self._space, self._space.base_field.mat_conj(self._nparray))
+
+    def _as_matrices(self):
+        """
+        Returns the batch as a stack of matrices, kets for rows and bras for
+        columns.
+        """
+
+        ket_dim = self._space.ket_space().dim()
+        bra_dim = self._space.bra_space().dim()
+        return self._nparray.reshape(len(self), ket_dim, bra_dim)
+
+    def trace(self, axes=None):
+        """
+        Batched version of :func:`HilbertArray.trace`.
+
+        A full trace returns an ndarray containing the trace of each element,
+        a partial trace returns a ``BatchedHilbertArray``.  All requested
+        traces are done in a single pass.
+
+        >>> from qitensor import qubit, qudit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> rho = BatchedHilbertArray.stack([ (ha*hb).random_density() for i in range(3) ])
+        >>> abs(rho.trace() - 1).max() < 1e-12
+        True
+        >>> rho.trace(hb)
+        BatchedHilbertArray(3, |a><a|)
+        >>> rho.trace(hb)[1].closeto(rho[1].trace(hb))
+        True
+        >>> x = BatchedHilbertArray.stack([ (ha*hb*ha.H).random_array() for i in range(3) ])
+        >>> x.trace(ha)[2].closeto(x[2].trace(ha))
+        True
+        """
+
+        if axes is None:
+            if self._space != self._space.H:
+                raise HilbertError('bra space does not equal ket space; '+
+                    'please specify axes')
+            return np.trace(self._as_matrices(), axis1=1, axis2=2)
+
+        axes = _trace_axes_dict(self._space, axes)
+
+        labels = list(range(1, len(self._space.axes)+1))
+        for (s1, s2) in axes.items():
+            labels[self._space.axes_lookup[s2]] = labels[self._space.axes_lookup[s1]]
+        traced = frozenset(list(axes.keys()) + list(axes.values()))
+        out_atoms = [ x for x in self._space.axes if not x in traced ]
+        out_labels = [0] + [ labels[self._space.axes_lookup[x]] for x in out_atoms ]
+
+        arr = np.einsum(self._nparray, [0]+labels, out_labels)
+
+        if not out_atoms:
+            return arr
+        return self._wrap(create_space1(out_atoms), arr)
+
+    def tracekeep(self, keep_spc):
+        """
+        Trace out all but the given spaces of a batch of density operators.
+
+        >>> from qitensor import qubit, qudit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> rho = BatchedHilbertArray.stack([ (ha*hb).random_density() for i in range(3) ])
+        >>> rho.tracekeep(hb).closeto(rho.trace(ha))
+        True
+        """
+
+        if self._space != self._space.H:
+            raise HilbertError("self did not have equal bra and ket spaces: "+str(self._space))
+
+        if keep_spc == keep_spc.H:
+            keep_spc = keep_spc.ket_space()
+        keep_spc.assert_ket_space()
+
+        self_spc = self._space.ket_space()
+
+        if self_spc == keep_spc:
+            return self
+
+        if not (keep_spc.ket_set <= self_spc.ket_set):
+            raise MismatchedSpaceError('space not part of array: '+str(keep_spc)+' vs. '+str(self_spc))
+
+        return self.trace(self_spc / keep_spc)
+
+    ########## spectral functions ##########
+
+    def eigvals(self, hermit=False):
+        """
+        Returns the eigenvalues of each operator in the batch, as an ndarray
+        with one row per batch element.
+
+        If ``hermit`` is True, the operators are assumed Hermitian and the
+        eigenvalues are real and in ascending order.
+
+        >>> from qitensor import qudit, BatchedHilbertArray
+        >>> ha = qudit('a', 3)
+        >>> rho = BatchedHilbertArray.stack([ ha.random_density() for i in range(4) ])
+        >>> ew = rho.eigvals(hermit=True)
+        >>> ew.shape
+        (4, 3)
+        >>> abs(ew[2] - rho[2].eigvals(hermit=True)).max() < 1e-12
+        True
+        """
+
+        self._space.assert_square()
+        mats = self._as_matrices()
+        if hermit:
+            return np.linalg.eigvalsh(mats)
+        else:
+            return np.linalg.eigvals(mats)
+
+    def _assert_density_matrices(self, check_hermitian=True, check_normalized=True):
+        if not self._space.is_symmetric():
+            raise HilbertError("not a density matrix: "+str(self._space))
+
+        mats = self._as_matrices()
+
+        if check_hermitian:
+            if not np.allclose(mats, np.conj(np.swapaxes(mats, 1, 2))):
+                raise HilbertError("not a density matrix: not Hermitian")
+
+        if check_normalized:
+            tr = np.trace(mats, axis1=1, axis2=2)
+            if np.max(np.abs(tr - 1)) > toler:
+                raise HilbertError('density matrix was not normalized: trace='+
+                    str(tr[np.argmax(np.abs(tr - 1))]))
+
+    def entropy(self, normalize=False, checks=True):
+        """
+        Returns the von Neumann entropy (in bits) of each density operator in
+        the batch.  See :func:`HilbertArray.entropy`.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, qudit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> x = BatchedHilbertArray.stack([ ha.ket(0).O, ha.eye()/2 ])
+        >>> abs(x.entropy() - [0, 1]).max() < 1e-10
+        True
+        >>> BatchedHilbertArray.stack([ hb.eye() ]).entropy(normalize=True) - np.log2(3) < 1e-10
+        array([ True], dtype=bool)
+        """
+
+        self._assert_density_matrices(
+            check_hermitian=checks,
+            check_normalized=(checks and not normalize))
+
+        ew = self.eigvals(hermit=True)
+
+        if normalize:
+            ew /= np.abs(np.sum(ew, axis=1))[:, np.newaxis]
+
+        if checks and not np.all(ew >= -toler):
+            raise HilbertError('density matrix was not positive: '+str(ew.min()))
+
+        p = np.where(ew > 0, ew, 1)
+        return -np.sum(np.where(ew > 0, ew * np.log2(p), 0), axis=1)
+
+    def norm(self, p=2):
+        """
+        Returns the vector norm of each array in the batch.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, BatchedHilbertArray
+        >>> ha = qubit('a')
+        >>> x = BatchedHilbertArray(ha, [[3, 4], [1, 0]])
+        >>> x.norm()
+        array([ 5.,  1.])
+        >>> x.norm(p=1)
+        array([ 7.,  1.])
+        >>> x.norm(p=np.inf)
+        array([ 4.,  1.])
+        """
+
+        flat = self._nparray.reshape(len(self), -1)
+        return np.linalg.norm(flat, ord=p, axis=1)
+
+    def _sqrtm(self):
+        (w, v) = np.linalg.eigh(self._as_matrices())
+        w = np.sqrt(np.clip(w, 0, None))
+        return np.matmul(v * w[:, np.newaxis, :], np.conj(np.swapaxes(v, 1, 2)))
+
+    def fidelity(self, other):
+        """
+        Returns the fidelity between corresponding pairs of density operators.
+        ``other`` can be a batch or a single ``HilbertArray``.  See
+        :func:`HilbertArray.fidelity`.
+
+        >>> from qitensor import qudit, BatchedHilbertArray
+        >>> ha = qudit('a', 3)
+        >>> rho = BatchedHilbertArray.stack([ ha.random_density() for i in range(4) ])
+        >>> sigma = ha.random_density()
+        >>> f = rho.fidelity(sigma)
+        >>> abs(f[1] - rho[1].fidelity(sigma)) < 1e-10
+        True
+        >>> abs(rho.fidelity(rho) - 1).max() < 1e-10
+        True
+        """
+
+        if isinstance(other, HilbertArray):
+            other = BatchedHilbertArray(other.space, other.nparray[np.newaxis])
+        if other.space != self._space:
+            raise MismatchedSpaceError("Mismatched spaces: "+
+                repr(self._space)+' vs. '+repr(other.space))
+
+        self._assert_density_matrices()
+        other._assert_density_matrices()
+
+        prod = np.matmul(self._sqrtm(), other._sqrtm())
+        return np.sum(np.linalg.svd(prod, compute_uv=False), axis=-1)
+
+def _batched_tensordot(a, b, contraction_spaces):
+    """
+    Tensordot where either or both of the operands are batched.  The axis
+    bookkeeping is shared with ``HilbertArray.tensordot``.
+    """
+
+    a.space.base_field.assert_same(b.space.base_field)
+    wisdom = _get_td_wisdom(a.space, b.space, contraction_spaces)
+    (ax_a, ax_b) = wisdom.contract_axes
+
+    a_batched = isinstance(a, BatchedHilbertArray)
+    b_batched = isinstance(b, BatchedHilbertArray)
+    na = a.nparray
+    nb = b.nparray
+
+    if a_batched and b_batched:
+        if len(a) != len(b):
+            raise HilbertShapeError(len(a), len(b))
+        n = len(a)
+        free_a = [ i for i in range(na.ndim-1) if not i in ax_a ]
+        free_b = [ i for i in range(nb.ndim-1) if not i in ax_b ]
+        shape_a = [ na.shape[1+i] for i in free_a ]
+        shape_b = [ nb.shape[1+i] for i in free_b ]
+        k = int(np.prod([ na.shape[1+i] for i in ax_a ]))
+        ma = na.transpose([0] + [ 1+i for i in free_a ] + [ 1+i for i in ax_a ]). \
+            reshape(n, -1, k)
+        mb = nb.transpose([0] + [ 1+i for i in ax_b ] + [ 1+i for i in free_b ]). \
+            reshape(n, k, -1)
+        td = np.matmul(ma, mb).reshape([n] + shape_a + shape_b)
+        batch_pos = 0
+    elif a_batched:
+        td = np.tensordot(na, nb, axes=([ 1+i for i in ax_a ], ax_b))
+        batch_pos = 0
+    else:
+        td = np.tensordot(na, nb, axes=(ax_a, [ 1+i for i in ax_b ]))
+        batch_pos = na.ndim - len(ax_a)
+
+    if wisdom.out_num_axes == 0:
+        return td.reshape(td.shape[0])
+
+    perm = [batch_pos] + [ t+1 if t >= batch_pos else t for t in wisdom.transpose_axes ]
+    return BatchedHilbertArray(wisdom.ret_space, td.transpose(perm))
@@ -33,3 +33,22 @@ def orbit(D=2, cnt=50000):
         y *= x
 
     return y
+
+def orbit_out(D=2, cnt=50000):
+    """
+    Same as ``orbit`` but ping-pongs between two preallocated buffers using
+    ``mul(out=...)``, so that the loop does not allocate.
+    """
+
+    ha = qudit('a', D)
+    hb = qudit('b', D)
+
+    x = (ha*hb).random_unitary()
+    y = (ha*hb).random_unitary()
+    z = y.space.array()
+
+    for idx in range(cnt):
+        y.mul(x, out=z)
+        (y, z) = (z, y)
+
+    return y
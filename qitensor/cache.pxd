@@ -0,0 +1,24 @@
+cdef class LRUCache:
+    cdef readonly object maxsize
+    cdef readonly long hits
+    cdef readonly long misses
+    cdef readonly long evictions
+    cdef object _data
+
+    cpdef get(self, key, default=*)
+    cpdef put(self, key, value)
+    cpdef _evict(self)
+    cpdef resize(self, maxsize)
+    cpdef clear(self)
+    cpdef reset_stats(self)
+    cpdef dict stats(self)
+    cpdef dump(self, f)
+    cpdef load(self, f)
+
+cdef class SizedLRUCache(LRUCache):
+    cdef readonly object maxbytes
+    cdef readonly long nbytes
+    cdef object _sizes
+    cdef object _size_fn
+
+    cpdef resize_bytes(self, maxbytes)
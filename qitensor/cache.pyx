@@ -0,0 +1,282 @@
+"""
+Bounded caches used internally by qitensor to remember the results of
+expensive bookkeeping (for example the axis permutations needed by
+:func:`qitensor.array.HilbertArray.tensordot`).
+
+Each cache keeps hit, miss and eviction counters, which can be inspected
+using :func:`LRUCache.stats`, and can be saved to and restored from disk so
+that a new process can start with a warm cache.
+"""
+
+from collections import OrderedDict
+import pickle
+import sys
+
+__all__ = ['LRUCache', 'SizedLRUCache']
+
+cdef class LRUCache:
+    """
+    A dictionary-like cache that holds at most ``maxsize`` entries, evicting
+    the least recently used entry when full.  A ``maxsize`` of None means the
+    cache is unbounded.
+
+    >>> from qitensor.cache import LRUCache
+    >>> c = LRUCache(2)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> sorted(c.stats().items())
+    [('evictions', 1), ('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+    >>> 'a' in c, 'b' in c, len(c)
+    (True, False, 2)
+    """
+
+    def __init__(self, maxsize=None):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be positive or None')
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return 'LRUCache(size=%d, maxsize=%r)' % (len(self._data), self.maxsize)
+
+    cpdef get(self, key, default=None):
+        """
+        Returns the value stored under ``key``, or ``default`` if there is
+        none.  Counts as a hit or a miss.
+        """
+
+        # pop and re-insert to mark as most recently used
+        value = self._data.pop(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    cpdef put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if needed.
+        """
+
+        self._data.pop(key, None)
+        self._data[key] = value
+        self._evict()
+
+    cpdef _evict(self):
+        if self.maxsize is None:
+            return
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    cpdef resize(self, maxsize):
+        """
+        Changes the maximum size, evicting entries if needed.
+
+        >>> from qitensor.cache import LRUCache
+        >>> c = LRUCache()
+        >>> for i in range(10): c.put(i, i)
+        >>> c.resize(3)
+        >>> len(c), c.evictions
+        (3, 7)
+        >>> sorted(c.keys())
+        [7, 8, 9]
+        """
+
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be positive or None')
+        self.maxsize = maxsize
+        self._evict()
+
+    def keys(self):
+        """
+        Returns the keys, from least to most recently used.
+        """
+
+        return list(self._data.keys())
+
+    cpdef clear(self):
+        """
+        Removes all entries.  The statistics are not reset.
+        """
+
+        self._data.clear()
+
+    cpdef reset_stats(self):
+        """
+        Resets the hit, miss and eviction counters.
+        """
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    cpdef dict stats(self):
+        """
+        Returns a dictionary with the current size, maximum size, and hit,
+        miss and eviction counts.
+        """
+
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    cpdef dump(self, f):
+        """
+        Writes the contents of the cache to a file (given as a filename or a
+        file object opened in binary mode), using pickle.
+
+        >>> import tempfile
+        >>> from qitensor.cache import LRUCache
+        >>> c = LRUCache()
+        >>> c.put('x', 1)
+        >>> d = LRUCache()
+        >>> with tempfile.TemporaryFile() as f:
+        ...     c.dump(f)
+        ...     _ = f.seek(0)
+        ...     d.load(f)
+        >>> d.get('x')
+        1
+        """
+
+        if isinstance(f, str):
+            with open(f, 'wb') as fh:
+                self.dump(fh)
+            return
+        pickle.dump(list(self._data.items()), f, pickle.HIGHEST_PROTOCOL)
+
+    cpdef load(self, f):
+        """
+        Adds the entries previously saved with :func:`dump` to this cache.
+        """
+
+        if isinstance(f, str):
+            with open(f, 'rb') as fh:
+                self.load(fh)
+            return
+        for (key, value) in pickle.load(f):
+            self.put(key, value)
+
+def _nbytes(value):
+    """
+    Estimates the memory used by a cached value: the ``nbytes`` of numpy
+    arrays (and of the arrays inside tuples), or ``sys.getsizeof`` otherwise.
+    """
+
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum([ _nbytes(x) for x in value ])
+    return sys.getsizeof(value)
+
+cdef class SizedLRUCache(LRUCache):
+    """
+    An ``LRUCache`` which is also bounded by the total memory used by its
+    values, ``maxbytes`` (None for no limit).  The size of a value is given
+    by ``size_fn``, which by default uses the ``nbytes`` of numpy arrays.  A
+    value larger than ``maxbytes`` is not stored at all, and any value it
+    would have replaced is removed.
+
+    >>> import numpy as np
+    >>> from qitensor.cache import SizedLRUCache
+    >>> c = SizedLRUCache(maxbytes=2000)
+    >>> c.put('a', np.zeros(100))
+    >>> c.put('b', np.zeros(100))
+    >>> c.nbytes
+    1600
+    >>> c.put('c', np.zeros(100))
+    >>> c.keys(), c.nbytes, c.evictions
+    (['b', 'c'], 1600, 1)
+    >>> c.put('d', np.zeros(1000))
+    >>> 'd' in c
+    False
+    >>> c.put('c', np.zeros(1000))
+    >>> 'c' in c, c.nbytes
+    (False, 800)
+    >>> sorted(c.stats().items())
+    [('evictions', 1), ('hits', 0), ('maxbytes', 2000), ('maxsize', None), ('misses', 0), ('nbytes', 800), ('size', 1)]
+    """
+
+    def __init__(self, maxsize=None, maxbytes=None, size_fn=None):
+        LRUCache.__init__(self, maxsize)
+        if maxbytes is not None and maxbytes < 0:
+            raise ValueError('maxbytes must be non-negative or None')
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._sizes = {}
+        self._size_fn = _nbytes if size_fn is None else size_fn
+
+    def __repr__(self):
+        return 'SizedLRUCache(size=%d, maxsize=%r, nbytes=%d, maxbytes=%r)' % \
+            (len(self._data), self.maxsize, self.nbytes, self.maxbytes)
+
+    cpdef put(self, key, value):
+        cdef long size = self._size_fn(value)
+        if key in self._data:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._data[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        self._evict()
+
+    cpdef _evict(self):
+        while len(self._data) and (
+                (self.maxsize is not None and len(self._data) > self.maxsize) or
+                (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            (key, _) = self._data.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    cpdef resize_bytes(self, maxbytes):
+        """
+        Changes the memory budget, evicting entries if needed.
+
+        >>> import numpy as np
+        >>> from qitensor.cache import SizedLRUCache
+        >>> c = SizedLRUCache()
+        >>> for i in range(10): c.put(i, np.zeros(10))
+        >>> c.resize_bytes(250)
+        >>> len(c), c.nbytes
+        (3, 240)
+        """
+
+        if maxbytes is not None and maxbytes < 0:
+            raise ValueError('maxbytes must be non-negative or None')
+        self.maxbytes = maxbytes
+        self._evict()
+
+    cpdef clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    cpdef dict stats(self):
+        """
+        Returns the same statistics as :func:`LRUCache.stats`, plus the
+        memory used (``nbytes``) and the budget (``maxbytes``).
+        """
+
+        ret = LRUCache.stats(self)
+        ret['nbytes'] = self.nbytes
+        ret['maxbytes'] = self.maxbytes
+        return ret
@@ -3,18 +3,24 @@ This module contains functions related to quantum circuits.
 """
 
 import numpy as np
+import scipy.sparse
 from qitensor import HilbertAtom, HilbertArray, HilbertError, \
     HilbertShapeError, MismatchedSpaceError
+from qitensor.sparse import SparseHilbertArray
+from qitensor.space import create_space1
+from qitensor.array import _cached_operator
 
 __all__ = [
     'cphase', 'cnot', 'swap', 'controlled_U',
-    'toffoli', 'fredkin', 'max_entangled',
+    'toffoli', 'fredkin', 'max_entangled', 'Circuit',
 ]
 
-def cphase(h1, h2):
+def cphase(h1, h2, sparse=False):
     """
     Returns the controlled-phase or generalized controlled-phase gate.
 
+    If ``sparse`` is True, a :class:`SparseHilbertArray` is returned.
+
     The given spaces must be HilbertAtom spaces (i.e. not tensor products).
 
     For qubits, returns an operator in h1*h2 given by the diagonal
@@ -44,6 +50,9 @@ def cphase(h1, h2):
     >>> (V10 - (hb*hb.prime).diag([1, -1, 1, -1])).norm() < 1e-14
     True
 
+    >>> cphase(ha*ha.prime, hb*hb.prime, sparse=True).to_dense() == U
+    True
+
     >>> cphase(ha*ha.prime, hb)
     Traceback (most recent call last):
         ...
@@ -64,16 +73,35 @@ def cphase(h1, h2):
     if h2.dim() != d:
         raise HilbertError('spaces must be of the same dimension')
 
-    ret = (h1*h2).O.array()
-    for (j, a) in enumerate(h1.index_iter()):
-        for (k, b) in enumerate(h2.index_iter()):
-            ret[{ h1: a, h1.H: a, h2: b, h2.H: b }] = field.fractional_phase(j*k, d)
-    return ret
+    if sparse:
+        (j, k) = np.divmod(np.arange(d*d), d)
+        data = _phase_table(field, d)[(j*k) % d]
+        idx = {}
+        for (h, n) in ((h1, j), (h2, k)):
+            for (x, i) in zip(h.axes, np.unravel_index(n, h.shape)):
+                idx[x] = i
+                idx[x.H] = i
+        return SparseHilbertArray.from_coo((h1*h2).O, data, idx)
+
+    return _cached_operator(('cphase', h1, h2), _build_cphase, h1, h2)
+
+def _phase_table(field, d):
+    """Returns the phases ``exp(2 pi i m / d)`` for ``m`` in ``range(d)``."""
+    return np.array([ field.fractional_phase(m, d) for m in range(d) ], dtype=field.dtype)
 
-def cnot(h1, h2, left=True):
+def _build_cphase(h1, h2):
+    d = h1.dim()
+    j = np.arange(d)
+    arr = np.diag(_phase_table(h1.base_field, d)[np.outer(j, j) % d].reshape(-1))
+    axes = sum([ x.axes for x in (h1, h2, h1.H, h2.H) ], [])
+    return (h1*h2).O.array(arr, reshape=True, input_axes=axes)
+
+def cnot(h1, h2, left=True, sparse=False):
     """
     Returns the controlled-not (controlled-X) gate.
 
+    If ``sparse`` is True, a :class:`SparseHilbertArray` is returned.
+
     The given spaces must be HilbertAtom spaces (i.e. not tensor products).
     FIXME - need docs for non-qubit case
     FIXME - doctest for group_op
@@ -105,6 +133,8 @@ def cnot(h1, h2, left=True):
     True
     >>> hd.bra(S3.r1) * cnot(hd, hd.prime, left=False) * hd.ket(S3.r1) == hd.prime.pauliX(S3.r1, left=False)
     True
+    >>> cnot(hd, hd.prime, left=False, sparse=True).to_dense() == cnot(hd, hd.prime, left=False)
+    True
     """
 
     for h in (h1, h2):
@@ -121,15 +151,37 @@ def cnot(h1, h2, left=True):
     if h1.group_op != h2.group_op:
         raise HilbertError('spaces must have the same group_op')
 
-    ret = (h1*h2).O.array()
-    for x in h1.indices:
-        ret[{ h1: x, h1.H: x }] = h2.pauliX(x, left)
+    if sparse:
+        return controlled_U(h1, dict([ (x, h2.pauliX(x, left)) for x in h1.indices ]),
+            sparse=True)
+
+    return _cached_operator(('cnot', h1, h2, left), _build_cnot, h1, h2, left)
 
-    return ret
+def _build_cnot(h1, h2, left):
+    # the block for control value x is h2.pauliX(x, left)
+    d = h1.dim()
+    cols = h2._group_table(h1.indices, left)
+    i = np.arange(d)[:, np.newaxis]
+    arr = np.zeros((d, d, d, d), dtype=h1.base_field.dtype)
+    arr[i, i.T, i, cols] = 1
+    return (h1*h2).O.array(arr, input_axes=[h1, h2, h1.H, h2.H])
 
-def controlled_U(cspc, U):
+def controlled_U(cspc, U, sparse=False):
     """
-    FIXME - docs
+    Returns a gate which applies one of a list of operators depending on the
+    value of the control space ``cspc``.
+
+    :param cspc: the control space
+    :type cspc: HilbertSpace
+    :param U: the operators to apply for each basis element of ``cspc``, as a
+        list, or as a dict keyed by index (the identity is used for missing
+        entries).  If a single operator is given and ``cspc`` is two
+        dimensional, the operator is applied when the control is ``1``.
+    :type U: HilbertArray, SparseHilbertArray, list, or dict
+    :param sparse: if True, a :class:`SparseHilbertArray` is returned.  The
+        operators may then themselves be sparse, which allows building gates
+        on registers too large to store densely.
+    :type sparse: bool; default False
 
     >>> from qitensor import qubit, qudit, controlled_U, cnot, swap
     >>> ha = qubit('a')
@@ -159,11 +211,34 @@ def controlled_U(cspc, U):
     True
     >>> V * ha.ket(1) == cnot(hb, hc) * ha.ket(1)
     True
+
+    >>> controlled_U(hd, [ha.X, ha.Y, ha.Z], sparse=True).to_dense() == U
+    True
+    >>> W = controlled_U(ha*hb, {(1,1): hc.X}, sparse=True)
+    >>> W
+    SparseHilbertArray(|a,b,c><a,b,c|, nnz=8)
+    >>> W.to_dense() == V
+    True
+
+    >>> # a gate that would take 4GB to store densely
+    >>> import scipy.sparse
+    >>> from qitensor import SparseHilbertArray
+    >>> hs = [ qubit('q%d' % i) for i in range(14) ]
+    >>> big = hs[1]
+    >>> for h in hs[2:]:
+    ...     big = big * h
+    >>> minus_one = SparseHilbertArray(big.O, -scipy.sparse.identity(big.dim()))
+    >>> W = controlled_U(hs[0], minus_one, sparse=True)
+    >>> W.nnz
+    16384
+    >>> psi = (hs[0]*big).random_array()
+    >>> (W * psi)[{ hs[0]: 1 }].closeto(-psi[{ hs[0]: 1 }])
+    True
     """
 
     cspc.assert_ket_space()
 
-    if isinstance(U, HilbertArray):
+    if isinstance(U, (HilbertArray, SparseHilbertArray)):
         if cspc.dim() != 2:
             raise HilbertError('ambiguous usage of controlled_U when cspc.dim() != 2')
         U = [U.space.eye(), U]
@@ -195,15 +270,76 @@ def controlled_U(cspc, U):
             raise MismatchedSpaceError('operators act on different spaces: '+
                 str(U.space)+' vs. '+str(U0.space))
 
-    ret = (cspc.O * U0.space).eye()
-    for (v, U) in Udict.items():
-        ret[{ cspc: v, cspc.H: v }] = U
+    if sparse:
+        return _controlled_U_sparse(cspc, Udict, U0.space)
 
-    return ret
+    # stack the blocks, in the order of cspc.index_iter()
+    Uspace = U0.space
+    D = Uspace.ket_space().dim()
+    blocks = np.empty((cspc.dim(), D, D), dtype=cspc.base_field.dtype)
+    blocks[:] = np.eye(D)
+    pos = dict([ (v, n) for (n, v) in enumerate(cspc.index_iter()) ])
+    for (v, U) in Udict.items():
+        n = pos.get(v if isinstance(v, tuple) else (v,))
+        if n is None:
+            raise HilbertError('invalid control index: '+repr(v))
+        if isinstance(U, SparseHilbertArray):
+            U = U.to_dense()
+        blocks[n] = U.as_np_matrix()
+
+    C = cspc.dim()
+    n = np.arange(C)
+    arr = np.zeros((C, D, C, D), dtype=cspc.base_field.dtype)
+    arr[n, :, n, :] = blocks
+    axes = cspc.axes + Uspace.sorted_kets + cspc.H.axes + Uspace.sorted_bras
+    return (cspc.O * Uspace).array(arr, reshape=True, input_axes=axes)
+
+def _controlled_U_sparse(cspc, Udict, Uspace):
+    """
+    Builds the block diagonal matrix for :func:`controlled_U` directly in
+    sparse form.
+    """
 
-def toffoli(ha, hb, hc):
+    # normalize the keys to tuples, as given by index_iter
+    Udict = dict([ (k if isinstance(k, tuple) else (k,), v) for (k, v) in Udict.items() ])
+
+    kets = Uspace.sorted_kets
+    bras = Uspace.sorted_bras
+    eye = scipy.sparse.identity(Uspace.ket_space().dim(), format='coo')
+
+    data = []
+    idx = dict([ (x, []) for x in (cspc.O * Uspace).bra_ket_set ])
+    used = 0
+    for (n, v) in enumerate(cspc.index_iter()):
+        if v in Udict:
+            used += 1
+            U = Udict[v]
+            if isinstance(U, SparseHilbertArray):
+                blk = U.matrix.tocoo()
+            else:
+                blk = scipy.sparse.coo_matrix(U.as_np_matrix())
+        else:
+            blk = eye
+        data.append(blk.data)
+        for (x, i) in zip(cspc.axes, np.unravel_index(n, cspc.shape)):
+            idx[x].append(np.repeat(i, blk.nnz))
+            idx[x.H].append(np.repeat(i, blk.nnz))
+        for (atoms, flat) in ((kets, blk.row), (bras, blk.col)):
+            for (x, i) in zip(atoms, np.unravel_index(flat, [a.dim() for a in atoms])):
+                idx[x].append(i)
+
+    if used != len(Udict):
+        raise HilbertError('invalid control index: '+
+            repr(sorted(frozenset(Udict.keys()) - frozenset(cspc.index_iter()))))
+
+    return SparseHilbertArray.from_coo(cspc.O * Uspace, np.concatenate(data),
+        dict([ (x, np.concatenate(v)) for (x, v) in idx.items() ]))
+
+def toffoli(ha, hb, hc, sparse=False):
     """
-    FIXME - docs
+    Returns the Toffoli (controlled-controlled-not) gate, with control spaces
+    ``ha`` and ``hb`` and target ``hc``.  If ``sparse`` is True, a
+    :class:`SparseHilbertArray` is returned.
 
     >>> from qitensor import qubit, toffoli
     >>> ha = qubit('a')
@@ -216,11 +352,15 @@ def toffoli(ha, hb, hc):
     True
     """
 
-    return controlled_U(ha, cnot(hb, hc))
+    if sparse:
+        return controlled_U(ha, cnot(hb, hc, sparse=True), sparse=True)
+    return _cached_operator(('toffoli', ha, hb, hc),
+        lambda: controlled_U(ha, cnot(hb, hc)))
 
-def fredkin(ha, hb, hc):
+def fredkin(ha, hb, hc, sparse=False):
     """
-    FIXME - docs
+    Returns the Fredkin (controlled-swap) gate, with control space ``ha``.
+    If ``sparse`` is True, a :class:`SparseHilbertArray` is returned.
 
     >>> from qitensor import qubit, fredkin
     >>> ha = qubit('a')
@@ -231,15 +371,21 @@ def fredkin(ha, hb, hc):
     True
     >>> U * ha.ket(1) == swap(hb, hc) * ha.ket(1)
     True
+    >>> fredkin(ha, hb, hc, sparse=True).to_dense() == U
+    True
     """
 
-    return controlled_U(ha, swap(hb, hc))
+    if sparse:
+        return controlled_U(ha, swap(hb, hc, sparse=True), sparse=True)
+    return _cached_operator(('fredkin', ha, hb, hc),
+        lambda: controlled_U(ha, swap(hb, hc)))
 
-def swap(h1, h2):
+def swap(h1, h2, sparse=False):
     """
     Returns the swap gate.
 
-    The given spaces must be of the same dimension.
+    The given spaces must be of the same dimension.  If ``sparse`` is True, a
+    :class:`SparseHilbertArray` is returned.
 
     >>> from qitensor import qubit, qudit, swap
     >>> ha = qubit('a')
@@ -260,6 +406,8 @@ def swap(h1, h2):
     >>> phi2 = (ha*hc).array(phi.nparray, reshape=True)
     >>> (psi2*phi2 - swap(ha*hc, hb)*psi*phi).norm() < 1e-14
     True
+    >>> swap(ha*hc, hb, sparse=True).to_dense() == swap(ha*hc, hb)
+    True
     """
 
     for h in (h1, h2):
@@ -268,6 +416,18 @@ def swap(h1, h2):
     if h1.dim() != h2.dim():
         raise HilbertShapeError(h1.dim(), h2.dim())
 
+    if sparse:
+        d = h1.dim()
+        (j, k) = np.divmod(np.arange(d*d), d)
+        idx = {}
+        for (h, n) in ((h1, j), (h2, k), (h2.H, j), (h1.H, k)):
+            for (x, i) in zip(h.axes, np.unravel_index(n, h.shape)):
+                idx[x] = i
+        return SparseHilbertArray.from_coo((h1*h2).O, np.ones(d*d), idx)
+
+    return _cached_operator(('swap', h1, h2), _build_swap, h1, h2)
+
+def _build_swap(h1, h2):
     arr = np.eye(h1.dim()*h2.dim(), dtype=h1.base_field.dtype)
     axes = sum([ x.axes for x in (h1, h2, h2.H, h1.H) ], [])
     return (h1*h2).O.array(arr, reshape=True, input_axes=axes)
@@ -334,3 +494,212 @@ def max_entangled(h1, h2):
         raise HilbertError('spaces must be of the same dimension')
 
     return (h1.H * h2).eye().transpose(h1) / field.sqrt(d)
+
+class Circuit(object):
+    """
+    A sequence of gates, each an operator of the form ``|x><x|`` on some
+    atoms.
+
+    Rather than applying each gate as a separate pass over the state, a
+    circuit is compiled by fusing gates into blocks acting on a few atoms
+    (see :func:`compile`), and the blocks are then applied in place with
+    :func:`HilbertArray.apply`.  The fused blocks are cached, so running
+    the same circuit on many inputs only compiles it once.
+
+    >>> from qitensor import qubit, cnot, Circuit
+    >>> ha = qubit('a')
+    >>> hb = qubit('b')
+    >>> hc = qubit('c')
+    >>> c = Circuit([ ha.hadamard(), cnot(ha, hb), hb.gateS(), cnot(hb, hc), hc.X ])
+    >>> c
+    Circuit(5 gates on |a,b,c>)
+    >>> c.compile(max_dim=4)
+    Circuit(2 gates on |a,b,c>)
+    >>> psi = ha.ket(0) * hb.ket(0) * hc.ket(0)
+    >>> c.run(psi).closeto(c.unitary() * psi)
+    True
+    >>> rho = (ha*hb*hc).random_density()
+    >>> c.run(rho).closeto(c.unitary() * rho * c.unitary().H)
+    True
+    """
+
+    def __init__(self, gates=()):
+        self.gates = []
+        self._compiled = {}
+        self.extend(gates)
+
+    def append(self, op):
+        """
+        Adds a gate to the end of the circuit and returns the circuit.
+
+        >>> from qitensor import qubit, Circuit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> Circuit().append(ha.X).append(hb.Z)
+        Circuit(2 gates on |a,b>)
+        >>> Circuit().append(ha.ket(0) * hb.bra(0))
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'gates must be of the form |x><x|, not |a><b|'
+        """
+
+        if op.space != op.space.ket_space().O:
+            raise HilbertError('gates must be of the form |x><x|, not '+repr(op.space))
+        self.gates.append(op)
+        self._compiled = {}
+        return self
+
+    def extend(self, ops):
+        """Adds several gates to the end of the circuit."""
+
+        for op in ops:
+            self.append(op)
+        return self
+
+    def __len__(self):
+        return len(self.gates)
+
+    def __iter__(self):
+        return iter(self.gates)
+
+    @property
+    def space(self):
+        """The ket space of all atoms acted on by the circuit."""
+
+        atoms = set()
+        for op in self.gates:
+            atoms |= op.space.ket_set
+        return create_space1(atoms)
+
+    def __repr__(self):
+        if len(self.gates) == 0:
+            return 'Circuit()'
+        return 'Circuit(%d gates on %r)' % (len(self.gates), self.space)
+
+    def compile(self, max_dim=8):
+        """
+        Returns an equivalent circuit with gates fused into blocks.
+
+        Each gate is fused into the latest block that it overlaps with, if the
+        fused block acts on a space of dimension at most ``max_dim``.  Since
+        the gate commutes with all later blocks, it may instead be fused into
+        one of those.  Otherwise it starts a new block.  The default of 8
+        (three qubits) is about the largest block that costs no more than a
+        single gate to apply to a large state.  The fused blocks are cached,
+        and each call returns a new circuit built from them, so changing the
+        returned circuit does not affect this one.
+
+        >>> from qitensor import qubit, cnot, Circuit
+        >>> q = [ qubit('q%d' % i) for i in range(4) ]
+        >>> layer = [ x.hadamard() for x in q ] + [ cnot(q[i], q[i+1]) for i in range(3) ]
+        >>> c = Circuit(layer * 5)
+        >>> len(c), len(c.compile())
+        (35, 6)
+        >>> c.compile().unitary().closeto(c.unitary())
+        True
+        >>> cc = c.compile()
+        >>> cc.append(q[3].X)
+        Circuit(7 gates on |q0,q1,q2,q3>)
+        >>> len(c), len(c.compile())
+        (35, 6)
+        >>> c.compile().unitary().closeto(c.unitary())
+        True
+        """
+
+        blocks = self._blocks(max_dim)
+        ret = Circuit()
+        ret.gates = list(blocks)
+        ret._compiled[max_dim] = blocks
+        return ret
+
+    def _blocks(self, max_dim):
+        """
+        Returns the gates of :func:`compile` as a tuple, computing them only
+        if they are not already cached.
+        """
+
+        ret = self._compiled.get(max_dim)
+        if ret is not None:
+            return ret
+
+        # each block is [atoms, op]
+        blocks = []
+        for g in self.gates:
+            atoms = g.space.ket_set
+            last = -1
+            for (i, (b_atoms, _)) in enumerate(blocks):
+                if b_atoms & atoms:
+                    last = i
+            candidates = [ i for i in range(max(last, 0), len(blocks)) ]
+            for i in candidates:
+                union = blocks[i][0] | atoms
+                if np.prod([ x.dim() for x in union ]) <= max_dim:
+                    op = blocks[i][1]
+                    if not isinstance(op, HilbertArray):
+                        op = op.to_dense()
+                    if not isinstance(g, HilbertArray):
+                        g = g.to_dense()
+                    blocks[i] = [union, g * op]
+                    break
+            else:
+                blocks.append([atoms, g])
+
+        ret = tuple([ op for (_, op) in blocks ])
+        self._compiled[max_dim] = ret
+        return ret
+
+    def unitary(self):
+        """
+        Returns the product of the gates as a dense operator.  Only possible
+        for circuits on a few atoms.
+        """
+
+        U = self.space.eye()
+        for g in self.gates:
+            U.apply(g, inplace=True)
+        return U
+
+    def run(self, state, inplace=False, scratch=None, max_dim=8):
+        """
+        Runs the compiled circuit on a state.
+
+        If ``state`` has no bras it is a ket ``psi``, and ``U psi`` is
+        returned.  Otherwise it is an operator such as a density matrix
+        ``rho``, and ``U rho U^dagger`` is returned.  The atoms of the circuit
+        must be among the kets (and bras) of the state, which may have other
+        atoms as well.
+
+        :param inplace: if True, the state is overwritten with the result and
+            returned
+        :param scratch: a scratch buffer for :func:`HilbertArray.apply`
+        :param max_dim: passed to :func:`compile`
+
+        >>> from qitensor import qubit, cnot, Circuit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> c = Circuit([ cnot(ha, hb), hb.Y ])
+        >>> psi = (ha*hb*hc).random_array()
+        >>> phi = psi.copy()
+        >>> c.run(phi, inplace=True) is phi
+        True
+        >>> phi.closeto(hb.Y * cnot(ha, hb) * psi)
+        True
+        """
+
+        blocks = self._blocks(max_dim)
+        ret = state if inplace else state.copy()
+        if scratch is None:
+            scratch = np.empty_like(ret.nparray)
+
+        for op in blocks:
+            ret.apply(op, inplace=True, scratch=scratch)
+
+        if len(state.space.bra_set):
+            # U rho U^dagger = (U (U rho)^dagger)^dagger
+            adj = ret.H
+            for op in blocks:
+                adj.apply(op, inplace=True, scratch=scratch)
+            np.copyto(ret.nparray, adj.H.nparray)
+
+        return ret
@@ -0,0 +1,454 @@
+"""
+Simulation of Clifford circuits on stabilizer states.
+
+A :class:`StabilizerState` stores the Aaronson-Gottesman tableau of an
+``n`` qubit stabilizer state, using ``O(n^2)`` bits rather than the ``2^n``
+amplitudes a dense ``HilbertArray`` would need, so circuits on thousands of
+qubits can be simulated.  The qubits are ordinary qubit ``HilbertAtom``
+objects, and gates are given either through the named methods (:func:`h`,
+:func:`cnot`, ...) or as the same ``HilbertArray`` gates used elsewhere, such
+as ``cnot(ha, hb)``, ``ha.hadamard()`` or ``ha.gateS()``.  Any Clifford gate on
+a few qubits is accepted by :func:`StabilizerState.apply`.
+
+The tableau rows are bit-packed into bytes and padded to whole 64 bit words,
+so that row operations work on 64 qubits at a time.
+
+>>> from qitensor import qubit, cnot, StabilizerState
+>>> qs = [ qubit('q%d' % i) for i in range(1000) ]
+>>> st = StabilizerState(qs)
+>>> st.h(qs[0])
+>>> for i in range(999):
+...     st.cnot(qs[i], qs[i+1])
+>>> s = st.sample(10, rng=1)
+>>> s.shape
+(10, 1000)
+>>> all((s == s[:, :1]).all(axis=1))
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertAtom, HilbertArray, HilbertError, MismatchedSpaceError
+from qitensor.space import create_space1
+from qitensor.cache import LRUCache
+
+__all__ = ['StabilizerState']
+
+def _popcount(w):
+    """
+    Counts the set bits of each uint64 in ``w``, summed along the last axis.
+    """
+
+    w = w - ((w >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    w = (w & np.uint64(0x3333333333333333)) + ((w >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    w = (w + (w >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    w = (w * np.uint64(0x0101010101010101)) >> np.uint64(56)
+    return w.sum(axis=-1, dtype=np.int64)
+
+# Pauli matrices indexed by (x, z) bits, with (1, 1) meaning Y
+_PAULIS = {
+    (0, 0): np.eye(2),
+    (1, 0): np.array([[0, 1], [1, 0]]),
+    (0, 1): np.array([[1, 0], [0, -1]]),
+    (1, 1): np.array([[0, -1j], [1j, 0]]),
+}
+
+# cache of conjugation tables, keyed by the gate matrix
+_clifford_table_cache = LRUCache(1000)
+
+def _local_pauli(k, pattern):
+    """
+    Returns the Pauli matrix on ``k`` qubits (first qubit most significant)
+    for a pattern whose bits ``2j`` and ``2j+1`` are the x and z bits of qubit
+    ``j``.
+    """
+
+    ret = np.eye(1)
+    for j in range(k):
+        ret = np.kron(ret, _PAULIS[((pattern >> (2*j)) & 1, (pattern >> (2*j+1)) & 1)])
+    return ret
+
+def _clifford_table(U):
+    """
+    Computes how a Clifford gate acts on the Pauli group by conjugation.
+
+    Returns ``(table, sign)``: for each local Pauli pattern ``p`` (see
+    :func:`_local_pauli`), ``U P U^dagger`` is the Pauli with pattern
+    ``table[p]`` times ``(-1)**sign[p]``.  Raises a HilbertError if ``U`` is
+    not a Clifford gate.
+    """
+
+    U = np.asarray(U, dtype=complex)
+    key = (U.shape, U.tobytes())
+    ret = _clifford_table_cache.get(key)
+    if ret is not None:
+        return ret
+
+    dim = U.shape[0]
+    k = int(round(np.log2(dim)))
+    if U.shape != (2**k, 2**k) or not np.allclose(np.dot(U, U.conj().T), np.eye(dim)):
+        raise HilbertError('gate is not a unitary on qubits')
+
+    paulis = np.array([ _local_pauli(k, p) for p in range(4**k) ])
+    table = np.zeros(4**k, dtype=np.uint8)
+    sign = np.zeros(4**k, dtype=np.uint8)
+    for (p, P) in enumerate(paulis):
+        Q = np.dot(np.dot(U, P), U.conj().T)
+        # coefficients of Q in the (orthogonal) Pauli basis
+        c = np.einsum('qij,ji->q', paulis, Q) / dim
+        q = np.argmax(abs(c))
+        if abs(c[q].real) < 1 - 1e-8:
+            raise HilbertError('not a Clifford gate')
+        table[p] = q
+        sign[p] = 1 if c[q].real < 0 else 0
+
+    ret = (table, sign)
+    _clifford_table_cache.put(key, ret)
+    return ret
+
+_H = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+_S = np.diag([1, 1j])
+_CNOT = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0]])
+_CZ = np.diag([1, 1, 1, -1])
+_SWAP = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+
+class StabilizerState(object):
+    """
+    A stabilizer state on a list of qubits, initially ``|0...0>``.
+
+    The state is modified in place by the gate and measurement methods.
+
+    >>> from qitensor import qubit, StabilizerState
+    >>> ha = qubit('a')
+    >>> hb = qubit('b')
+    >>> st = StabilizerState([ha, hb])
+    >>> st
+    StabilizerState(|a,b>, ['+ZI', '+IZ'])
+    >>> st.h(ha); st.cnot(ha, hb)
+    >>> st.stabilizers()
+    ['+XX', '+ZZ']
+    >>> st.to_array().closeto((ha*hb).array([[1, 0], [0, 1]]) / np.sqrt(2))
+    True
+    """
+
+    def __init__(self, qubits):
+        qubits = list(qubits)
+        for x in qubits:
+            if not isinstance(x, HilbertAtom) or x.is_dual or x.dim() != 2:
+                raise HilbertError('not a qubit: '+repr(x))
+        if len(set(qubits)) != len(qubits):
+            raise HilbertError('a qubit was listed twice')
+
+        n = len(qubits)
+        self.qubits = qubits
+        self._index = dict([ (x, i) for (i, x) in enumerate(qubits) ])
+
+        # Rows 0..n-1 are the destabilizers, rows n..2n-1 the stabilizers.
+        # Bit j of a row is bit (j & 7) of byte (j >> 3).  Rows are padded to
+        # a whole number of 64 bit words so that row operations can work on
+        # uint64 views.  The phase bits have shape (2n, 1); the sampler adds
+        # extra columns to track the phases as affine functions of random
+        # measurement outcomes.
+        nbytes = 8 * ((n + 63) // 64)
+        packed = np.packbits(np.eye(n, dtype=np.uint8), axis=1, bitorder='little')
+        eye = np.zeros((n, nbytes), dtype=np.uint8)
+        eye[:, :packed.shape[1]] = packed
+        self._x = np.zeros((2*n, nbytes), dtype=np.uint8)
+        self._z = np.zeros((2*n, nbytes), dtype=np.uint8)
+        self._x[:n] = eye
+        self._z[n:] = eye
+        self._r = np.zeros((2*n, 1), dtype=np.uint8)
+
+    def copy(self):
+        """Returns a copy of this state."""
+
+        ret = StabilizerState.__new__(StabilizerState)
+        ret.qubits = self.qubits
+        ret._index = self._index
+        ret._x = self._x.copy()
+        ret._z = self._z.copy()
+        ret._r = self._r.copy()
+        return ret
+
+    @property
+    def space(self):
+        """The HilbertSpace on which this state lives."""
+        return create_space1(self.qubits)
+
+    def __repr__(self):
+        if len(self.qubits) > 16:
+            return 'StabilizerState(%d qubits)' % len(self.qubits)
+        return 'StabilizerState('+repr(self.space)+', '+repr(self.stabilizers())+')'
+
+    def _qubit_index(self, h):
+        try:
+            return self._index[h]
+        except KeyError:
+            raise MismatchedSpaceError('qubit not in state: '+repr(h))
+
+    def _get_bits(self, arr, j, rows=slice(None)):
+        return (arr[rows, j >> 3] >> (j & 7)) & 1
+
+    def _set_bits(self, arr, j, vals):
+        mask = np.uint8(1 << (j & 7))
+        col = arr[:, j >> 3]
+        arr[:, j >> 3] = (col & ~mask) | (vals.astype(np.uint8) << (j & 7))
+
+    def _apply_table(self, idx, table, sign):
+        """
+        Conjugates every row of the tableau by a gate on qubits ``idx``,
+        given by its table from :func:`_clifford_table`.
+        """
+
+        pattern = np.zeros(self._x.shape[0], dtype=np.intp)
+        for (j, q) in enumerate(idx):
+            s = 2*j
+            pattern |= self._get_bits(self._x, q).astype(np.intp) << s
+            pattern |= self._get_bits(self._z, q).astype(np.intp) << (s+1)
+        new = table[pattern]
+        self._r[:, 0] ^= sign[pattern]
+        for (j, q) in enumerate(idx):
+            s = 2*j
+            self._set_bits(self._x, q, (new >> s) & 1)
+            self._set_bits(self._z, q, (new >> (s+1)) & 1)
+
+    def _gate(self, U, qubits):
+        (table, sign) = _clifford_table(U)
+        idx = [ self._qubit_index(h) for h in qubits ]
+        if len(set(idx)) != len(idx):
+            raise HilbertError('gate acts twice on the same qubit')
+        self._apply_table(idx, table, sign)
+
+    def h(self, a):
+        """Applies a Hadamard gate to qubit ``a``."""
+        self._gate(_H, [a])
+
+    def s(self, a):
+        """Applies the phase gate ``diag(1, i)`` to qubit ``a``."""
+        self._gate(_S, [a])
+
+    def x(self, a):
+        """Applies a Pauli X gate to qubit ``a``."""
+        self._gate(_PAULIS[(1, 0)], [a])
+
+    def y(self, a):
+        """Applies a Pauli Y gate to qubit ``a``."""
+        self._gate(_PAULIS[(1, 1)], [a])
+
+    def z(self, a):
+        """Applies a Pauli Z gate to qubit ``a``."""
+        self._gate(_PAULIS[(0, 1)], [a])
+
+    def cnot(self, a, b):
+        """Applies a controlled-not gate with control ``a`` and target ``b``."""
+        self._gate(_CNOT, [a, b])
+
+    def cz(self, a, b):
+        """Applies a controlled-Z gate to qubits ``a`` and ``b``."""
+        self._gate(_CZ, [a, b])
+
+    def swap(self, a, b):
+        """Swaps qubits ``a`` and ``b``."""
+        self._gate(_SWAP, [a, b])
+
+    def apply(self, op):
+        """
+        Applies a Clifford gate given as an operator on a few of the qubits,
+        for instance one created by ``cnot``, ``cphase``, ``swap``,
+        ``hadamard``, ``gateS`` or the Pauli operators.  Sparse gates are
+        accepted too.
+
+        >>> from qitensor import qubit, cnot, cphase, StabilizerState
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> st = StabilizerState([ha, hb, hc])
+        >>> for U in [ ha.hadamard(), cnot(ha, hb), hc.hadamard(), cphase(hb, hc), hc.gateS(), ha.Y ]:
+        ...     st.apply(U)
+        >>> psi = ha.ket(0) * hb.ket(0) * hc.ket(0)
+        >>> for U in [ ha.hadamard(), cnot(ha, hb), hc.hadamard(), cphase(hb, hc), hc.gateS(), ha.Y ]:
+        ...     psi = U * psi
+        >>> abs(st.to_array().H * psi) > 1 - 1e-12
+        True
+        >>> st.apply(ha.gateT())
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'not a Clifford gate'
+        """
+
+        if not isinstance(op, HilbertArray):
+            op = op.to_dense()
+        qubits = op.space.ket_space().sorted_kets
+        if op.space != create_space1(qubits).O:
+            raise HilbertError('not an operator: '+repr(op.space))
+        U = op.as_np_matrix()
+        self._gate(U, qubits)
+
+    def stabilizers(self):
+        """
+        Returns the stabilizer generators as strings, such as ``'-XZI'``.
+        """
+
+        n = len(self.qubits)
+        x = np.unpackbits(self._x[n:], axis=1, bitorder='little')[:, :n]
+        z = np.unpackbits(self._z[n:], axis=1, bitorder='little')[:, :n]
+        letters = np.array(['I', 'X', 'Z', 'Y'])[x + 2*z]
+        return [ ('-' if r else '+') + ''.join(l) for (r, l) in zip(self._r[n:, 0], letters) ]
+
+    def _rowsum_phase(self, xs, zs, xt, zt):
+        """
+        Returns the phase bit contributed by multiplying the Pauli rows
+        ``(xs, zs)`` (on the left) with each of the rows ``(xt, zt)``.
+        """
+
+        (xs, zs, xt, zt) = [ a.view(np.uint64) for a in (xs, zs, xt, zt) ]
+        pos = (xs & zs & zt & ~xt) | (xs & ~zs & xt & zt) | (~xs & zs & xt & ~zt)
+        neg = (xs & zs & xt & ~zt) | (xs & ~zs & ~xt & zt) | (~xs & zs & xt & zt)
+        g = _popcount(pos) - _popcount(neg)
+        # for commuting rows g is even
+        return ((g % 4) // 2).astype(np.uint8)
+
+    def _measure(self, a, outcome):
+        """
+        Measures qubit ``a`` in the Z basis.  If the outcome is random, the
+        phase bits of the new stabilizer are set to ``outcome()``.  Returns
+        the phase bits of the result and whether it was random.
+        """
+
+        n = len(self.qubits)
+        j = self._qubit_index(a)
+        xa = self._get_bits(self._x, j)
+        stab = np.nonzero(xa[n:])[0]
+
+        if len(stab):
+            p = n + stab[0]
+            rows = np.nonzero(xa)[0]
+            rows = rows[rows != p]
+            c = self._rowsum_phase(self._x[p], self._z[p], self._x[rows], self._z[rows])
+            self._r[rows] ^= self._r[p]
+            self._r[rows, 0] ^= c
+            X = self._x.view(np.uint64)
+            Z = self._z.view(np.uint64)
+            X[rows] ^= X[p]
+            Z[rows] ^= Z[p]
+
+            self._x[p-n] = self._x[p]
+            self._z[p-n] = self._z[p]
+            self._r[p-n] = self._r[p]
+            self._x[p] = 0
+            self._z[p] = 0
+            self._z[p, j >> 3] = 1 << (j & 7)
+            self._r[p] = outcome()
+            return (self._r[p].copy(), True)
+        else:
+            # the outcome is the phase of the product of the stabilizers
+            # whose destabilizers anticommute with Z_a
+            rows = n + np.nonzero(xa[:n])[0]
+            sx = np.bitwise_xor.accumulate(self._x.view(np.uint64)[rows], axis=0)
+            sz = np.bitwise_xor.accumulate(self._z.view(np.uint64)[rows], axis=0)
+            # the partial products, before multiplying by each row
+            sx = np.vstack([ np.zeros_like(sx[:1]), sx[:-1] ])
+            sz = np.vstack([ np.zeros_like(sz[:1]), sz[:-1] ])
+            c = self._rowsum_phase(self._x[rows], self._z[rows], sx, sz)
+            sr = np.bitwise_xor.reduce(self._r[rows], axis=0)
+            sr[0] ^= np.uint8(np.sum(c) % 2)
+            return (sr, False)
+
+    def measure(self, a, rng=None):
+        """
+        Measures qubit ``a`` in the computational basis, collapsing the
+        state.  Returns the outcome, 0 or 1.
+
+        :param rng: a numpy random Generator, or a seed for one
+        """
+
+        rng = np.random.default_rng(rng)
+        (bits, _) = self._measure(a, lambda: rng.integers(2))
+        return int(bits[0])
+
+    def sample(self, shots, qubits=None, rng=None):
+        """
+        Samples the outcomes of measuring the given qubits (default all) in
+        the computational basis, without modifying the state.  Returns an
+        array of shape ``(shots, len(qubits))``.
+
+        A single symbolic pass over the qubits expresses every outcome as an
+        affine function of the random bits, after which each shot costs only
+        a matrix product mod 2.
+
+        :param rng: a numpy random Generator, or a seed for one
+
+        >>> from qitensor import qubit, StabilizerState
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> st = StabilizerState([ha, hb, hc])
+        >>> st.h(ha); st.cnot(ha, hb); st.x(hc)
+        >>> s = st.sample(1000, rng=0)
+        >>> sorted(set(map(tuple, s)))
+        [(0, 0, 1), (1, 1, 1)]
+        >>> 400 < s[:, 0].sum() < 600
+        True
+        >>> st.sample(3, [hc], rng=0)
+        array([[1],
+               [1],
+               [1]], dtype=uint8)
+        """
+
+        if qubits is None:
+            qubits = self.qubits
+        qubits = list(qubits)
+        rng = np.random.default_rng(rng)
+
+        m = len(qubits)
+        work = self.copy()
+        work._r = np.zeros((self._r.shape[0], m+1), dtype=np.uint8)
+        work._r[:, 0] = self._r[:, 0]
+
+        counter = [0]
+        def fresh_bit():
+            counter[0] += 1
+            ret = np.zeros(m+1, dtype=np.uint8)
+            ret[counter[0]] = 1
+            return ret
+
+        forms = np.array([ work._measure(a, fresh_bit)[0] for a in qubits ])
+        k = counter[0]
+        bits = rng.integers(0, 2, size=(shots, k)).astype(np.uint8)
+        return ((forms[:, 0] + np.dot(bits, forms[:, 1:k+1].T)) % 2).astype(np.uint8)
+
+    def to_array(self):
+        """
+        Returns the state as a dense ``HilbertArray``, with the global phase
+        chosen so that the first nonzero amplitude is positive.  Only possible
+        for small numbers of qubits.
+
+        >>> from qitensor import qubit, StabilizerState
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> st = StabilizerState([ha, hb])
+        >>> st.x(hb); st.h(ha); st.s(ha)
+        >>> st.to_array().closeto(ha.y_plus() * hb.ket(1))
+        True
+        """
+
+        space = self.space
+        n = len(self.qubits)
+        x = np.unpackbits(self._x[n:], axis=1, bitorder='little')[:, :n]
+        z = np.unpackbits(self._z[n:], axis=1, bitorder='little')[:, :n]
+
+        # project a generic vector onto the state
+        psi = space.random_array()
+        for i in range(n):
+            Spsi = psi
+            for (j, h) in enumerate(self.qubits):
+                P = _PAULIS[(x[i, j], z[i, j])]
+                if x[i, j] or z[i, j]:
+                    Spsi = h.O.array(P) * Spsi
+            if self._r[n+i, 0]:
+                Spsi = -Spsi
+            psi = (psi + Spsi) / 2
+
+        flat = psi.nparray.flatten()
+        first = flat[np.argmax(abs(flat) > 1e-8)]
+        return psi * (abs(first) / first) / psi.norm()
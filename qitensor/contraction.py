@@ -0,0 +1,373 @@
+"""
+Multi-operand tensor contraction with automatic ordering.
+
+A product such as ``A * B * C * D`` is evaluated by python from left to
+right, one ``tensordot`` at a time.  Depending on the dimensions involved this
+can create very large intermediate arrays.  The :func:`contract` function
+computes the same product, but first works out which axes get contracted with
+which (using the usual rule that the bra spaces of the left factor contract
+against the ket spaces of the right factor) and then chooses a pairwise
+contraction order that minimizes the number of floating point operations, in
+the style of ``numpy.einsum_path``.  Plans are cached, keyed by the tuple of
+input spaces, so the planning cost is paid only once for a given expression
+shape.
+
+>>> from qitensor import qudit, contract
+>>> ha = qudit('a', 3)
+>>> hb = qudit('b', 4)
+>>> hc = qudit('c', 5)
+>>> K = (hb*hc*ha.H).random_isometry()
+>>> rho = ha.random_density()
+>>> contract(K, rho, K.H).closeto(K * rho * K.H)
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertArray, HilbertError
+from qitensor.array import _get_td_wisdom
+from qitensor.cache import LRUCache
+
+__all__ = ['contract', 'contraction_plan', 'ContractionPlan']
+
+# Above this many operands, a greedy search is used rather than the exact
+# dynamic programming search (which takes time exponential in the number of
+# operands).
+optimal_search_limit = 8
+
+class ContractionPlan(object):
+    """
+    A pairwise contraction order for a tensor network.
+
+    Each operand is described by a list of integer labels, one per axis.  A
+    label that appears in two operands is summed over, a label that appears
+    twice in the same operand is traced over, and ``out_labels`` gives the
+    labels (and their order) of the result.  Don't create these directly, use
+    :func:`contraction_plan`.
+    """
+
+    def __init__(self, labels, out_labels, dims):
+        self.labels = tuple(tuple(l) for l in labels)
+        self.out_labels = tuple(out_labels)
+        self.dims = dict(dims)
+
+        n = len(self.labels)
+        if n == 0:
+            raise HilbertError('nothing to contract')
+
+        counts = {}
+        for ll in self.labels:
+            for l in ll:
+                counts[l] = counts.get(l, 0) + 1
+        for l in self.out_labels:
+            counts[l] = counts.get(l, 0) + 1
+
+        # Labels that only occur within a single operand (and not in the
+        # output) are summed out, and diagonals are taken for repeated labels,
+        # before any pairwise contraction.
+        self.preprocess = []
+        op_labels = []
+        for ll in self.labels:
+            keep = []
+            for l in ll:
+                if not l in keep and counts[l] > ll.count(l):
+                    keep.append(l)
+            if keep != list(ll):
+                self.preprocess.append((list(ll), keep))
+            else:
+                self.preprocess.append(None)
+            op_labels.append(frozenset(keep))
+        self._op_labels = op_labels
+
+        self._ext_cache = {}
+
+        if n <= optimal_search_limit:
+            tree = self._optimal_tree(n)
+        else:
+            tree = self._greedy_tree(n)
+
+        # Flatten the tree into a list of steps.  Operands are referred to by
+        # id: the inputs are 0..n-1, and each step creates a new id.
+        self.steps = []
+        self.flops = 0
+        self.largest_intermediate = 0
+        cur_labels = [ list(pp[1]) if pp else list(ll)
+            for (ll, pp) in zip(self.labels, self.preprocess) ]
+        self._flatten(tree, cur_labels)
+        final_labels = cur_labels[-1] if self.steps else cur_labels[0]
+
+        if sorted(final_labels) != sorted(self.out_labels):
+            raise HilbertError('inconsistent output labels')
+        self.out_perm = [ final_labels.index(l) for l in self.out_labels ]
+
+        naive = 0
+        mask = 1
+        for k in range(1, n):
+            naive += self._flops(mask, 1 << k)
+            mask |= 1 << k
+        self.naive_flops = naive
+
+    def _ext(self, mask):
+        """
+        The labels that remain on the result of contracting the operands in
+        ``mask``.
+        """
+
+        ret = self._ext_cache.get(mask)
+        if ret is None:
+            inside = set()
+            outside = set(self.out_labels)
+            for (i, ll) in enumerate(self._op_labels):
+                if mask & (1 << i):
+                    inside |= ll
+                else:
+                    outside |= ll
+            ret = frozenset(inside & outside)
+            self._ext_cache[mask] = ret
+        return ret
+
+    def _size(self, labels):
+        ret = 1
+        for l in labels:
+            ret *= self.dims[l]
+        return ret
+
+    def _flops(self, m1, m2):
+        return self._size(self._ext(m1) | self._ext(m2))
+
+    def _optimal_tree(self, n):
+        best = {}
+        for i in range(n):
+            best[1 << i] = (0, i)
+        for mask in range(1, 1 << n):
+            if mask in best:
+                continue
+            best_cost = None
+            best_split = None
+            # enumerate the ways of splitting mask into two nonempty parts
+            low = mask & -mask
+            sub = (mask - 1) & mask
+            while sub:
+                # only consider splits where the lowest bit goes to the left
+                # part, so that each split is counted once
+                if sub & low:
+                    other = mask ^ sub
+                    cost = best[sub][0] + best[other][0] + self._flops(sub, other)
+                    if best_cost is None or cost < best_cost:
+                        best_cost = cost
+                        best_split = (sub, other)
+                sub = (sub - 1) & mask
+            best[mask] = (best_cost, best_split)
+
+        def build(mask):
+            split = best[mask][1]
+            if isinstance(split, tuple):
+                return (build(split[0]), build(split[1]))
+            return split
+        return build((1 << n) - 1)
+
+    def _greedy_tree(self, n):
+        nodes = dict(((1 << i), i) for i in range(n))
+        while len(nodes) > 1:
+            masks = list(nodes.keys())
+            best = None
+            for (ia, ma) in enumerate(masks):
+                for mb in masks[ia+1:]:
+                    shared = bool(self._ext(ma) & self._ext(mb))
+                    key = (not shared, self._flops(ma, mb), self._size(self._ext(ma | mb)))
+                    if best is None or key < best[0]:
+                        best = (key, ma, mb)
+            (_, ma, mb) = best
+            nodes[ma | mb] = (nodes.pop(ma), nodes.pop(mb))
+        return list(nodes.values())[0]
+
+    def _flatten(self, tree, cur_labels):
+        if not isinstance(tree, tuple):
+            return tree
+        a = self._flatten(tree[0], cur_labels)
+        b = self._flatten(tree[1], cur_labels)
+        la = cur_labels[a]
+        lb = cur_labels[b]
+        shared = [ l for l in la if l in lb ]
+        axes_a = [ la.index(l) for l in shared ]
+        axes_b = [ lb.index(l) for l in shared ]
+        new_labels = [ l for l in la if not l in shared ] + \
+            [ l for l in lb if not l in shared ]
+        self.flops += self._size(set(la) | set(lb))
+        self.largest_intermediate = max(self.largest_intermediate, self._size(new_labels))
+        self.steps.append((a, b, axes_a, axes_b))
+        cur_labels.append(new_labels)
+        return len(cur_labels) - 1
+
+    def __repr__(self):
+        return 'ContractionPlan(operands=%d, flops=%d, naive_flops=%d, largest_intermediate=%d)' % \
+            (len(self.labels), self.flops, self.naive_flops, self.largest_intermediate)
+
+    def execute(self, nparrays):
+        """
+        Carries out the contraction on a list of numpy arrays, returning a
+        numpy array with axes in the order of ``out_labels``.
+        """
+
+        work = []
+        for (arr, pp) in zip(nparrays, self.preprocess):
+            if pp is not None:
+                arr = np.einsum(arr, pp[0], pp[1])
+            work.append(arr)
+        for (a, b, axes_a, axes_b) in self.steps:
+            work.append(np.tensordot(work[a], work[b], axes=(axes_a, axes_b)))
+        return work[-1].transpose(self.out_perm)
+
+# cache of plans for a network, keyed by the network structure
+_network_plan_cache = LRUCache(1000)
+# cache of (plan, output space), keyed by the tuple of input spaces
+_chain_plan_cache = LRUCache(1000)
+
+def _get_network_plan(labels, out_labels, dims):
+    """
+    Returns a (cached) ``ContractionPlan`` for the given network.
+    """
+
+    key = (tuple(tuple(l) for l in labels), tuple(out_labels),
+        tuple(sorted(dims.items())))
+    plan = _network_plan_cache.get(key)
+    if plan is None:
+        plan = ContractionPlan(labels, out_labels, dims)
+        _network_plan_cache.put(key, plan)
+    return plan
+
+def _chain_network(spaces):
+    """
+    Works out which axes are contracted when multiplying arrays on the given
+    spaces from left to right.  Returns the labels of each operand, the labels
+    of the output, the dimension of each label, and the output space (or None
+    if the result is a scalar).
+    """
+
+    labels = []
+    dims = {}
+    next_label = 0
+    # maps each atom of the running product to its label
+    cur = None
+    cur_space = None
+
+    for spc in spaces:
+        ll = []
+        for dim in spc.shape:
+            ll.append(next_label)
+            dims[next_label] = dim
+            next_label += 1
+
+        if cur is None:
+            cur = dict(zip(spc.axes, ll))
+            cur_space = spc
+        else:
+            wisdom = _get_td_wisdom(cur_space, spc, None)
+            mul_space = frozenset([x.H for x in cur_space.bra_set]) & spc.ket_set
+            for x in mul_space:
+                ll[spc.axes_lookup[x]] = cur[x.H]
+            new = dict((x, l) for (x, l) in cur.items() if not x.H in mul_space)
+            for (x, l) in zip(spc.axes, ll):
+                if not x in mul_space:
+                    new[x] = l
+            if wisdom.out_num_axes == 0:
+                cur = None
+                cur_space = None
+            else:
+                cur = new
+                cur_space = wisdom.ret_space
+        labels.append(ll)
+
+    if cur is None:
+        return (labels, [], dims, None)
+    else:
+        return (labels, [ cur[x] for x in cur_space.axes ], dims, cur_space)
+
+def _get_chain_plan(spaces):
+    key = tuple(spaces)
+    ret = _chain_plan_cache.get(key)
+    if ret is None:
+        (labels, out_labels, dims, out_space) = _chain_network(spaces)
+        ret = (_get_network_plan(labels, out_labels, dims), out_space)
+        _chain_plan_cache.put(key, ret)
+    return ret
+
+def contraction_plan(*operands):
+    """
+    Returns the ``ContractionPlan`` that :func:`contract` would use for the
+    given arrays (or spaces).
+
+    The plan reports the number of multiply-adds needed (``flops``), the
+    number needed when going from left to right (``naive_flops``), and the
+    size of the largest intermediate array.
+
+    >>> from qitensor import qudit, contraction_plan
+    >>> ha = qudit('a', 10)
+    >>> hb = qudit('b', 10)
+    >>> hc = qudit('c', 10)
+    >>> plan = contraction_plan(ha*hb.H, hb*hc.H, hc)
+    >>> plan
+    ContractionPlan(operands=3, flops=200, naive_flops=1100, largest_intermediate=10)
+    >>> plan.steps
+    [(1, 2, [1], [0]), (0, 3, [1], [0])]
+    """
+
+    spaces = [ x.space if isinstance(x, HilbertArray) else x for x in operands ]
+    return _get_chain_plan(spaces)[0]
+
+def contract(*arrays):
+    """
+    Multiplies any number of arrays, choosing an efficient contraction order.
+
+    The result is the same as ``arrays[0] * arrays[1] * ... * arrays[-1]``
+    (which python evaluates from left to right), but the pairwise
+    contractions are done in an order that minimizes the total work.  Scalars
+    may be mixed in with the arrays.
+
+    See also: :func:`contraction_plan`
+
+    >>> from qitensor import qudit, contract
+    >>> ha = qudit('a', 3)
+    >>> hb = qudit('b', 4)
+    >>> hc = qudit('c', 5)
+    >>> A = (ha*hb.H).random_array()
+    >>> B = (hb*hc.H).random_array()
+    >>> v = hc.random_array()
+    >>> contract(A, B, v).closeto(A * B * v)
+    True
+    >>> abs(contract(v.H, B.H, A.H, 2, A, B, v) - 2 * (A*B*v).norm()**2) < 1e-12
+    True
+    >>> contract(A, B.H)
+    Traceback (most recent call last):
+        ...
+    DuplicatedSpaceError: '<b|'
+    """
+
+    scalars = []
+    ops = []
+    for x in arrays:
+        if isinstance(x, HilbertArray):
+            ops.append(x)
+        else:
+            scalars.append(x)
+
+    if len(ops) == 0:
+        raise HilbertError('need at least one array')
+
+    base_field = ops[0].space.base_field
+    for x in ops[1:]:
+        base_field.assert_same(x.space.base_field)
+
+    (plan, out_space) = _get_chain_plan([ x.space for x in ops ])
+    arr = plan.execute([ x.nparray for x in ops ])
+
+    if out_space is None:
+        ret = arr[()]
+    else:
+        ret = out_space.array_from_buffer(arr)
+        if len(ops) == 1:
+            ret = ret.copy()
+
+    for x in scalars:
+        ret = ret * x
+    return ret
@@ -0,0 +1,395 @@
+"""
+A DiagonalHilbertArray is an operator on a space of the form ``|x><x|`` which
+is diagonal in the computational basis, and which stores only its diagonal
+(``d`` numbers rather than ``d^2``).  Multiplying it against a dense
+``HilbertArray`` just scales the appropriate axes of the dense array, which
+costs time proportional to the size of the dense array rather than a matrix
+product.  Operations that can't be done this way fall back to the dense
+representation.
+
+>>> import numpy as np
+>>> from qitensor import qubit, qudit, DiagonalHilbertArray
+>>> ha = qubit('a')
+>>> hb = qudit('b', 3)
+>>> D = DiagonalHilbertArray(hb.O, [1, 2, 3])
+>>> D
+DiagonalHilbertArray(|b><b|, array([ 1.+0.j,  2.+0.j,  3.+0.j]))
+>>> x = (ha*hb).O.random_array()
+>>> (D * x).closeto(hb.diag([1, 2, 3]) * x)
+True
+>>> (x * D).closeto(x * hb.diag([1, 2, 3]))
+True
+>>> U = hb.random_unitary()
+>>> (U * D * U.H).closeto(U * hb.diag([1, 2, 3]) * U.H)
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertSpace, HilbertArray, HilbertError, \
+    HilbertShapeError, MismatchedSpaceError
+from qitensor.array import _trace_axes_dict
+from qitensor.space import create_space1
+
+__all__ = ['DiagonalHilbertArray']
+
+def _expand(d, atoms, target_atoms):
+    """
+    Reshapes ``d``, whose axes correspond to ``atoms``, so that it broadcasts
+    against an array whose axes correspond to ``target_atoms``.  ``atoms``
+    must be a subset of ``target_atoms``.
+    """
+
+    pos = [ target_atoms.index(x) for x in atoms ]
+    perm = np.argsort(pos)
+    shape = [1] * len(target_atoms)
+    for (p, n) in zip(pos, d.shape):
+        shape[p] = n
+    return d.transpose(perm).reshape(shape)
+
+class DiagonalHilbertArray(object):
+    """
+    A diagonal operator on a ``HilbertSpace`` of the form ``|x><x|``, storing
+    only the diagonal.
+    """
+
+    # make numpy defer to our reflected operators
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, space, diag):
+        """
+        Creates a diagonal operator.
+
+        :param space: an operator space (a ket space ``h`` is taken to mean
+            ``h.O``)
+        :param diag: the diagonal, either as a flat list or with one axis per
+            ket of ``space`` (in the same order as ``space.ket_space().axes``)
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> DiagonalHilbertArray(ha*hb, [1, 2, 3, 4])
+        DiagonalHilbertArray(|a,b><a,b|, array([ 1.+0.j,  2.+0.j,  3.+0.j,  4.+0.j]))
+        >>> DiagonalHilbertArray(ha*hb.H, [1, 2])
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'not a symmetric operator space: |a><b|'
+        >>> DiagonalHilbertArray(ha, [1, 2, 3])
+        Traceback (most recent call last):
+            ...
+        HilbertShapeError: '3 vs. 2'
+        """
+
+        if not isinstance(space, HilbertSpace):
+            raise TypeError('space must be a HilbertSpace')
+        if len(space.bra_set) == 0 or len(space.ket_set) == 0:
+            space = space.O
+        if space != space.H:
+            raise HilbertError('not a symmetric operator space: '+str(space))
+
+        ket_space = space.ket_space()
+        diag = space.base_field.cast_array(np.asarray(diag))
+        if diag.size != ket_space.dim():
+            raise HilbertShapeError(diag.size, ket_space.dim())
+
+        self._space = space
+        self._kets = ket_space.axes
+        self._diag = diag.reshape(ket_space.shape)
+
+    @classmethod
+    def eye(cls, space):
+        """
+        Returns the identity operator.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray.eye(ha).to_dense() == ha.eye()
+        True
+        """
+
+        ket_space = space.ket_space() if len(space.ket_set) else space.H
+        return cls(space, np.ones(ket_space.dim()))
+
+    @classmethod
+    def fully_mixed(cls, space):
+        """
+        Returns the fully mixed state.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray.fully_mixed(ha).to_dense() == ha.fully_mixed()
+        True
+        """
+
+        ket_space = space.ket_space() if len(space.ket_set) else space.H
+        D = ket_space.dim()
+        return cls(space, np.ones(D) / D)
+
+    @classmethod
+    def from_array(cls, arr, check=True):
+        """
+        Takes the diagonal of an operator.  If ``check`` is True, an error is
+        raised if the operator is not diagonal.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> D = DiagonalHilbertArray.from_array(ha.Z * hb.eye())
+        >>> D.to_dense() == ha.Z * hb.eye()
+        True
+        >>> DiagonalHilbertArray.from_array(ha.X)
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'operator is not diagonal'
+        """
+
+        if not arr.space.is_symmetric():
+            raise HilbertError('not a symmetric operator space: '+str(arr.space))
+        m = arr.as_np_matrix()
+        d = np.diagonal(m)
+        if check and np.count_nonzero(m) > np.count_nonzero(d):
+            raise HilbertError('operator is not diagonal')
+        return cls(arr.space, d)
+
+    @property
+    def space(self):
+        """The HilbertSpace of this array."""
+        return self._space
+
+    @property
+    def values(self):
+        """The diagonal, as a flat numpy array."""
+        return self._diag.reshape(-1)
+
+    def __repr__(self):
+        return 'DiagonalHilbertArray(%r, %r)' % (self._space, self.values)
+
+    def copy(self):
+        """Returns a copy of this array."""
+        return DiagonalHilbertArray(self._space, self._diag.copy())
+
+    def to_dense(self):
+        """
+        Returns this operator as a ``HilbertArray``.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray(ha, [1, 2]).to_dense() == ha.diag([1, 2])
+        True
+        """
+
+        return self._space.diag(self.values)
+
+    def to_sparse(self):
+        """
+        Returns this operator as a :class:`SparseHilbertArray`.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray(ha, [1, 2]).to_sparse().to_dense() == ha.diag([1, 2])
+        True
+        """
+
+        import scipy.sparse
+        from qitensor.sparse import SparseHilbertArray
+        return SparseHilbertArray(self._space, scipy.sparse.diags(self.values, format='csr'))
+
+    def _scale(self, arr, atoms):
+        """
+        Returns a copy of the dense array ``arr`` with the axes corresponding
+        to ``atoms`` (the kets of this operator, or their duals) multiplied by
+        the diagonal.
+        """
+
+        d = _expand(self._diag, atoms, arr.axes)
+        return arr.space.array_from_buffer(arr.nparray * d)
+
+    def __mul__(self, other):
+        """
+        Multiplies by another array or by a scalar.
+
+        Multiplying by a dense array whose ket space (or bra space, if the
+        dense array is on the left) contains the space of this operator is
+        done by scaling the axes of the dense array.  The product of two
+        diagonal operators is a diagonal operator.
+
+        >>> from qitensor import qubit, qudit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> D = DiagonalHilbertArray(ha, [1, 2])
+        >>> E = DiagonalHilbertArray(hb, [3, 4, 5])
+        >>> D * E
+        DiagonalHilbertArray(|a,b><a,b|, array([  3.+0.j,   4.+0.j,   5.+0.j,   6.+0.j,   8.+0.j,  10.+0.j]))
+        >>> (D * E).to_dense() == D.to_dense() * E.to_dense()
+        True
+        >>> (D * D).to_dense() == ha.diag([1, 4])
+        True
+        >>> (D * 2).to_dense() == 2 * D.to_dense()
+        True
+        >>> x = (ha*hb.H).random_array()
+        >>> (D * x).closeto(D.to_dense() * x)
+        True
+        >>> y = (hb*ha.H).random_array()
+        >>> (y * D).closeto(y * D.to_dense())
+        True
+        >>> psi = ha.random_array()
+        >>> abs(psi.H * D * psi - psi.H * D.to_dense() * psi) < 1e-14
+        True
+        """
+
+        if isinstance(other, DiagonalHilbertArray):
+            self._space.base_field.assert_same(other._space.base_field)
+            kets = create_space1(frozenset(self._kets) | frozenset(other._kets)).axes
+            d = _expand(self._diag, self._kets, kets) * _expand(other._diag, other._kets, kets)
+            return DiagonalHilbertArray(create_space1(kets).O, d)
+        elif isinstance(other, HilbertArray):
+            if other.space.ket_set.issuperset(self._kets):
+                self._space.base_field.assert_same(other.space.base_field)
+                return self._scale(other, self._kets)
+            return self.to_dense() * other
+        elif hasattr(other, 'to_dense'):
+            return self.to_sparse() * other
+
+        try:
+            x = self._space.base_field.input_cast_function()(other)
+        except TypeError:
+            return NotImplemented
+        return DiagonalHilbertArray(self._space, self._diag * x)
+
+    def __rmul__(self, other):
+        if isinstance(other, HilbertArray):
+            bras = [ x.H for x in self._kets ]
+            if other.space.bra_set.issuperset(bras):
+                self._space.base_field.assert_same(other.space.base_field)
+                return self._scale(other, bras)
+            return other * self.to_dense()
+        return self * other
+
+    def __truediv__(self, other):
+        try:
+            x = self._space.base_field.input_cast_function()(other)
+        except TypeError:
+            return NotImplemented
+        return DiagonalHilbertArray(self._space, self._diag / x)
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return DiagonalHilbertArray(self._space, -self._diag)
+
+    def __add__(self, other):
+        """
+        Adds two arrays.  The sum of diagonal operators is diagonal, otherwise
+        the result is dense.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> D = DiagonalHilbertArray(ha, [1, 2])
+        >>> (D + D).to_dense() == ha.diag([2, 4])
+        True
+        >>> D + ha.X == ha.diag([1, 2]) + ha.X
+        True
+        >>> ha.X - D == ha.X - ha.diag([1, 2])
+        True
+        """
+
+        if isinstance(other, DiagonalHilbertArray):
+            if self._space != other._space:
+                raise MismatchedSpaceError('Mismatched HilbertSpaces: '+
+                    repr(self._space)+' vs. '+repr(other._space))
+            return DiagonalHilbertArray(self._space, self._diag + other._diag)
+        elif isinstance(other, HilbertArray):
+            return self.to_dense() + other
+        else:
+            return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, (DiagonalHilbertArray, HilbertArray)):
+            return NotImplemented
+        return self + (-other)
+
+    def __rsub__(self, other):
+        if not isinstance(other, HilbertArray):
+            return NotImplemented
+        return (-self) + other
+
+    @property
+    def H(self):
+        """
+        Returns the adjoint (Hermitian conjugate) of this operator.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray(ha, [1j, 2]).H
+        DiagonalHilbertArray(|a><a|, array([ 0.-1.j,  2.-0.j]))
+        """
+
+        return self.conj()
+
+    def conj(self):
+        """Returns the complex conjugate of this operator."""
+
+        bf = self._space.base_field
+        return DiagonalHilbertArray(self._space, bf.mat_conj(self._diag))
+
+    def norm(self):
+        """
+        Returns the Frobenius norm of this operator.
+
+        >>> from qitensor import qubit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> DiagonalHilbertArray(ha, [3, 4]).norm()
+        5.0
+        """
+
+        return np.sqrt(np.sum(np.abs(self._diag)**2))
+
+    def closeto(self, other, rtol=1e-05, atol=1e-08):
+        """
+        Checks whether two arrays are nearly equal, similar to numpy.allclose.
+        """
+
+        if isinstance(other, DiagonalHilbertArray):
+            if self._space != other._space:
+                return False
+            return np.allclose(self._diag, other._diag, rtol=rtol, atol=atol)
+        return self.to_dense().closeto(other, rtol=rtol, atol=atol)
+
+    def trace(self, axes=None):
+        """
+        Returns the (full or partial) trace of this operator.  The result of a
+        partial trace is diagonal.
+
+        >>> from qitensor import qubit, qudit, DiagonalHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> D = DiagonalHilbertArray(ha*hb, range(6))
+        >>> D.trace()
+        (15+0j)
+        >>> D.trace(ha)
+        DiagonalHilbertArray(|b><b|, array([ 3.+0.j,  5.+0.j,  7.+0.j]))
+        >>> D.trace(hb).to_dense() == D.to_dense().trace(hb)
+        True
+        >>> D.trace(ha*hb)
+        (15+0j)
+        """
+
+        if axes is None:
+            return np.sum(self._diag)
+
+        axes = _trace_axes_dict(self._space, axes)
+        traced = []
+        for (s1, s2) in axes.items():
+            if s1.H != s2:
+                # not a trace of a ket against its own bra
+                return self.to_dense().trace(axes)
+            traced.append(s2 if s1.is_dual else s1)
+
+        keep = [ x for x in self._kets if not x in traced ]
+        d = np.sum(self._diag, axis=tuple([ self._kets.index(x) for x in traced ]))
+        if not keep:
+            return d[()]
+        return DiagonalHilbertArray(create_space1(keep).O, d)
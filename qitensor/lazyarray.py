@@ -0,0 +1,489 @@
+"""
+Lazily evaluated HilbertArray expressions.
+
+Calling :func:`HilbertArray.lazy` returns a ``LazyHilbertArray``.  Arithmetic
+on lazy arrays (``*``, ``+``, ``-``, scalar multiplication, ``.H``, ``.T``,
+``conj``, ``trace``, ``relabel``) only computes the resulting HilbertSpace;
+nothing is computed until :func:`LazyHilbertArray.eval` is called.  At that
+point the expression is fused before being evaluated:
+
+* Products, adjoints, transposes, relabelings and traces are combined into a
+  single tensor network which is evaluated using the contraction order
+  optimizer of :mod:`qitensor.contraction`.  Adjacent transposes and adjoints
+  cancel, and a partial trace of a product is done as part of the contraction
+  rather than by forming the product and then tracing.
+* Sums and scalar multiples are accumulated into a single output buffer.
+
+>>> from qitensor import qudit
+>>> ha = qudit('a', 3)
+>>> hb = qudit('b', 4)
+>>> hc = qudit('c', 5)
+>>> K = (hb*hc*ha.H).random_isometry()
+>>> rho = ha.random_density()
+>>> expr = (K.lazy() * rho * K.H).trace(hc)
+>>> expr
+LazyHilbertArray(|b><b|)
+>>> expr.eval().closeto((K * rho * K.H).trace(hc))
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertSpace, HilbertArray, HilbertError, \
+    MismatchedSpaceError
+from qitensor.array import _get_td_wisdom, _trace_axes_dict, _relabel_mapping
+from qitensor.space import create_space1
+from qitensor.contraction import _get_network_plan
+
+__all__ = ['LazyHilbertArray']
+
+class _Network(object):
+    """
+    A product of arrays, with contraction structure given by integer labels on
+    the axes.  ``out`` maps each HilbertAtom of the result to a label.
+    """
+
+    def __init__(self, operands, out, coeff):
+        # list of [HilbertArray, conj flag, list of labels]
+        self.operands = operands
+        self.out = out
+        self.coeff = coeff
+
+    def merge_label(self, keep, drop):
+        for op in self.operands:
+            op[2] = [ keep if l == drop else l for l in op[2] ]
+        for (k, l) in self.out.items():
+            if l == drop:
+                self.out[k] = keep
+
+class _LabelSource(object):
+    def __init__(self):
+        self.next = 0
+
+    def fresh(self, n):
+        ret = list(range(self.next, self.next+n))
+        self.next += n
+        return ret
+
+class LazyHilbertArray(object):
+    """
+    A deferred HilbertArray expression.  Don't create these directly, use
+    :func:`HilbertArray.lazy`.
+    """
+
+    # make numpy defer to our reflected operators
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, space, base_field, op, args):
+        # space is None for scalar valued expressions
+        self._space = space
+        self._base_field = base_field
+        self._op = op
+        self._args = args
+
+    @classmethod
+    def _leaf(cls, arr):
+        return cls(arr.space, arr.space.base_field, 'leaf', (arr,))
+
+    @property
+    def space(self):
+        """
+        The HilbertSpace of the result, or None if the result is a scalar.
+        """
+        return self._space
+
+    def __repr__(self):
+        if self._space is None:
+            return 'LazyHilbertArray(scalar)'
+        return 'LazyHilbertArray('+repr(self._space)+')'
+
+    def lazy(self):
+        return self
+
+    ########## expression building ##########
+
+    def _coerce(self, other):
+        if isinstance(other, LazyHilbertArray):
+            ret = other
+        elif isinstance(other, HilbertArray):
+            ret = LazyHilbertArray._leaf(other)
+        else:
+            return None
+        self._base_field.assert_same(ret._base_field)
+        return ret
+
+    def _scaled(self, c):
+        return LazyHilbertArray(self._space, self._base_field, 'scale', (self, c))
+
+    def __mul__(self, other):
+        """
+        Lazy multiplication.  See :func:`HilbertArray.__mul__`.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb.H).random_array()
+        >>> y = hb.O.random_array()
+        >>> (x.lazy() * y * 2).eval().closeto(x * y * 2)
+        True
+        >>> (3 * x.lazy() * y.H).eval().closeto(3 * x * y.H)
+        True
+        >>> z = (ha*hb).O.random_array()
+        >>> w = (ha*hb).O.random_array()
+        >>> ((z.lazy() + w) * z).eval().closeto((z + w) * z)
+        True
+        >>> ((z.lazy() + w) * (w.lazy() - z)).eval().closeto((z + w) * (w - z))
+        True
+        >>> x.lazy() * x
+        Traceback (most recent call last):
+            ...
+        DuplicatedSpaceError: '<b|'
+        """
+
+        o = self._coerce(other)
+        if o is None:
+            try:
+                c = self._base_field.input_cast_function()(other)
+            except TypeError:
+                return NotImplemented
+            return self._scaled(c)
+        return _product(self, o)
+
+    def __rmul__(self, other):
+        o = self._coerce(other)
+        if o is None:
+            try:
+                c = self._base_field.input_cast_function()(other)
+            except TypeError:
+                return NotImplemented
+            return self._scaled(c)
+        return _product(o, self)
+
+    def __truediv__(self, other):
+        try:
+            c = self._base_field.input_cast_function()(other)
+        except TypeError:
+            return NotImplemented
+        return self._scaled(1 / c)
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return self._scaled(-1)
+
+    def __add__(self, other):
+        """
+        Lazy addition.  Sums are accumulated into a single output buffer.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = ha.O.random_array()
+        >>> y = ha.O.random_array()
+        >>> (x.lazy() + 2*y - x.H).eval().closeto(x + 2*y - x.H)
+        True
+        >>> x.lazy() + hb.O.random_array()
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'Mismatched HilbertSpaces: |a><a| vs. |b><b|'
+        """
+
+        o = self._coerce(other)
+        if o is None:
+            return NotImplemented
+        return _sum(self, o, 1)
+
+    def __radd__(self, other):
+        o = self._coerce(other)
+        if o is None:
+            return NotImplemented
+        return _sum(o, self, 1)
+
+    def __sub__(self, other):
+        o = self._coerce(other)
+        if o is None:
+            return NotImplemented
+        return _sum(self, o, -1)
+
+    def __rsub__(self, other):
+        o = self._coerce(other)
+        if o is None:
+            return NotImplemented
+        return _sum(o, self, -1)
+
+    @property
+    def H(self):
+        """
+        Lazy adjoint.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb.H).random_array()
+        >>> y = hb.random_array()
+        >>> (x.lazy() * y).H.eval().closeto((x * y).H)
+        True
+        >>> x.lazy().H.H.eval() == x
+        True
+        """
+
+        return LazyHilbertArray(_H(self._space), self._base_field, 'adjoint', (self,))
+
+    @property
+    def T(self):
+        """
+        Lazy transpose.
+        """
+
+        return LazyHilbertArray(_H(self._space), self._base_field, 'transpose', (self,))
+
+    def conj(self):
+        """
+        Lazy complex conjugate.
+        """
+
+        return LazyHilbertArray(self._space, self._base_field, 'conj', (self,))
+
+    def trace(self, axes=None):
+        """
+        Lazy trace.  See :func:`HilbertArray.trace`.
+
+        A partial trace of a product is computed during the contraction, so
+        the full product is never formed.
+
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> x = (ha*hb).O.random_array()
+        >>> y = (ha*hb).O.random_array()
+        >>> (x.lazy() * y).trace(hb).eval().closeto((x * y).trace(hb))
+        True
+        >>> abs((x.lazy() * y).trace().eval() - (x * y).trace()) < 1e-12
+        True
+        >>> (x.lazy() + y).trace(ha).eval().closeto((x + y).trace(ha))
+        True
+        """
+
+        if self._space is None:
+            raise HilbertError('cannot trace a scalar')
+        if axes is None:
+            if self._space != self._space.H:
+                raise HilbertError('bra space does not equal ket space; '+
+                    'please specify axes')
+            axes = dict((x, x.H) for x in self._space.ket_set)
+        else:
+            axes = _trace_axes_dict(self._space, axes)
+
+        traced = frozenset(list(axes.keys()) + list(axes.values()))
+        out_atoms = [ x for x in self._space.axes if not x in traced ]
+        out_space = create_space1(out_atoms) if out_atoms else None
+
+        return LazyHilbertArray(out_space, self._base_field, 'trace', (self, axes))
+
+    def tracekeep(self, keep_spc):
+        """
+        Lazy version of :func:`HilbertArray.tracekeep`.
+        """
+
+        if self._space is None or self._space != self._space.H:
+            raise HilbertError("self did not have equal bra and ket spaces: "+str(self._space))
+        if keep_spc == keep_spc.H:
+            keep_spc = keep_spc.ket_space()
+        keep_spc.assert_ket_space()
+        self_spc = self._space.ket_space()
+        if self_spc == keep_spc:
+            return self
+        if not (keep_spc.ket_set <= self_spc.ket_set):
+            raise MismatchedSpaceError('space not part of array: '+str(keep_spc)+' vs. '+str(self_spc))
+        return self.trace(self_spc / keep_spc)
+
+    def relabel(self, from_spaces, to_spaces=None):
+        """
+        Lazy relabeling.  See :func:`HilbertArray.relabel`.
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb.H).random_array()
+        >>> x.lazy().relabel(hb.H, ha.H).eval() == x.relabel(hb.H, ha.H)
+        True
+        """
+
+        if self._space is None:
+            raise HilbertError('cannot relabel a scalar')
+        mapping = _relabel_mapping(self._space, from_spaces, to_spaces)
+        xlate_list = [ mapping.get(x, x) for x in self._space.axes ]
+        HilbertSpace._assert_nodup_space(xlate_list, "relabling would cause a duplicated space")
+        new_space = create_space1(xlate_list)
+        return LazyHilbertArray(new_space, self._base_field, 'relabel', (self, mapping))
+
+    def relabel_prime(self):
+        """
+        Lazy version of :func:`HilbertArray.relabel_prime`.
+        """
+
+        return self.relabel(self._space.axes, [ x.prime for x in self._space.axes ])
+
+    ########## evaluation ##########
+
+    def _terms(self, src):
+        """
+        Returns a list of networks whose sum is the value of this expression.
+        """
+
+        op = self._op
+        args = self._args
+
+        if op == 'leaf':
+            arr = args[0]
+            labels = src.fresh(len(arr.axes))
+            return [ _Network([ [arr, False, labels] ], dict(zip(arr.axes, labels)), 1) ]
+
+        if op == 'sum':
+            ret = args[0]._terms(src)
+            for net in args[1]._terms(src):
+                net.coeff = net.coeff * args[2]
+                ret.append(net)
+            return ret
+
+        if op == 'product':
+            (a, b) = [ _collapse(x._terms(src), x, src) for x in args ]
+            mul_space = frozenset([x.H for x in a.out if x.is_dual]) & \
+                frozenset([x for x in b.out if not x.is_dual])
+            for x in mul_space:
+                la = a.out.pop(x.H)
+                lb = b.out.pop(x)
+                b.merge_label(la, lb)
+            out = dict(a.out)
+            out.update(b.out)
+            return [ _Network(a.operands + b.operands, out, a.coeff * b.coeff) ]
+
+        ret = args[0]._terms(src)
+
+        for net in ret:
+            if op == 'scale':
+                net.coeff = net.coeff * args[1]
+            elif op == 'adjoint':
+                for o in net.operands:
+                    o[1] = not o[1]
+                net.coeff = np.conj(net.coeff)
+                net.out = dict((x.H, l) for (x, l) in net.out.items())
+            elif op == 'transpose':
+                net.out = dict((x.H, l) for (x, l) in net.out.items())
+            elif op == 'conj':
+                for o in net.operands:
+                    o[1] = not o[1]
+                net.coeff = np.conj(net.coeff)
+            elif op == 'relabel':
+                mapping = args[1]
+                net.out = dict((mapping.get(x, x), l) for (x, l) in net.out.items())
+            elif op == 'trace':
+                for (s1, s2) in args[1].items():
+                    l1 = net.out.pop(s1)
+                    l2 = net.out.pop(s2)
+                    net.merge_label(l1, l2)
+            else:
+                raise AssertionError('unknown op '+op)
+
+        return ret
+
+    def eval(self):
+        """
+        Evaluates the expression, returning a HilbertArray (or a scalar).
+
+        >>> from qitensor import qubit
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb).O.random_array()
+        >>> x.lazy().eval() == x
+        True
+        >>> x.lazy().eval() is x
+        False
+        """
+
+        return _eval_terms(self._terms(_LabelSource()), self._space)
+
+def _H(space):
+    return None if space is None else space.H
+
+def _product(a, b):
+    if a._space is None:
+        space = b._space
+    elif b._space is None:
+        space = a._space
+    else:
+        wisdom = _get_td_wisdom(a._space, b._space, None)
+        space = wisdom.ret_space if wisdom.out_num_axes else None
+    return LazyHilbertArray(space, a._base_field, 'product', (a, b))
+
+def _sum(a, b, sign):
+    if a._space != b._space:
+        raise MismatchedSpaceError('Mismatched HilbertSpaces: '+
+            repr(a._space)+' vs. '+repr(b._space))
+    return LazyHilbertArray(a._space, a._base_field, 'sum', (a, b, sign))
+
+def _eval_network(net, space):
+    """
+    Evaluates a single network, returning an ndarray laid out for ``space``
+    (or a 0-d array if ``space`` is None).  The coefficient is not applied.
+    """
+
+    # Canonicalize the labels so that the plan cache can be shared between
+    # networks of the same shape.
+    canon = {}
+    labels = []
+    dims = {}
+    for (arr, _conj, ll) in net.operands:
+        cl = []
+        for (l, d) in zip(ll, arr.nparray.shape):
+            if not l in canon:
+                canon[l] = len(canon)
+                dims[canon[l]] = d
+            cl.append(canon[l])
+        labels.append(cl)
+    axes = [] if space is None else space.axes
+    out_labels = [ canon[net.out[x]] for x in axes ]
+
+    plan = _get_network_plan(labels, out_labels, dims)
+    nparrays = [ arr.space.base_field.mat_conj(arr.nparray) if conj else arr.nparray
+        for (arr, conj, _ll) in net.operands ]
+    ret = plan.execute(nparrays)
+
+    # the result must not be a view of one of the inputs
+    for (arr, _conj, _ll) in net.operands:
+        if np.may_share_memory(ret, arr.nparray):
+            return ret.copy()
+    return ret
+
+def _collapse(nets, expr, src):
+    """
+    Reduces a list of networks to a single network, evaluating the sum if
+    necessary.
+    """
+
+    if len(nets) == 1:
+        return nets[0]
+    val = _eval_terms(nets, expr._space)
+    if expr._space is None:
+        return _Network([], {}, val)
+    labels = src.fresh(len(val.axes))
+    return _Network([ [val, False, labels] ], dict(zip(val.axes, labels)), 1)
+
+def _eval_terms(nets, space):
+    ret = None
+    for net in nets:
+        if net.operands:
+            val = _eval_network(net, space)
+            if not np.all(net.coeff == 1):
+                val *= net.coeff
+        else:
+            val = net.coeff
+        if ret is None:
+            ret = val
+        else:
+            ret += val
+
+    if space is None:
+        return ret[()] if isinstance(ret, np.ndarray) else ret
+    return space.array_from_buffer(ret)
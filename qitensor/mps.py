@@ -0,0 +1,615 @@
+"""
+Matrix product states (MPS) and matrix product operators (MPO) over a chain of
+HilbertAtoms.  These can represent states of long 1D chains (e.g. dozens of
+qubits) which are far too large for a dense ``HilbertArray``, provided the
+entanglement across each cut of the chain is limited.
+
+Each site of the chain is a ket ``HilbertAtom`` and the state lives on the
+tensor product of the sites, using the usual ``|a,b,...>`` labels.  Local
+gates are ordinary ``HilbertArray`` operators on one site or on two adjacent
+sites.  After a two-site gate the bond between the sites is truncated using an
+SVD, according to ``max_bond`` and ``cutoff``.  Only numeric base fields are
+supported.
+
+>>> import numpy as np
+>>> from qitensor import qubit, cnot, MPS
+>>> q = [ qubit('q%d' % i) for i in range(40) ]
+>>> psi = MPS.product_state([ q[0].x_plus() ] + [ x.ket(0) for x in q[1:] ])
+>>> psi
+MPS(40 sites, max bond 1)
+>>> for i in range(39):
+...     psi = psi.apply(cnot(q[i], q[i+1]))
+>>> psi
+MPS(40 sites, max bond 2)
+>>> abs(psi.expectation(q[0].Z * q[39].Z) - 1) < 1e-12
+True
+>>> psi.reduced_density(q[20]*q[21]).closeto((q[20]*q[21]).diag([0.5, 0, 0, 0.5]))
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertSpace, HilbertAtom, HilbertError, \
+    HilbertShapeError, MismatchedSpaceError
+from qitensor.space import create_space1
+
+__all__ = ['MPS', 'MPO']
+
+def _parse_sites(sites):
+    """
+    Converts a list of atoms, or a HilbertSpace, into a list of ket atoms.
+    """
+
+    if isinstance(sites, HilbertSpace):
+        sites = sites.ket_space().sorted_kets
+    sites = list(sites)
+    for x in sites:
+        if not isinstance(x, HilbertAtom) or x.is_dual:
+            raise HilbertError('sites must be ket HilbertAtoms: '+repr(x))
+    HilbertSpace._assert_nodup_space(sites, "a site was listed twice")
+    return sites
+
+def _num_kept(s, max_bond, cutoff):
+    """
+    Returns how many of the singular values ``s`` (in descending order) are
+    kept: those above ``cutoff`` relative to the largest one, but not more
+    than ``max_bond``, and at least one.
+    """
+
+    k = np.count_nonzero(s > cutoff * s[0]) if len(s) and s[0] > 0 else 1
+    if max_bond is not None:
+        k = min(k, max_bond)
+    return max(k, 1)
+
+def _split(M, max_bond, cutoff):
+    """
+    Truncated SVD of a matrix.  Returns ``(U, SV, discarded_weight)`` with
+    ``M`` approximately equal to ``U.dot(SV)``.
+    """
+
+    (U, s, V) = np.linalg.svd(M, full_matrices=False)
+    k = _num_kept(s, max_bond, cutoff)
+    err = np.sum(s[k:]**2)
+    return (U[:, :k], s[:k, np.newaxis] * V[:k, :], err)
+
+def _operator_tensor(op, sites):
+    """
+    Returns the data of the operator ``op`` as an ndarray with axes ordered
+    as the output indices of ``sites`` followed by their input indices.
+    """
+
+    if op.space != create_space1(sites).O:
+        raise MismatchedSpaceError('operator must be on '+
+            repr(create_space1(sites).O)+', not '+repr(op.space))
+    axes = [ op.get_dim(x) for x in sites ] + [ op.get_dim(x.H) for x in sites ]
+    return op.nparray.transpose(axes)
+
+class MPS(object):
+    """
+    A matrix product state.
+
+    Site ``i`` holds a tensor of shape ``(Dl, d, Dr)`` where ``d`` is the
+    dimension of the site and ``Dl``, ``Dr`` are the bond dimensions (the
+    outer bonds are one dimensional).  Don't call the constructor directly
+    unless you already have the tensors; use :func:`from_array` or
+    :func:`product_state` instead.
+
+    The methods do not modify the MPS, they return a new one (which may share
+    tensors with the original).
+    """
+
+    def __init__(self, sites, tensors, center=None):
+        sites = _parse_sites(sites)
+        tensors = [ np.asarray(A) for A in tensors ]
+        if len(sites) != len(tensors) or len(sites) == 0:
+            raise HilbertError('need one tensor for each site')
+        for (i, (x, A)) in enumerate(zip(sites, tensors)):
+            if A.ndim != 3 or A.shape[1] != x.dim():
+                raise HilbertShapeError(A.shape, (None, x.dim(), None))
+            if i > 0 and tensors[i-1].shape[2] != A.shape[0]:
+                raise HilbertShapeError(tensors[i-1].shape[2], A.shape[0])
+        if tensors[0].shape[0] != 1 or tensors[-1].shape[2] != 1:
+            raise HilbertError('outer bonds must have dimension one')
+
+        self.sites = sites
+        self.tensors = tensors
+        # sites left of the center are left-canonical and those to the right
+        # are right-canonical, if the center is not None
+        self.center = center
+        self.truncation_error = 0.0
+
+    @classmethod
+    def from_array(cls, psi, sites=None, max_bond=None, cutoff=1e-14):
+        """
+        Converts a dense ket ``HilbertArray`` to an MPS.
+
+        :param sites: the order of the sites in the chain, default is the
+            sorted order of the kets of ``psi``
+        :type sites: list of HilbertAtoms or HilbertSpace
+        :param max_bond: the maximum bond dimension, or None for no limit
+        :param cutoff: singular values smaller than this, relative to the
+            largest, are discarded
+
+        >>> from qitensor import qubit, qudit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> hc = qubit('c')
+        >>> psi = (ha*hb*hc).random_array()
+        >>> m = MPS.from_array(psi)
+        >>> m.bond_dims
+        [2, 2]
+        >>> m.to_array().closeto(psi)
+        True
+        >>> MPS.from_array(psi, [hc, ha, hb]).to_array().closeto(psi)
+        True
+        >>> MPS.from_array(ha.O.eye())
+        Traceback (most recent call last):
+            ...
+        NotKetSpaceError: '|a><a|'
+        """
+
+        psi.space.assert_ket_space()
+        if sites is None:
+            sites = psi.space.sorted_kets
+        sites = _parse_sites(sites)
+        if frozenset(sites) != psi.space.ket_set:
+            raise MismatchedSpaceError('sites do not match the space of the array: '+
+                repr(create_space1(sites))+' vs. '+repr(psi.space))
+
+        data = psi.nparray.transpose([ psi.get_dim(x) for x in sites ])
+        tensors = []
+        err = 0.0
+        rest = data.reshape(1, -1)
+        for x in sites[:-1]:
+            Dl = rest.shape[0]
+            (U, rest, e) = _split(rest.reshape(Dl * x.dim(), -1), max_bond, cutoff)
+            err += e
+            tensors.append(U.reshape(Dl, x.dim(), -1))
+        tensors.append(rest.reshape(rest.shape[0], sites[-1].dim(), 1))
+
+        ret = cls(sites, tensors, center=len(sites)-1)
+        ret.truncation_error = err
+        return ret
+
+    @classmethod
+    def product_state(cls, states):
+        """
+        Returns the product of the given single-site kets.
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> m = MPS.product_state([ ha.ket(1), hb.x_plus() ])
+        >>> m.to_array().closeto(ha.ket(1) * hb.x_plus())
+        True
+        """
+
+        sites = []
+        tensors = []
+        for v in states:
+            v.space.assert_ket_space()
+            if len(v.axes) != 1:
+                raise HilbertError('each state must be on a single site: '+repr(v.space))
+            sites.append(v.axes[0])
+            tensors.append(np.asarray(v.nparray).reshape(1, -1, 1))
+        return cls(sites, tensors)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def __repr__(self):
+        return 'MPS(%d sites, max bond %d)' % (len(self.sites), max([1] + self.bond_dims))
+
+    @property
+    def space(self):
+        """The HilbertSpace on which this state lives."""
+        return create_space1(self.sites)
+
+    @property
+    def bond_dims(self):
+        """The dimensions of the bonds between adjacent sites."""
+        return [ A.shape[2] for A in self.tensors[:-1] ]
+
+    def _replace(self, tensors, center, err=0.0):
+        ret = MPS(self.sites, tensors, center)
+        ret.truncation_error = self.truncation_error + err
+        return ret
+
+    def to_array(self):
+        """
+        Converts to a dense ``HilbertArray``.  Only possible for small chains.
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> MPS.product_state([ ha.ket(0), hb.ket(1) ]).to_array() == ha.ket(0) * hb.ket(1)
+        True
+        """
+
+        data = self.tensors[0]
+        for A in self.tensors[1:]:
+            data = np.tensordot(data, A, axes=1)
+        data = data.reshape([ x.dim() for x in self.sites ])
+        return self.space.array_from_buffer(data, input_axes=self.sites)
+
+    def canonicalize(self, center):
+        """
+        Returns an equivalent MPS in mixed canonical form with orthogonality
+        center at site ``center`` (an index or a HilbertAtom).
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> psi = (ha*hb*hc).random_array()
+        >>> m = MPS.from_array(psi).canonicalize(hb)
+        >>> m.center
+        1
+        >>> m.to_array().closeto(psi)
+        True
+        """
+
+        if isinstance(center, HilbertAtom):
+            center = self.sites.index(center)
+        if self.center == center:
+            return self
+
+        tensors = list(self.tensors)
+        n = len(tensors)
+        (lo, hi) = (0, n-1) if self.center is None else (self.center, self.center)
+
+        # sweep left to right up to the center
+        for i in range(min(lo, center), center):
+            (Dl, d, Dr) = tensors[i].shape
+            (Q, R) = np.linalg.qr(tensors[i].reshape(Dl*d, Dr))
+            tensors[i] = Q.reshape(Dl, d, -1)
+            tensors[i+1] = np.tensordot(R, tensors[i+1], axes=1)
+
+        # sweep right to left down to the center
+        for i in range(max(hi, center), center, -1):
+            (Dl, d, Dr) = tensors[i].shape
+            (Q, R) = np.linalg.qr(tensors[i].reshape(Dl, d*Dr).T)
+            tensors[i] = Q.T.reshape(-1, d, Dr)
+            tensors[i-1] = np.tensordot(tensors[i-1], R.T, axes=1)
+
+        return self._replace(tensors, center)
+
+    def compress(self, max_bond=None, cutoff=1e-14):
+        """
+        Returns an MPS with bonds truncated to at most ``max_bond`` (and with
+        relative singular values below ``cutoff`` discarded).  The discarded
+        weight is added to ``truncation_error``.
+
+        >>> from qitensor import qubit, MPS
+        >>> hs = [ qubit('q%d' % i) for i in range(6) ]
+        >>> space = hs[0]*hs[1]*hs[2]*hs[3]*hs[4]*hs[5]
+        >>> psi = space.random_array().normalized()
+        >>> m = MPS.from_array(psi)
+        >>> m.bond_dims
+        [2, 4, 8, 4, 2]
+        >>> m2 = m.compress(max_bond=4)
+        >>> m2.bond_dims
+        [2, 4, 4, 4, 2]
+        >>> abs(m2.to_array().norm()**2 + m2.truncation_error - 1) < 1e-12
+        True
+        """
+
+        m = self.canonicalize(len(self) - 1)
+        tensors = list(m.tensors)
+        err = 0.0
+        for i in range(len(tensors)-1, 0, -1):
+            (Dl, d, Dr) = tensors[i].shape
+            (U, SV, e) = _split(tensors[i].reshape(Dl, d*Dr).T, max_bond, cutoff)
+            err += e
+            tensors[i] = U.T.reshape(-1, d, Dr)
+            tensors[i-1] = np.tensordot(tensors[i-1], SV.T, axes=1)
+        return m._replace(tensors, 0, err)
+
+    def norm(self):
+        """
+        Returns the norm of this state.
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> psi = (ha*hb).random_array()
+        >>> abs(MPS.from_array(psi).norm() - psi.norm()) < 1e-12
+        True
+        """
+
+        return np.sqrt(abs(self.inner(self)))
+
+    def normalized(self):
+        """Returns a normalized copy of this state."""
+
+        m = self.canonicalize(0 if self.center is None else self.center)
+        tensors = list(m.tensors)
+        tensors[m.center] = tensors[m.center] / np.linalg.norm(tensors[m.center])
+        return m._replace(tensors, m.center)
+
+    def inner(self, other):
+        """
+        Returns the inner product ``<self|other>``.
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb).random_array()
+        >>> y = (ha*hb).random_array()
+        >>> abs(MPS.from_array(x).inner(MPS.from_array(y)) - x.H * y) < 1e-12
+        True
+        """
+
+        if self.sites != other.sites:
+            raise MismatchedSpaceError('MPS are on different chains: '+
+                repr(self.space)+' vs. '+repr(other.space))
+        E = np.ones((1, 1))
+        for (A, B) in zip(self.tensors, other.tensors):
+            # E[a, b] -> E[a', b']
+            E = np.tensordot(E, A.conj(), axes=([0], [0]))
+            E = np.tensordot(E, B, axes=([0, 1], [0, 1]))
+        return E[0, 0]
+
+    def apply(self, op, max_bond=None, cutoff=1e-14):
+        """
+        Applies a local operator, returning a new MPS.
+
+        :param op: an operator on one site, or on two adjacent sites
+        :type op: HilbertArray
+        :param max_bond: for two-site operators, the maximum bond dimension
+            to keep
+        :param cutoff: for two-site operators, singular values smaller than
+            this, relative to the largest, are discarded
+
+        >>> from qitensor import qubit, cnot, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> psi = (ha*hb*hc).random_array()
+        >>> m = MPS.from_array(psi)
+        >>> m.apply(hb.X).to_array().closeto(hb.X * psi)
+        True
+        >>> m.apply(cnot(hc, hb)).to_array().closeto(cnot(hc, hb) * psi)
+        True
+        >>> m.apply(cnot(ha, hc))
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'sites are not adjacent: |a,c>'
+        """
+
+        sites = op.space.ket_space().sorted_kets
+        pos = sorted([ self.sites.index(x) for x in sites ])
+        if len(pos) == 1:
+            i = pos[0]
+            G = _operator_tensor(op, [self.sites[i]])
+            tensors = list(self.tensors)
+            tensors[i] = np.einsum('ij,ljr->lir', G, tensors[i])
+            # a non-unitary operator spoils canonical form away from the center
+            return self._replace(tensors, i if self.center == i else None)
+        elif len(pos) == 2:
+            (i, j) = pos
+            if j != i+1:
+                raise HilbertError('sites are not adjacent: '+repr(op.space.ket_space()))
+            G = _operator_tensor(op, self.sites[i:i+2])
+            m = self.canonicalize(i)
+            tensors = list(m.tensors)
+            theta = np.tensordot(tensors[i], tensors[i+1], axes=1)
+            theta = np.einsum('abcd,lcdr->labr', G, theta)
+            (Dl, d1, d2, Dr) = theta.shape
+            (U, SV, err) = _split(theta.reshape(Dl*d1, d2*Dr), max_bond, cutoff)
+            tensors[i] = U.reshape(Dl, d1, -1)
+            tensors[i+1] = SV.reshape(-1, d2, Dr)
+            return m._replace(tensors, i+1, err)
+        else:
+            raise HilbertError('only one and two site operators are supported')
+
+    def reduced_density(self, block):
+        """
+        Returns the reduced density operator of a contiguous block of sites.
+
+        :param block: the sites to keep
+        :type block: HilbertSpace or list of HilbertAtoms
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> hd = qubit('d')
+        >>> psi = (ha*hb*hc*hd).random_array().normalized()
+        >>> m = MPS.from_array(psi)
+        >>> m.reduced_density(hb*hc).closeto(psi.O.trace(ha*hd))
+        True
+        >>> m.reduced_density(hd).closeto(psi.O.trace(ha*hb*hc))
+        True
+        >>> m.reduced_density(ha*hc)
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'sites are not contiguous: |a,c>'
+        """
+
+        block = _parse_sites(block)
+        pos = sorted([ self.sites.index(x) for x in block ])
+        if pos != list(range(pos[0], pos[-1]+1)):
+            raise HilbertError('sites are not contiguous: '+repr(create_space1(block)))
+        (i, j) = (pos[0], pos[-1])
+
+        # with the center at i, the environments on both sides are trivial
+        m = self.canonicalize(i)
+        T = m.tensors[i]
+        for A in m.tensors[i+1:j+1]:
+            T = np.tensordot(T, A, axes=1)
+        rho = np.tensordot(T, T.conj(), axes=([0, T.ndim-1], [0, T.ndim-1]))
+
+        sites = self.sites[i:j+1]
+        return create_space1(sites).O.array_from_buffer(rho,
+            input_axes=sites + [ x.H for x in sites ])
+
+    def expectation(self, op):
+        """
+        Returns ``<psi|op|psi>`` for an :class:`MPO` or for a ``HilbertArray``
+        operator on any (not necessarily adjacent) sites.
+
+        >>> from qitensor import qubit, MPS
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> psi = (ha*hb*hc).random_array().normalized()
+        >>> m = MPS.from_array(psi)
+        >>> op = ha.Z * hc.X
+        >>> abs(m.expectation(op) - psi.H * op * psi) < 1e-12
+        True
+        """
+
+        if isinstance(op, MPO):
+            return op.expectation(self)
+
+        sites = op.space.ket_space().sorted_kets
+        if op.space != create_space1(sites).O:
+            raise HilbertError('not an operator: '+repr(op.space))
+        sites = sorted(sites, key=self.sites.index)
+        return MPO.from_array(op, sites).expectation(self)
+
+class MPO(object):
+    """
+    A matrix product operator.
+
+    Site ``i`` holds a tensor of shape ``(Dl, d, d, Dr)`` whose middle axes
+    are the output (ket) and input (bra) indices.  Use :func:`from_array` to
+    create one.
+    """
+
+    def __init__(self, sites, tensors):
+        sites = _parse_sites(sites)
+        tensors = [ np.asarray(W) for W in tensors ]
+        if len(sites) != len(tensors) or len(sites) == 0:
+            raise HilbertError('need one tensor for each site')
+        for (x, W) in zip(sites, tensors):
+            if W.ndim != 4 or W.shape[1:3] != (x.dim(), x.dim()):
+                raise HilbertShapeError(W.shape, (None, x.dim(), x.dim(), None))
+        self.sites = sites
+        self.tensors = tensors
+
+    @classmethod
+    def from_array(cls, op, sites=None, max_bond=None, cutoff=1e-14):
+        """
+        Converts a dense operator to an MPO.
+
+        >>> from qitensor import qubit, cnot, MPO
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> U = cnot(ha, hb) * hc.X
+        >>> W = MPO.from_array(U)
+        >>> W
+        MPO(3 sites, max bond 2)
+        >>> W.to_array().closeto(U)
+        True
+        """
+
+        if sites is None:
+            sites = op.space.ket_space().sorted_kets
+        sites = _parse_sites(sites)
+        n = len(sites)
+
+        # interleave the axes as (out_1, in_1, out_2, in_2, ...)
+        G = _operator_tensor(op, sites)
+        G = G.transpose(sum([ [k, k+n] for k in range(n) ], []))
+
+        tensors = []
+        rest = G.reshape(1, -1)
+        for x in sites[:-1]:
+            Dl = rest.shape[0]
+            d = x.dim()
+            (U, rest, _) = _split(rest.reshape(Dl*d*d, -1), max_bond, cutoff)
+            tensors.append(U.reshape(Dl, d, d, -1))
+        d = sites[-1].dim()
+        tensors.append(rest.reshape(-1, d, d, 1))
+        return cls(sites, tensors)
+
+    def __repr__(self):
+        return 'MPO(%d sites, max bond %d)' % (len(self.sites),
+            max([1] + [ W.shape[3] for W in self.tensors[:-1] ]))
+
+    @property
+    def space(self):
+        """The HilbertSpace on which this operator acts (``|sites><sites|``)."""
+        return create_space1(self.sites).O
+
+    def to_array(self):
+        """Converts to a dense ``HilbertArray``.  Only possible for small chains."""
+
+        data = self.tensors[0]
+        for W in self.tensors[1:]:
+            data = np.tensordot(data, W, axes=1)
+        data = data.reshape(data.shape[1:-1])
+        # axes are now (out_1, in_1, out_2, in_2, ...)
+        axes = sum([ [x, x.H] for x in self.sites ], [])
+        return self.space.array_from_buffer(data, input_axes=axes)
+
+    def apply(self, psi, max_bond=None, cutoff=1e-14):
+        """
+        Applies this operator to an :class:`MPS`, returning a new MPS
+        compressed according to ``max_bond`` and ``cutoff``.
+
+        >>> from qitensor import qubit, cnot, MPS, MPO
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> U = cnot(ha, hb) * hc.X
+        >>> psi = (ha*hb*hc).random_array()
+        >>> MPO.from_array(U).apply(MPS.from_array(psi)).to_array().closeto(U * psi)
+        True
+        """
+
+        if self.sites != psi.sites:
+            raise MismatchedSpaceError('MPO and MPS are on different chains: '+
+                repr(self.space)+' vs. '+repr(psi.space))
+        tensors = []
+        for (W, A) in zip(self.tensors, psi.tensors):
+            B = np.einsum('aoib,lir->alobr', W, A)
+            s = B.shape
+            tensors.append(B.reshape(s[0]*s[1], s[2], s[3]*s[4]))
+        ret = MPS(psi.sites, tensors)
+        ret.truncation_error = psi.truncation_error
+        return ret.compress(max_bond, cutoff)
+
+    def __mul__(self, other):
+        if isinstance(other, MPS):
+            return self.apply(other)
+        return NotImplemented
+
+    def expectation(self, psi):
+        """
+        Returns ``<psi|W|psi>``.  The sites of this MPO may be any
+        subsequence of the chain of ``psi``, with the identity acting on the
+        other sites.
+
+        >>> from qitensor import qubit, MPS, MPO
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> H = ha.Z * hb.Z * hc.eye() + ha.eye() * hb.X * hc.X
+        >>> psi = (ha*hb*hc).random_array().normalized()
+        >>> abs(MPO.from_array(H).expectation(MPS.from_array(psi)) - psi.H * H * psi) < 1e-12
+        True
+        """
+
+        pos = [ psi.sites.index(x) if x in psi.sites else -1 for x in self.sites ]
+        if -1 in pos or pos != sorted(pos):
+            raise MismatchedSpaceError('MPO sites are not a subsequence of the MPS chain: '+
+                repr(self.space)+' vs. '+repr(psi.space))
+        ops = dict(zip(pos, self.tensors))
+
+        # E[bra bond, mpo bond, ket bond]
+        E = np.ones((1, 1, 1))
+        for (i, A) in enumerate(psi.tensors):
+            E = np.tensordot(E, A.conj(), axes=([0], [0]))          # w k o a'
+            W = ops.get(i)
+            if W is None:
+                # identity on this site, the MPO bond passes through
+                E = np.tensordot(E, A, axes=([1, 2], [0, 1]))       # w a' k'
+                E = E.transpose(1, 0, 2)
+            else:
+                E = np.tensordot(E, W, axes=([0, 2], [0, 1]))       # k a' i w'
+                E = np.tensordot(E, A, axes=([0, 2], [0, 1]))       # a' w' k'
+        return E[0, 0, 0]
@@ -54,6 +54,9 @@ cdef class SageHilbertBaseField(HilbertBaseField):
     cpdef input_cast_function(self):
         return self.sage_ring
 
+    cpdef np.ndarray cast_array(self, np.ndarray arr):
+        return np.vectorize(self.sage_ring, otypes=[self.dtype])(arr)
+
     cpdef fractional_phase(self, int a, int b):
         return self.sage_ring(sage.all.exp(2 * sage.all.pi * sage.all.I * a / b))
 
@@ -69,6 +72,9 @@ cdef class SageHilbertBaseField(HilbertBaseField):
     cpdef xlog2x(self, x):
         return self.sage_ring(0 if x<=0 else x*sage.all.log(x)/sage.all.log2)
 
+    cpdef spectrum_entropy(self, np.ndarray p):
+        return sum([-self.xlog2x(x) for x in p])
+
     cpdef np.ndarray eye(self, long size):
         return np.array(sage.all.identity_matrix(self.sage_ring, size), dtype=self.dtype)
 
@@ -0,0 +1,244 @@
+"""
+Reproducible random sampling of states, unitaries and density operators.
+
+The ``random_*`` methods of ``HilbertSpace`` draw one sample per call.  A
+:class:`RandomSampler` instead draws ``n`` samples per call, returned as a
+:class:`BatchedHilbertArray` and computed with stacked LAPACK calls, from an
+explicit ``numpy.random.Generator``.  Independent streams for parallel
+workers are created with :func:`RandomSampler.spawn`, so that Monte-Carlo
+computations give the same results regardless of how the work is split up.
+
+>>> import numpy as np
+>>> from qitensor import qubit, RandomSampler
+>>> ha = qubit('a')
+>>> hb = qubit('b')
+>>> rhos = RandomSampler(1234).density_hs(ha*hb, 1000)
+>>> rhos
+BatchedHilbertArray(1000, |a,b><a,b|)
+>>> workers = RandomSampler(1234).spawn(4)
+>>> parts = [ w.density_hs(ha*hb, 250).trace(hb).entropy() for w in workers ]
+>>> again = [ w.density_hs(ha*hb, 250).trace(hb).entropy()
+...     for w in RandomSampler(1234).spawn(4) ]
+>>> np.array_equal(np.concatenate(parts), np.concatenate(again))
+True
+"""
+
+import numpy as np
+
+from qitensor import HilbertError, HilbertShapeError
+from qitensor.batched import BatchedHilbertArray
+from qitensor.space import _ginibre
+
+__all__ = ['RandomSampler']
+
+class RandomSampler(object):
+    """
+    Draws random arrays from a ``numpy.random.Generator``.
+
+    Each sampling method takes a space and a number of samples ``n``.  If
+    ``n`` is given, a :class:`BatchedHilbertArray` of ``n`` samples is
+    returned; otherwise a single ``HilbertArray`` is returned.  Operator
+    spaces follow the same conventions as the corresponding ``HilbertSpace``
+    methods: a ket or bra space ``x`` stands for ``x.O``.
+
+    :param rng: a numpy random Generator, a seed for one, or None for a fresh
+        unpredictable seed
+
+    >>> from qitensor import qubit, RandomSampler
+    >>> ha = qubit('a')
+    >>> U = RandomSampler(5).unitary(ha, 3)
+    >>> U
+    BatchedHilbertArray(3, |a><a|)
+    >>> (U.H * U).closeto(ha.eye())
+    True
+    >>> RandomSampler(5).unitary(ha, 3).closeto(U)
+    True
+    """
+
+    def __init__(self, rng=None):
+        if isinstance(rng, RandomSampler):
+            rng = rng.rng
+        #: The ``numpy.random.Generator`` used for all draws.
+        self.rng = np.random.default_rng(rng)
+
+    def __repr__(self):
+        return 'RandomSampler('+repr(self.rng)+')'
+
+    def spawn(self, n):
+        """
+        Returns ``n`` new samplers whose streams are statistically
+        independent of each other and of this sampler, for use by parallel
+        workers.  The streams are derived from this sampler's seed, so
+        spawning is reproducible.
+
+        >>> from qitensor import qubit, RandomSampler
+        >>> ha = qubit('a')
+        >>> (s1, s2) = RandomSampler(0).spawn(2)
+        >>> s1.array(ha) == s2.array(ha)
+        False
+        >>> RandomSampler(0).spawn(2)[1].array(ha) == s2.array(ha)
+        False
+        >>> RandomSampler(0).spawn(2)[1].array(ha) == RandomSampler(0).spawn(2)[1].array(ha)
+        True
+        """
+
+        if hasattr(self.rng, 'spawn'):
+            # numpy >= 1.25
+            return [ RandomSampler(g) for g in self.rng.spawn(n) ]
+        bitgen = self.rng.bit_generator
+        return [ RandomSampler(np.random.Generator(type(bitgen)(seq)))
+            for seq in bitgen._seed_seq.spawn(n) ]
+
+    def _count(self, n):
+        return 1 if n is None else n
+
+    def _wrap(self, space, n, data):
+        """
+        Wraps a stack of samples laid out as ``(n,) + space.shape`` (or a
+        stack of matrices with kets for rows and bras for columns).
+        """
+
+        data = data.reshape((self._count(n),) + space.shape)
+        if n is None:
+            return space.array_from_buffer(data[0])
+        return BatchedHilbertArray(space, data)
+
+    def _haar_matrices(self, m, rows, cols):
+        """
+        Returns ``m`` Haar random isometries of shape ``(rows, cols)``, from
+        the thin QR decomposition of Gaussian matrices with the phases of the
+        diagonal of R moved into Q (Mezzadri's algorithm).
+        """
+
+        (q, r) = np.linalg.qr(_ginibre(self.rng, (m, rows, cols)))
+        d = np.diagonal(r, axis1=1, axis2=2)
+        return q * (d / np.abs(d))[:, np.newaxis, :]
+
+    def _density_space(self, spc):
+        if len(spc.ket_set) == 0:
+            spc = spc.H
+        if len(spc.bra_set) > 0 and spc.bra_set != spc.H.bra_set:
+            raise HilbertError('not a symmetric operator space: '+str(spc))
+        return spc.ket_space()
+
+    def array(self, spc, n=None):
+        """
+        Returns arrays with entries drawn from the complex standard normal
+        distribution, like :func:`HilbertSpace.random_array`.
+        """
+
+        return self._wrap(spc, n, _ginibre(self.rng, (self._count(n),) + spc.shape))
+
+    def state(self, spc, n=None):
+        """
+        Returns Haar random pure states (normalized kets).
+
+        >>> from qitensor import qudit, RandomSampler
+        >>> ha = qudit('a', 5)
+        >>> psi = RandomSampler(0).state(ha, 10)
+        >>> psi.norm().round(12).tolist() == [1.0] * 10
+        True
+        """
+
+        spc = spc.ket_space()
+        m = self._count(n)
+        v = _ginibre(self.rng, (m, spc.dim()))
+        v /= np.linalg.norm(v, axis=1)[:, np.newaxis]
+        return self._wrap(spc, n, v)
+
+    def unitary(self, spc, n=None):
+        """
+        Returns Haar random unitaries, like :func:`HilbertSpace.random_unitary`.
+        """
+
+        if len(spc.ket_set) == 0 or len(spc.bra_set) == 0:
+            spc = spc.O
+        spc.assert_square()
+        return self.isometry(spc, n)
+
+    def isometry(self, spc, n=None):
+        """
+        Returns Haar random isometries from the bra space to the ket space of
+        ``spc``, like :func:`HilbertSpace.random_isometry`.  They are computed
+        directly by thin QR decompositions, without forming a unitary on the
+        ket space.
+
+        >>> from qitensor import qubit, qudit, RandomSampler
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 7)
+        >>> V = RandomSampler(0).isometry(hb*ha.H, 4)
+        >>> (V.H * V).closeto(ha.eye())
+        True
+        """
+
+        if len(spc.ket_set) == 0 or len(spc.bra_set) == 0:
+            raise HilbertError('not an operator space: '+str(spc))
+        dk = spc.ket_space().dim()
+        db = spc.bra_space().dim()
+        if dk < db:
+            raise HilbertShapeError(dk, db)
+        return self._wrap(spc, n, self._haar_matrices(self._count(n), dk, db))
+
+    def density_hs(self, spc, n=None, rank=None):
+        """
+        Returns random density operators from the Hilbert-Schmidt ensemble,
+        or with ``rank`` given, the ensemble induced by partial tracing a
+        Haar random pure state with an environment of dimension ``rank``.
+
+        >>> from qitensor import qudit, RandomSampler
+        >>> ha = qudit('a', 4)
+        >>> rho = RandomSampler(0).density_hs(ha, 5, rank=2)
+        >>> np.allclose(rho.trace(), 1)
+        True
+        >>> [ int(np.sum(rho[i].eigvals(hermit=True) > 1e-12)) for i in range(5) ]
+        [2, 2, 2, 2, 2]
+        """
+
+        spc = self._density_space(spc)
+        d = spc.dim()
+        k = d if rank is None else rank
+        m = self._count(n)
+        g = _ginibre(self.rng, (m, d, k))
+        rho = np.matmul(g, np.conj(np.swapaxes(g, 1, 2)))
+        rho /= np.trace(rho, axis1=1, axis2=2)[:, np.newaxis, np.newaxis]
+        return self._wrap(spc.O, n, rho)
+
+    def density_bures(self, spc, n=None):
+        """
+        Returns random density operators from the Bures ensemble, obtained
+        as ``(1 + U) G G^dagger (1 + U^dagger)`` (normalized), with ``U`` a
+        Haar random unitary and ``G`` a Gaussian matrix.
+
+        >>> from qitensor import qudit, RandomSampler
+        >>> ha = qudit('a', 3)
+        >>> rho = RandomSampler(0).density_bures(ha, 5)
+        >>> np.allclose(rho.trace(), 1)
+        True
+        >>> rho.H.closeto(rho)
+        True
+        """
+
+        spc = self._density_space(spc)
+        d = spc.dim()
+        m = self._count(n)
+        a = self._haar_matrices(m, d, d)
+        a[:, np.arange(d), np.arange(d)] += 1
+        a = np.matmul(a, _ginibre(self.rng, (m, d, d)))
+        rho = np.matmul(a, np.conj(np.swapaxes(a, 1, 2)))
+        rho /= np.trace(rho, axis1=1, axis2=2)[:, np.newaxis, np.newaxis]
+        return self._wrap(spc.O, n, rho)
+
+    def povm_element(self, spc, n=None):
+        """
+        Returns random POVM elements (positive operators with eigenvalues
+        bounded by one), distributed like those of
+        :func:`HilbertSpace.random_povm_element`.
+        """
+
+        spc = self._density_space(spc)
+        d = spc.dim()
+        m = self._count(n)
+        eig = self.rng.random((m, d))
+        u = self._haar_matrices(m, d, d)
+        E = np.matmul(u * eig[:, np.newaxis, :], np.conj(np.swapaxes(u, 1, 2)))
+        return self._wrap(spc.O, n, E)
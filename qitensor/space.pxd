@@ -35,11 +35,12 @@ cdef class HilbertSpace(object):
     cpdef HilbertArray diag(self, v)
     cpdef reshaped_np_matrix(self, m, input_axes=*)
     cpdef array(self, data=*, cpython.bool noinit_data=*, cpython.bool reshape=*, input_axes=*)
-    cpdef HilbertArray random_array(self)
-    cpdef HilbertArray random_unitary(self)
-    cpdef HilbertArray random_isometry(self)
-    cpdef HilbertArray random_density(self)
-    cpdef HilbertArray random_povm_element(self)
+    cpdef array_from_buffer(self, nd, cpython.bool copy=*, cpython.bool reshape=*, input_axes=*)
+    cpdef HilbertArray random_array(self, rng=*)
+    cpdef HilbertArray random_unitary(self, rng=*)
+    cpdef HilbertArray random_isometry(self, rng=*)
+    cpdef HilbertArray random_density(self, rng=*)
+    cpdef HilbertArray random_povm_element(self, rng=*)
     cpdef HilbertArray eye(self)
     cpdef HilbertArray fully_mixed(self)
     cpdef basis_vec(self, idx)
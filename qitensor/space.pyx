@@ -6,6 +6,7 @@ multiplication operator to HilbertAtoms or other HilbertSpaces.
 """
 
 import numpy as np
+cimport numpy as cnp
 import itertools
 import operator
 import functools
@@ -16,6 +17,7 @@ from qitensor import have_sage
 from qitensor.exceptions import DuplicatedSpaceError, HilbertError, \
     MismatchedSpaceError, HilbertShapeError, NotKetSpaceError
 import qitensor.atom
+import qitensor.array
 from qitensor.arrayformatter import FORMATTER
 from qitensor.subspace import TensorSubspace
 from qitensor.array import HilbertArray
@@ -23,20 +25,8 @@ from qitensor.array cimport HilbertArray
 
 __all__ = ['HilbertSpace']
 
-# helper function for hadamard
-cdef int _countbits(int i):
-    """
-    Count the number of set bits.
-
-    >>> _countbits(0xfeedf00d)
-    FIXME - doctest doesn't run?
-    """
-
-    cdef int n = 0
-    while i:
-        n += i & 1
-        i >>= 1
-    return n
+# typed ndarray attributes compile to NumPy C-API calls
+cnp.import_array()
 
 # helper function for hadamard
 cdef int _int_log2(int i):
@@ -151,6 +141,25 @@ cpdef long _shape_product(l):
 
 ########################################
 
+def _ginibre(rng, shape):
+    """
+    Returns complex numbers drawn from a standard normal distribution, using
+    the numpy random Generator ``rng``.
+    """
+
+    return (rng.standard_normal(size=shape) +
+        rng.standard_normal(size=shape)*1j) / np.sqrt(2)
+
+def _random_unit(rng, size):
+    """
+    Returns numbers uniformly distributed in [0, 1), from ``rng`` if it is
+    given or else from the global numpy random state.
+    """
+
+    if rng is None:
+        return np.random.rand(size)
+    return np.random.default_rng(rng).random(size)
+
 cdef class HilbertSpace:
     def __init__(self, ket_set, bra_set, _H=None):
         """
@@ -762,22 +771,119 @@ cdef class HilbertSpace:
 
         return HilbertArray(self, data, noinit_data, reshape, input_axes)
 
-    cpdef HilbertArray random_array(self):
+    cpdef array_from_buffer(self, nd, cpython.bool copy=False, cpython.bool reshape=False, input_axes=None):
+        """
+        Returns a ``HilbertArray`` wrapping an existing numpy array.
+
+        Unlike :func:`array`, which always copies its input, this adopts ``nd``
+        as the underlying storage whenever possible: if the dtype already
+        matches the base field then no copy is made and the returned array is
+        a view of ``nd`` (so writes to one show up in the other).  Pass
+        ``copy=True`` to get an independent array.  The ``reshape`` and
+        ``input_axes`` parameters have the same meaning as for :func:`array`;
+        reshaping a non-contiguous array or casting the dtype will make a copy.
+
+        This is useful for handing buffers produced by numpy or by other
+        libraries to qitensor without paying for a copy and elementwise cast.
+
+        :param nd: the input data
+        :type nd: numpy.ndarray
+        :param copy: if true, always copy the input data
+        :type copy: bool; default False
+        :param reshape: if true, the input is reshaped as needed
+        :type reshape: bool; default False
+        :param input_axes: tells how the axes map to the space
+        :type input_axes: tuple of HilbertAtoms
+
+        See also: :func:`array`
+
+        >>> import numpy
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> buf = numpy.zeros((2, 3), dtype=complex)
+        >>> x = (ha*hb).array_from_buffer(buf)
+        >>> x.nparray is buf
+        True
+        >>> buf[1, 2] = 5
+        >>> x[1, 2]
+        (5+0j)
+
+        >>> y = (ha*hb).array_from_buffer(buf, copy=True)
+        >>> numpy.may_share_memory(y.nparray, buf)
+        False
+
+        >>> z = (ha*hb.H).array_from_buffer(buf.T, input_axes=(hb.H, ha))
+        >>> z.nparray.base is buf
+        True
+        >>> z[{ ha: 1, hb.H: 2 }]
+        (5+0j)
+
+        >>> ha.O.array_from_buffer(numpy.arange(4), reshape=True)
+        HilbertArray(|a><a|,
+        array([[ 0.+0.j,  1.+0.j],
+               [ 2.+0.j,  3.+0.j]]))
+        >>> ha.O.array_from_buffer(numpy.zeros(4, dtype=complex), reshape=True).space
+        |a><a|
+        >>> ha.O.array_from_buffer(numpy.arange(3), reshape=True)
+        Traceback (most recent call last):
+            ...
+        HilbertShapeError: '3 vs. 4'
+        """
+
+        cdef np.ndarray arr = np.asarray(nd)
+        cdef tuple data_shape
+
+        if input_axes is None:
+            data_shape = self.shape
+        else:
+            data_shape = tuple([ len(spc.indices) for spc in input_axes ])
+
+        if reshape:
+            if arr.size != _shape_product(data_shape):
+                raise HilbertShapeError(arr.size, _shape_product(data_shape))
+            arr = arr.reshape(data_shape)
+        if np.shape(arr) != data_shape:
+            raise HilbertShapeError(np.shape(arr), data_shape)
+
+        if input_axes is not None:
+            if frozenset(input_axes) != frozenset(self.axes):
+                raise MismatchedSpaceError("input_axes doesn't match array space")
+            arr = arr.transpose([ input_axes.index(x) for x in self.axes ])
+
+        arr = self.base_field.cast_array(arr)
+        if copy and np.may_share_memory(arr, nd):
+            arr = arr.copy()
+
+        cdef HilbertArray ret = self.array(None, True)
+        ret.nparray = arr
+        return ret
+
+    cpdef HilbertArray random_array(self, rng=None):
         """
         Returns a ``HilbertArray`` with random values.
 
         The values are complex numbers drawn from a standard normal distribution.
 
+        :param rng: a numpy random Generator, or a seed for one.  If not
+            given, the global numpy random state is used.  See also
+            :class:`qitensor.sampling.RandomSampler`, which draws many samples
+            at once.
+
         >>> from qitensor import qubit
         >>> ha = qubit('a')
         >>> ha.random_array() # doctest: +SKIP
         HilbertArray(|a>,
         array([-0.484410+0.426767j,  0.000693+0.912554j]))
-
+        >>> ha.random_array(rng=5) == ha.random_array(rng=5)
+        True
         """
-        return self.array(self.base_field.random_array(self.shape))
 
-    cpdef HilbertArray random_unitary(self):
+        if rng is None:
+            return self.array_from_buffer(self.base_field.random_array(self.shape))
+        return self.array_from_buffer(_ginibre(np.random.default_rng(rng), self.shape))
+
+    cpdef HilbertArray random_unitary(self, rng=None):
         """
         Returns a random unitary.
 
@@ -791,6 +897,8 @@ cdef class HilbertSpace:
         Random Matrices from the Classical Compact Groups", Notices of the AMS
         54, 592 (2007).
 
+        :param rng: a numpy random Generator, or a seed for one
+
         >>> from qitensor import qubit
         >>> ha = qubit('a')
         >>> hb = qubit('b')
@@ -811,23 +919,23 @@ cdef class HilbertSpace:
         """
 
         if len(self.ket_set) == 0 or len(self.bra_set) == 0:
-            return (self * self.H).random_unitary()
+            return (self * self.H).random_unitary(rng)
 
         self.assert_square()
 
-        z = self.random_array().as_np_matrix()
-        (q, r) = self.base_field.mat_qr(z)
-        d = np.diag(r)
-        ph = d/np.abs(d)
-        ret = np.multiply(q, ph)
-        return self.reshaped_np_matrix(ret)
+        return self.random_isometry(rng)
 
-    cpdef HilbertArray random_isometry(self):
+    cpdef HilbertArray random_isometry(self, rng=None):
         """
-        Returns a random isometry.
+        Returns a random isometry, distributed uniformly with respect to the
+        Haar measure.  It is computed directly from the thin QR decomposition
+        of a random matrix of the shape of the isometry, as in
+        :func:`random_unitary`.
 
         The ket space must be at least as great in dimension as the bra space.
 
+        :param rng: a numpy random Generator, or a seed for one
+
         >>> from qitensor import qubit, qudit
 
         >>> ha = qubit('a')
@@ -849,14 +957,21 @@ cdef class HilbertSpace:
         if dk < db:
             raise HilbertShapeError(dk, db)
 
-        U = self.ket_space().O.random_unitary()
-        iso = U.as_np_matrix()[:, :db]
-        return self.reshaped_np_matrix(iso)
+        z = self.random_array(rng).as_np_matrix()
+        (q, r) = self.base_field.mat_qr(z)
+        d = np.diag(r)
+        ph = d/np.abs(d)
+        ret = np.multiply(q, ph)
+        return self.reshaped_np_matrix(ret)
 
-    cpdef HilbertArray random_density(self):
+    cpdef HilbertArray random_density(self, rng=None):
         """
         Returns a random density matrix (positive matrix with unit trace).
 
+        :param rng: a numpy random Generator, or a seed for one.  See
+            :class:`qitensor.sampling.RandomSampler` for the Hilbert-Schmidt
+            and Bures ensembles.
+
         >>> from qitensor import qubit, qudit
 
         >>> ha = qubit('a')
@@ -879,21 +994,29 @@ cdef class HilbertSpace:
         """
 
         if len(self.ket_set) == 0:
-            return self.H.random_density()
+            return self.H.random_density(rng)
         if len(self.bra_set) > 0 and self.bra_set != self.H.bra_set:
             raise HilbertError('not a symmetric operator space: '+str(self))
 
+        from qitensor.diagonal import DiagonalHilbertArray
+
+        if rng is not None:
+            # draw everything from a single stream, even when given a seed
+            rng = np.random.default_rng(rng)
         ket_spc = self.ket_space()
-        eig = np.random.rand(ket_spc.dim())
+        eig = _random_unit(rng, ket_spc.dim())
         eig /= np.sum(eig)
-        U = ket_spc.random_unitary()
-        return U * ket_spc.diag(eig) * U.H
+        U = ket_spc.random_unitary(rng)
+        # U * W only needs to scale the columns of U
+        return U * DiagonalHilbertArray(ket_spc, eig) * U.H
 
-    cpdef HilbertArray random_povm_element(self):
+    cpdef HilbertArray random_povm_element(self, rng=None):
         """
         Returns a random POVM element (positive matrix with eigenvalues bounded
         by one).
 
+        :param rng: a numpy random Generator, or a seed for one
+
         >>> from qitensor import qubit, qudit
 
         >>> ha = qubit('a')
@@ -916,14 +1039,19 @@ cdef class HilbertSpace:
         """
 
         if len(self.ket_set) == 0:
-            return self.H.random_density()
+            return self.H.random_povm_element(rng)
         if len(self.bra_set) > 0 and self.bra_set != self.H.bra_set:
             raise HilbertError('not a symmetric operator space: '+str(self))
 
+        from qitensor.diagonal import DiagonalHilbertArray
+
+        if rng is not None:
+            # draw everything from a single stream, even when given a seed
+            rng = np.random.default_rng(rng)
         ket_spc = self.ket_space()
-        eig = np.random.rand(ket_spc.dim())
-        U = ket_spc.random_unitary()
-        return U * ket_spc.diag(eig) * U.H
+        eig = _random_unit(rng, ket_spc.dim())
+        U = ket_spc.random_unitary(rng)
+        return U * DiagonalHilbertArray(ket_spc, eig) * U.H
 
     cpdef HilbertArray eye(self):
         """
@@ -959,7 +1087,10 @@ cdef class HilbertSpace:
 
         bra_size = self.assert_square()
 
-        return self.array(self.base_field.eye(bra_size), reshape=True)
+        return qitensor.array._cached_operator(('eye', self), self._build_eye, bra_size)
+
+    def _build_eye(self, bra_size):
+        return self.array_from_buffer(self.base_field.eye(bra_size), reshape=True)
 
     cpdef HilbertArray fully_mixed(self):
         """
@@ -986,6 +1117,9 @@ cdef class HilbertSpace:
         if self.bra_set != self.H.bra_set:
             raise HilbertError('not a symmetric operator space: '+str(self))
 
+        return qitensor.array._cached_operator(('fully_mixed', self), self._build_fully_mixed)
+
+    def _build_fully_mixed(self):
         return self.eye() / self.ket_space().dim()
 
     cpdef basis_vec(self, idx):
@@ -1046,7 +1180,58 @@ cdef class HilbertSpace:
         True
         """
 
-        return [ self.basis_vec(idx) for idx in self.index_iter() ]
+        return [ self.array_from_buffer(v) for v in self.basis_stack() ]
+
+    def basis_iter(self):
+        """
+        Iterates over the computational basis of this space, in the order of
+        :func:`index_iter`, without holding more than one basis vector in
+        memory.
+
+        All of the yielded arrays share a single buffer, which is updated in
+        place as the iteration proceeds, so each one is only valid until the
+        next is requested.  The arrays are write-protected (modifying one
+        makes a private copy); use ``copy()`` to keep a basis vector.
+
+        >>> from qitensor import qubit, indexed_space
+        >>> ha = qubit('a')
+        >>> hc = indexed_space('c', ['x', 'y', 'z'])
+        >>> spc = ha*hc.H
+        >>> all(x == y for (x, y) in zip(spc.basis_iter(), spc.basis()))
+        True
+        >>> [ x.copy() for x in ha.basis_iter() ] == [ ha.ket(0), ha.ket(1) ]
+        True
+        """
+
+        buf = self.array().nparray
+        flat = buf.reshape(-1)
+        view = buf.view()
+        view.flags.writeable = False
+        for i in range(flat.size):
+            flat[i] = 1
+            yield self.array_from_buffer(view)
+            flat[i] = 0
+
+    def basis_stack(self):
+        """
+        Returns the computational basis of this space as a single numpy
+        array, with a leading axis running over the basis elements (in the
+        order of :func:`index_iter`) followed by the axes of this space.  This
+        is an identity matrix reshaped, and is a convenient form for passing
+        all of the basis elements to a vectorized function at once.
+
+        >>> from qitensor import qubit, qudit
+        >>> ha = qubit('a')
+        >>> hb = qudit('b', 3)
+        >>> B = (ha*hb).basis_stack()
+        >>> B.shape
+        (6, 2, 3)
+        >>> (ha*hb).array(B[4]) == (ha*hb).basis_vec((1, 1))
+        True
+        """
+
+        cdef long d = self.dim()
+        return np.eye(d, dtype=self.base_field.dtype).reshape((d,)+self.shape)
 
     cpdef hermitian_basis(self, normalize=False, tracefree=False):
         """
@@ -1183,7 +1368,7 @@ cdef class HilbertSpace:
             self.base_field.fractional_phase(i*k, N)
             for i in range(N)], dtype=self.base_field.dtype)
         arr /= self.base_field.sqrt(N)
-        return self.array(data=arr, reshape=True)
+        return self.array_from_buffer(arr, reshape=True)
 
     cpdef HilbertArray fourier(self):
         """
@@ -1230,18 +1415,19 @@ cdef class HilbertSpace:
 
         cdef int N = self.assert_square()
 
-        cdef np.ndarray arr = np.zeros((N, N), dtype=self.base_field.dtype)
-        cdef int j, k
-        for k in range(N):
-            arr[1, k] = self.base_field.fractional_phase(-k, N)
-        for j in range(N):
-            if j == 1: continue
-            for k in range(N):
-                arr[j, k] = arr[1, (j*k)%N]
+        return qitensor.array._cached_operator(('fourier', self), self._build_fourier, N)
+
+    def _build_fourier(self, N):
+        # entry (j, k) is the phase for (j*k)%N, so only N phases need to be
+        # computed
+        phases = np.array([ self.base_field.fractional_phase(-k, N)
+            for k in range(N) ], dtype=self.base_field.dtype)
+        j = np.arange(N)
+        arr = phases[np.outer(j, j) % N]
 
         arr /= self.base_field.sqrt(N)
 
-        return self.array(data=arr, reshape=True)
+        return self.array_from_buffer(arr, reshape=True)
 
     cpdef HilbertArray hadamard(self):
         """
@@ -1275,18 +1461,24 @@ cdef class HilbertSpace:
             return (self * self.H).hadamard()
 
         cdef int N = self.assert_square()
-        if _int_log2(N) < 0:
+        cdef int n = _int_log2(N)
+        if n < 0:
             raise HilbertError("Hadamard matrix only defined if dimension is a power of 2")
 
-        cdef np.ndarray arr = np.zeros((N, N), dtype=self.base_field.dtype)
-        cdef int j, k
-        for j in range(N):
-            for k in range(N):
-                arr[j, k] = -1 if (1 & _countbits(j&k)) else 1
+        return qitensor.array._cached_operator(('hadamard', self), self._build_hadamard, N, n)
+
+    def _build_hadamard(self, N, n):
+        # the sign of entry (j, k) is the parity of the bits of j&k
+        j = np.arange(N)
+        jk = np.bitwise_and.outer(j, j)
+        parity = np.zeros((N, N), dtype=int)
+        for i in range(n):
+            parity ^= (jk >> i) & 1
+        arr = np.array(1 - 2*parity, dtype=self.base_field.dtype)
 
         arr /= self.base_field.sqrt(N)
 
-        return self.array(data=arr, reshape=True)
+        return self.array_from_buffer(arr, reshape=True)
 
     cpdef HilbertArray haar_matrix(self):
         """
@@ -1316,6 +1508,10 @@ cdef class HilbertSpace:
 
         >>> ha.haar_matrix() == ha.O.haar_matrix()
         True
+        >>> qudit('b', 3).haar_matrix()
+        Traceback (most recent call last):
+            ...
+        HilbertError: 'Haar matrix only defined if dimension is a power of 2'
         """
 
         if len(self.ket_set) == 0 or len(self.bra_set) == 0:
@@ -1324,8 +1520,11 @@ cdef class HilbertSpace:
         cdef int N = self.assert_square()
         cdef int n = _int_log2(N)
         if n < 0:
-            raise HilbertShapeError("Hadamard matrix only defined if dimension is a power of 2")
+            raise HilbertError("Haar matrix only defined if dimension is a power of 2")
+
+        return qitensor.array._cached_operator(('haar_matrix', self), self._build_haar_matrix, N, n)
 
+    def _build_haar_matrix(self, int N, int n):
         cdef np.ndarray arr = np.zeros((N, N), dtype=self.base_field.dtype)
 
         arr[0,:] = 1 / self.base_field.sqrt(N)
@@ -1342,7 +1541,7 @@ cdef class HilbertSpace:
                 row += 1
                 col += step+step
 
-        return self.array(data=arr, reshape=True)
+        return self.array_from_buffer(arr, reshape=True)
 
     cpdef full_space(self):
         """
@@ -0,0 +1,453 @@
+"""
+A SparseHilbertArray is an operator (or vector) on a HilbertSpace whose data is
+stored as a ``scipy.sparse`` matrix.  The matrix has one row for each basis
+element of the ket space and one column for each basis element of the bra
+space, in the same order as :func:`HilbertArray.as_np_matrix`.  The space
+semantics are the same as for ``HilbertArray``: multiplication contracts the
+bra space of the left factor with the ket space of the right factor, and
+sparse and dense arrays can be mixed.
+
+This is useful for gates such as those from :mod:`qitensor.circuit`, which are
+mostly zeros, on registers that are too large for the dense ``d^2`` tensor.
+
+>>> import numpy as np
+>>> from qitensor import qubit, cnot, SparseHilbertArray
+>>> ha = qubit('a')
+>>> hb = qubit('b')
+>>> U = cnot(ha, hb, sparse=True)
+>>> U
+SparseHilbertArray(|a,b><a,b|, nnz=4)
+>>> psi = (ha*hb).random_array()
+>>> (U * psi).closeto(cnot(ha, hb) * psi)
+True
+>>> (U * U).to_dense() == (ha*hb).eye()
+True
+"""
+
+import numpy as np
+import scipy.sparse
+
+from qitensor import HilbertSpace, HilbertArray, HilbertError, \
+    HilbertShapeError, MismatchedSpaceError
+from qitensor.array import _get_td_wisdom, _trace_axes_dict
+from qitensor.space import create_space1, _shape_product
+
+__all__ = ['SparseHilbertArray']
+
+def _unravel(n, atoms):
+    """
+    Converts flat indices over the tensor product of ``atoms`` (in C order)
+    into a list of index arrays, one for each atom.
+    """
+
+    if not atoms:
+        return []
+    return list(np.unravel_index(n, [x.dim() for x in atoms]))
+
+def _ravel(idx, atoms, nnz):
+    """
+    Inverse of :func:`_unravel`: converts a dict of index arrays (keyed by
+    atom) into flat indices over the tensor product of ``atoms``.
+    """
+
+    if not atoms:
+        return np.zeros(nnz, dtype=np.intp)
+    return np.ravel_multi_index([idx[x] for x in atoms], [x.dim() for x in atoms])
+
+def _reindex(mat, row_atoms, col_atoms, new_row_atoms, new_col_atoms):
+    """
+    Returns a CSR matrix with the entries of the sparse matrix ``mat`` (whose
+    rows and columns are indexed by ``row_atoms`` and ``col_atoms``) moved to
+    rows and columns indexed by ``new_row_atoms`` and ``new_col_atoms``.  The
+    new atoms must be a rearrangement of the old ones.
+    """
+
+    if row_atoms == new_row_atoms and col_atoms == new_col_atoms:
+        return mat.tocsr()
+
+    coo = mat.tocoo()
+    idx = dict(zip(row_atoms, _unravel(coo.row, row_atoms)))
+    idx.update(zip(col_atoms, _unravel(coo.col, col_atoms)))
+    shape = (_shape_product([x.dim() for x in new_row_atoms]),
+             _shape_product([x.dim() for x in new_col_atoms]))
+    return scipy.sparse.csr_matrix((coo.data, (
+        _ravel(idx, new_row_atoms, coo.nnz),
+        _ravel(idx, new_col_atoms, coo.nnz))), shape=shape)
+
+def _as_matrix(x, row_atoms, col_atoms):
+    """
+    Returns the data of a SparseHilbertArray or HilbertArray as a matrix with
+    rows indexed by ``row_atoms`` and columns by ``col_atoms``.  The result is
+    sparse for a SparseHilbertArray and a dense ndarray for a HilbertArray.
+    """
+
+    if isinstance(x, SparseHilbertArray):
+        return _reindex(x._matrix, x._space.sorted_kets, x._space.sorted_bras,
+            row_atoms, col_atoms)
+    else:
+        shape = (_shape_product([a.dim() for a in row_atoms]),
+                 _shape_product([a.dim() for a in col_atoms]))
+        axes = [x.get_dim(a) for a in row_atoms + col_atoms]
+        return x.nparray.transpose(axes).reshape(shape)
+
+def _product(left, right):
+    """
+    Contracts the bra space of ``left`` with the ket space of ``right``, where
+    at least one of them is a SparseHilbertArray.  The result is sparse if
+    both inputs are sparse, and dense otherwise.
+    """
+
+    hs = left.space
+    ohs = right.space
+    hs.base_field.assert_same(ohs.base_field)
+
+    # validates the spaces and computes the output space
+    wisdom = _get_td_wisdom(hs, ohs, None)
+
+    mul = sorted(frozenset([x.H for x in hs.bra_set]) & ohs.ket_set)
+    mul_H = [x.H for x in mul]
+    row_atoms = hs.sorted_kets + [x for x in hs.sorted_bras if not x in mul_H]
+    col_atoms = [x for x in ohs.sorted_kets if not x in mul] + ohs.sorted_bras
+
+    L = _as_matrix(left, row_atoms, mul_H)
+    R = _as_matrix(right, mul, col_atoms)
+
+    if isinstance(right, SparseHilbertArray):
+        # sparse.T * dense.T avoids relying on ndarray/spmatrix dispatch
+        P = (R.T * L.T).T
+    else:
+        P = L * R
+
+    if wisdom.out_num_axes == 0:
+        if scipy.sparse.issparse(P):
+            P = P.toarray()
+        return np.asarray(P)[0, 0]
+
+    ret_space = wisdom.ret_space
+    if scipy.sparse.issparse(P):
+        return SparseHilbertArray(ret_space, _reindex(P, row_atoms, col_atoms,
+            ret_space.sorted_kets, ret_space.sorted_bras))
+    else:
+        P = np.asarray(P).reshape([x.dim() for x in row_atoms + col_atoms])
+        return ret_space.array_from_buffer(P, input_axes=row_atoms + col_atoms)
+
+class SparseHilbertArray(object):
+    """
+    An array on a ``HilbertSpace`` stored as a sparse (ket x bra) matrix.
+
+    Use :func:`from_array`, :func:`from_coo` or :func:`HilbertArray.to_sparse`
+    to create one, or pass ``sparse=True`` to the constructors in
+    :mod:`qitensor.circuit`.  Only numeric (not symbolic) base fields are
+    supported.
+    """
+
+    # make numpy defer to our reflected operators
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, space, matrix):
+        """
+        Wraps a sparse matrix (or anything ``scipy.sparse.csr_matrix``
+        accepts) whose rows are indexed by the ket space and columns by the
+        bra space of ``space``.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, SparseHilbertArray
+        >>> ha = qubit('a')
+        >>> SparseHilbertArray(ha.O, np.eye(2)).to_dense() == ha.eye()
+        True
+        >>> SparseHilbertArray(ha, np.eye(2))
+        Traceback (most recent call last):
+            ...
+        HilbertShapeError: '(2, 2) vs. (2, 1)'
+        """
+
+        if not isinstance(space, HilbertSpace):
+            raise TypeError('space must be a HilbertSpace')
+        if space.base_field.dtype == object:
+            raise HilbertError('sparse arrays require a numeric base field')
+
+        shape = (_shape_product([x.dim() for x in space.sorted_kets]),
+                 _shape_product([x.dim() for x in space.sorted_bras]))
+        matrix = scipy.sparse.csr_matrix(matrix, dtype=space.base_field.dtype)
+        if matrix.shape != shape:
+            raise HilbertShapeError(matrix.shape, shape)
+
+        self._space = space
+        self._matrix = matrix
+
+    @classmethod
+    def from_array(cls, arr):
+        """
+        Converts a ``HilbertArray`` to sparse form.  Same as
+        :func:`HilbertArray.to_sparse`.
+
+        >>> from qitensor import qubit, SparseHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = SparseHilbertArray.from_array(ha.X * hb.Z)
+        >>> x.nnz
+        4
+        >>> x.to_dense() == ha.X * hb.Z
+        True
+        """
+
+        return cls(arr.space, scipy.sparse.csr_matrix(arr.as_np_matrix()))
+
+    @classmethod
+    def from_coo(cls, space, data, idx):
+        """
+        Creates a sparse array from a list of nonzero entries.
+
+        :param data: the values of the entries
+        :param idx: a dict mapping each HilbertAtom of ``space`` (both bras
+            and kets) to an array giving the integer index of each entry
+            along that atom.  Repeated entries are summed.
+
+        >>> from qitensor import qubit, SparseHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = SparseHilbertArray.from_coo(ha*hb.H, [1, 2], { ha: [0, 1], hb.H: [1, 1] })
+        >>> x.to_dense() == (ha*hb.H).array([[0, 1], [0, 2]])
+        True
+        """
+
+        data = np.asarray(data)
+        idx = dict([ (k, np.asarray(v, dtype=np.intp)) for (k, v) in idx.items() ])
+        missing = space.bra_ket_set - frozenset(idx.keys())
+        if missing:
+            raise HilbertError('no indices given for '+repr(sorted(missing)))
+        shape = (_shape_product([x.dim() for x in space.sorted_kets]),
+                 _shape_product([x.dim() for x in space.sorted_bras]))
+        n = len(data)
+        mat = scipy.sparse.coo_matrix((data, (
+            _ravel(idx, space.sorted_kets, n),
+            _ravel(idx, space.sorted_bras, n))), shape=shape)
+        return cls(space, mat)
+
+    @property
+    def space(self):
+        """The HilbertSpace of this array."""
+        return self._space
+
+    @property
+    def matrix(self):
+        """The underlying ``scipy.sparse.csr_matrix``."""
+        return self._matrix
+
+    @property
+    def nnz(self):
+        """The number of stored entries."""
+        return self._matrix.nnz
+
+    def __repr__(self):
+        return 'SparseHilbertArray(%r, nnz=%d)' % (self._space, self._matrix.nnz)
+
+    def copy(self):
+        """Returns a copy of this array."""
+        return SparseHilbertArray(self._space, self._matrix.copy())
+
+    def to_dense(self):
+        """
+        Returns this array as a ``HilbertArray``.
+
+        >>> from qitensor import qubit, cphase
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> cphase(ha, hb, sparse=True).to_dense() == cphase(ha, hb)
+        True
+        """
+
+        return self._space.reshaped_np_matrix(self._matrix.toarray())
+
+    def _coo(self):
+        """
+        Returns ``(data, idx)`` in the format taken by :func:`from_coo`.
+        """
+
+        coo = self._matrix.tocoo()
+        idx = dict(zip(self._space.sorted_kets, _unravel(coo.row, self._space.sorted_kets)))
+        idx.update(zip(self._space.sorted_bras, _unravel(coo.col, self._space.sorted_bras)))
+        return (coo.data, idx)
+
+    def _assert_same_space(self, other):
+        if self._space != other.space:
+            raise MismatchedSpaceError('Mismatched HilbertSpaces: '+
+                repr(self._space)+' vs. '+repr(other.space))
+
+    def __add__(self, other):
+        """
+        Adds two arrays.  If either is dense, so is the result.
+
+        >>> from qitensor import qubit, cnot
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> U = cnot(ha, hb, sparse=True)
+        >>> (U + U).to_dense() == 2 * cnot(ha, hb)
+        True
+        >>> U + (ha*hb).eye() == cnot(ha, hb) + (ha*hb).eye()
+        True
+        >>> (ha*hb).eye() - U == (ha*hb).eye() - cnot(ha, hb)
+        True
+        >>> U + ha.O.eye()
+        Traceback (most recent call last):
+            ...
+        MismatchedSpaceError: 'Mismatched HilbertSpaces: |a,b><a,b| vs. |a><a|'
+        """
+
+        if isinstance(other, SparseHilbertArray):
+            self._assert_same_space(other)
+            return SparseHilbertArray(self._space, self._matrix + other._matrix)
+        elif isinstance(other, HilbertArray):
+            self._assert_same_space(other)
+            return self.to_dense() + other
+        else:
+            return NotImplemented
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return SparseHilbertArray(self._space, -self._matrix)
+
+    def __sub__(self, other):
+        if not isinstance(other, (SparseHilbertArray, HilbertArray)):
+            return NotImplemented
+        return self + (-other)
+
+    def __rsub__(self, other):
+        if not isinstance(other, HilbertArray):
+            return NotImplemented
+        return (-self) + other
+
+    def __mul__(self, other):
+        """
+        Multiplies by another (sparse or dense) array or by a scalar.
+
+        Contraction is over the bra space of the left factor and the ket space
+        of the right factor, as for ``HilbertArray``.  The product of two
+        sparse arrays is sparse, and the product of a sparse array and a dense
+        array is dense.
+
+        >>> from qitensor import qubit, cnot, cphase
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> U = cnot(ha, hb, sparse=True)
+        >>> V = cphase(hb, hc, sparse=True)
+        >>> U * V
+        SparseHilbertArray(|a,b,c><a,b,c|, nnz=8)
+        >>> (U * V).to_dense() == cnot(ha, hb) * cphase(hb, hc)
+        True
+        >>> x = (hc*ha.H).random_array()
+        >>> (x * U).closeto(x * cnot(ha, hb))
+        True
+        >>> y = (hb*hc.H).random_array()
+        >>> (U * y).closeto(cnot(ha, hb) * y)
+        True
+        >>> (2 * U).to_dense() == U.to_dense() * 2
+        True
+        >>> psi = (ha*hb).random_array()
+        >>> abs(psi.H * U * psi - psi.H * cnot(ha, hb) * psi) < 1e-14
+        True
+        """
+
+        if isinstance(other, (SparseHilbertArray, HilbertArray)):
+            return _product(self, other)
+        try:
+            x = self._space.base_field.input_cast_function()(other)
+        except TypeError:
+            return NotImplemented
+        return SparseHilbertArray(self._space, self._matrix * x)
+
+    def __rmul__(self, other):
+        if isinstance(other, HilbertArray):
+            return _product(other, self)
+        return self * other
+
+    def __truediv__(self, other):
+        try:
+            x = self._space.base_field.input_cast_function()(other)
+        except TypeError:
+            return NotImplemented
+        return SparseHilbertArray(self._space, self._matrix / x)
+
+    __div__ = __truediv__
+
+    @property
+    def H(self):
+        """
+        Returns the adjoint (Hermitian conjugate) of this array.
+
+        >>> from qitensor import qubit, SparseHilbertArray
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> x = (ha*hb.H*hb.prime.H).random_array()
+        >>> SparseHilbertArray.from_array(x).H.to_dense() == x.H
+        True
+        """
+
+        return SparseHilbertArray(self._space.H, self._matrix.conj().T)
+
+    def norm(self):
+        """
+        Returns the Frobenius norm of this array.
+
+        >>> from qitensor import qubit, cnot
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> cnot(ha, hb, sparse=True).norm()
+        2.0
+        """
+
+        return np.sqrt(np.sum(np.abs(self._matrix.data)**2))
+
+    def closeto(self, other, rtol=1e-05, atol=1e-08):
+        """
+        Checks whether two arrays are nearly equal, similar to numpy.allclose.
+        """
+
+        if isinstance(other, SparseHilbertArray):
+            other = other.to_dense()
+        return self.to_dense().closeto(other, rtol=rtol, atol=atol)
+
+    def trace(self, axes=None):
+        """
+        Returns the (full or partial) trace of this array.  See
+        :func:`HilbertArray.trace`.  The result of a partial trace is sparse.
+
+        >>> from qitensor import qubit, cnot, toffoli
+        >>> ha = qubit('a')
+        >>> hb = qubit('b')
+        >>> hc = qubit('c')
+        >>> U = toffoli(ha, hb, hc, sparse=True)
+        >>> U.trace()
+        (6+0j)
+        >>> U.trace(ha)
+        SparseHilbertArray(|b,c><b,c|, nnz=6)
+        >>> U.trace(ha).to_dense() == toffoli(ha, hb, hc).trace(ha)
+        True
+        >>> U.trace(ha*hb).to_dense() == toffoli(ha, hb, hc).trace(ha*hb)
+        True
+        """
+
+        if axes is None:
+            if self._space != self._space.H:
+                raise HilbertError('bra space does not equal ket space; '+
+                    'please specify axes')
+            return self._matrix.diagonal().sum()
+
+        axes = _trace_axes_dict(self._space, axes)
+        (data, idx) = self._coo()
+
+        keep = np.ones(len(data), dtype=bool)
+        for (s1, s2) in axes.items():
+            keep &= (idx[s1] == idx[s2])
+
+        out_atoms = self._space.bra_ket_set - \
+            frozenset(list(axes.keys())+list(axes.values()))
+        if not out_atoms:
+            return np.sum(data[keep])
+
+        out_space = create_space1(out_atoms)
+        return SparseHilbertArray.from_coo(out_space, data[keep],
+            dict([ (x, idx[x][keep]) for x in out_atoms ]))
@@ -1,13 +1,17 @@
 import numpy as np
-import itertools
+import scipy.sparse.linalg
 import random
 
 from qitensor import qudit, direct_sum, NotKetSpaceError, \
     HilbertSpace, HilbertArray, HilbertError, HilbertShapeError, MismatchedSpaceError
-from qitensor.space import create_space2
+from qitensor.space import create_space1, create_space2
 
 toler = 1e-12
 
+# spaces up to this dimension (of the operator space) use dense
+# eigensolvers rather than ARPACK
+_dense_eig_dim = 64
+
 # FIXME - some methods don't have docs
 # FIXME - use CP_Map in the map-state duality example
 # FIXME - method to relabel input/output/env space
@@ -21,6 +25,42 @@ toler = 1e-12
 
 __all__ = ['Superoperator', 'CP_Map']
 
+def _split_operand(in_space, rho):
+    """
+    Returns the data of ``rho`` as an ndarray of shape ``(din, din, s)``, with
+    the kets and bras of ``in_space`` first, followed by the remaining
+    (spectator) axes flattened into one, along with the list of spectator
+    axes.
+    """
+
+    in_axes = in_space.O.axes
+    rest = [ x for x in rho.axes if x not in in_space.O.bra_ket_set ]
+    nd = rho.nparray.transpose([ rho.axes.index(x) for x in in_axes + rest ])
+    din = in_space.dim()
+    return (nd.reshape(din, din, -1), rest)
+
+def _join_output(out_space, data, rest):
+    """
+    The inverse of :func:`_split_operand`, for an output on ``out_space``.
+    """
+
+    out_axes = out_space.O.axes + rest
+    return create_space1(out_axes).array(data, reshape=True, input_axes=out_axes)
+
+def _isometry_from_kraus(out_space, env_space, in_space, K):
+    """
+    Returns the Stinespring isometry ``J`` for the Kraus operators given as an
+    ndarray of shape ``(dout, n, din)``.  If the environment is bigger than
+    ``n``, the extra environment states are unused.
+    """
+
+    (db, n, da) = np.shape(K)
+    de = env_space.dim()
+    if n < de:
+        K = np.concatenate([ K, np.zeros((db, de-n, da), dtype=K.dtype) ], axis=1)
+    axes = out_space.axes + env_space.axes + in_space.H.axes
+    return (out_space * env_space * in_space.H).array(K, reshape=True, input_axes=axes)
+
 def _unreduce_supop_v1(in_space, out_space, m):
     """
     This is the function that handles restoring a pickle.
@@ -52,6 +92,7 @@ class Superoperator(object):
             raise HilbertShapeError(m.shape, (self.out_space.O.dim(), self.in_space.O.dim()))
 
         self._H_S = None
+        self._eig = None
 
     def __reduce__(self):
         """
@@ -121,13 +162,208 @@ class Superoperator(object):
         if not rho.space.bra_ket_set >= self.in_space.O.bra_ket_set:
             raise MismatchedSpaceError("argument space "+repr(rho.space)+
                     " does not contain superop domain "+repr(self.in_space.O))
-        (row_space, col_space) = rho._get_row_col_spaces(col_space=self.in_space.O)
-        ret_vec = self._m * rho.as_np_matrix(col_space=self.in_space.O)
-        if len(row_space):
-            out_space = self.out_space.O * np.prod(row_space)
+        (R, rest) = _split_operand(self.in_space, rho)
+        return _join_output(self.out_space, self._apply_data(R), rest)
+
+    def _apply_data(self, R):
+        """
+        Applies this map to operand data laid out as by
+        :func:`_split_operand`, returning data of shape ``(dout, dout, s)``.
+        """
+
+        (da, _, s) = R.shape
+        db = self.out_space.dim()
+        return np.dot(self._m.A, R.reshape(da*da, s)).reshape(db, db, s)
+
+    def as_linear_operator(self):
+        """
+        Returns this map as a ``scipy.sparse.linalg.LinearOperator`` acting on
+        operators flattened as in :func:`as_matrix`.  The transfer matrix is
+        not formed if the map can be applied more cheaply in another way (see
+        :func:`CP_Map.apply_costs`).
+
+        >>> import numpy as np
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 3)
+        >>> E = CP_Map.random(ha, ha, 2)
+        >>> A = E.as_linear_operator()
+        >>> A.shape
+        (9, 9)
+        >>> rho = ha.random_density()
+        >>> np.allclose(A.matvec(rho.nparray.flatten()), E(rho).nparray.flatten())
+        True
+        """
+
+        da = self.in_space.dim()
+        db = self.out_space.dim()
+        def matvec(v):
+            R = np.asarray(v).reshape(da, da, 1)
+            return self._apply_data(R).reshape(db*db)
+        return scipy.sparse.linalg.LinearOperator((db*db, da*da), matvec=matvec,
+            dtype=self.in_space.base_field.dtype)
+
+    def _assert_endomorphism(self):
+        if self.in_space != self.out_space:
+            raise MismatchedSpaceError("input and output spaces differ: "+
+                repr(self.in_space)+" vs. "+repr(self.out_space))
+
+    def eig(self):
+        """
+        Returns the eigenvalues and eigenvectors of the transfer matrix, with
+        the eigenvalues sorted by decreasing absolute value.  The eigenvectors
+        are the columns of the returned matrix, and are operators flattened as
+        in :func:`as_matrix`.  The result is computed once and cached.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 2)
+        >>> (w, V) = CP_Map.noisy(ha, 0.25).eig()
+        >>> np.round(w.real, 12).tolist()
+        [1.0, 0.75, 0.75, 0.75]
+        """
+
+        self._assert_endomorphism()
+        if self._eig is None:
+            (w, V) = np.linalg.eig(self.as_matrix().A)
+            order = np.argsort(-np.abs(w), kind='stable')
+            (w, V) = (w[order], V[:, order])
+            self._eig = (w, V, None)
+        return self._eig[:2]
+
+    def _top_eigs(self, k):
+        """
+        Returns the ``k`` eigenvalues of largest absolute value (sorted by
+        decreasing absolute value) and their eigenvectors.  Large maps use
+        ARPACK on :func:`as_linear_operator`, so the transfer matrix is not
+        needed.
+        """
+
+        self._assert_endomorphism()
+        n = self.in_space.O.dim()
+        k = min(k, n)
+        if n <= _dense_eig_dim or k >= n-1 or self._eig is not None:
+            (w, V) = self.eig()
+            return (w[:k], V[:, :k])
+        (w, V) = scipy.sparse.linalg.eigs(self.as_linear_operator(), k=k, which='LM')
+        order = np.argsort(-np.abs(w), kind='stable')
+        return (w[order], V[:, order])
+
+    def spectrum(self, k=None):
+        """
+        Returns the eigenvalues of this map, sorted by decreasing absolute
+        value.  If ``k`` is given, only the ``k`` largest are computed.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 3)
+        >>> abs(CP_Map.random(ha, ha).spectrum()[0] - 1) < 1e-12
+        True
+        """
+
+        if k is None:
+            return self.eig()[0]
+        return self._top_eigs(k)[0]
+
+    def spectral_gap(self):
+        """
+        Returns the difference between the absolute values of the largest
+        two eigenvalues.  For a channel with a unique steady state this
+        governs the rate of convergence to it under repeated application.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> '%.6f' % CP_Map.noisy(qudit('a', 2), 0.2).spectral_gap()
+        '0.200000'
+        >>> '%.6f' % CP_Map.noisy(qudit('b', 10), 0.3).spectral_gap()
+        '0.300000'
+        """
+
+        w = self._top_eigs(2)[0]
+        if len(w) < 2:
+            return abs(w[0])
+        return abs(w[0]) - abs(w[1])
+
+    def fixed_points(self, k=6, tol=1e-8):
+        """
+        Returns operators ``X`` with ``E(X) = X``, found among the
+        eigenvectors for the ``k`` eigenvalues of largest absolute value.  If
+        the space of fixed points has dimension greater than ``k`` only part
+        of it is found.
+
+        >>> from qitensor import qubit, CP_Map
+        >>> ha = qubit('a')
+        >>> len(CP_Map.decohere(ha).fixed_points())
+        2
+        """
+
+        (w, V) = self._top_eigs(k)
+        spc = self.out_space.O
+        return [ spc.array(V[:, i], reshape=True)
+            for i in range(len(w)) if abs(w[i] - 1) < tol ]
+
+    def steady_state(self, k=6, tol=1e-8):
+        """
+        Returns a density operator left unchanged by this map.  For a channel
+        with several steady states, an arbitrary one is returned.
+
+        >>> import numpy as np
+        >>> from qitensor import qubit, qudit, CP_Map
+        >>> ha = qubit('a')
+        >>> g = 0.3
+        >>> K0 = ha.O.array([[1, 0], [0, np.sqrt(1-g)]])
+        >>> K1 = ha.O.array([[0, np.sqrt(g)], [0, 0]])
+        >>> E = CP_Map.from_kraus([K0, K1])
+        >>> E.steady_state().closeto(ha.ket(0).O)
+        True
+        >>> hb = qudit('b', 10)
+        >>> CP_Map.noisy(hb, 0.5).steady_state().closeto(hb.fully_mixed())
+        True
+        """
+
+        fixed = self.fixed_points(k, tol)
+        traces = [ abs(X.trace()) for X in fixed ]
+        if len(fixed) == 0 or max(traces) < tol:
+            raise HilbertError('no steady state found')
+        X = fixed[int(np.argmax(traces))]
+        X = X / X.trace()
+        return (X + X.H) / 2
+
+    def __pow__(self, n):
+        """
+        Returns this map composed with itself ``n`` times.  When the transfer
+        matrix is well conditioned with respect to diagonalization this uses
+        the (cached) eigendecomposition, otherwise repeated squaring.
+
+        >>> from qitensor import qudit, Superoperator
+        >>> ha = qudit('a', 3)
+        >>> E = Superoperator.random(ha, ha) * 0.3
+        >>> rho = ha.random_density()
+        >>> ((E**5)(rho) - E(E(E(E(E(rho)))))).norm() < 1e-12
+        True
+        >>> ((E**0)(rho) - rho).norm() < 1e-14
+        True
+        """
+
+        self._assert_endomorphism()
+        if n != int(n) or n < 0:
+            raise ValueError('power must be a nonnegative integer: '+repr(n))
+        n = int(n)
+
+        d2 = self.in_space.O.dim()
+        if n == 0:
+            return Superoperator(self.in_space, self.out_space, np.eye(d2))
+
+        (w, V) = self.eig()
+        (_, _, Vinv) = self._eig
+        if Vinv is None:
+            if np.linalg.cond(V) < 1e6:
+                Vinv = np.linalg.inv(V)
+            else:
+                Vinv = False
+            self._eig = (w, V, Vinv)
+
+        if Vinv is False:
+            m = np.linalg.matrix_power(self.as_matrix().A, n)
         else:
-            out_space = self.out_space.O
-        return out_space.array(ret_vec, reshape=True, input_axes=self.out_space.O.axes+row_space)
+            m = np.dot(V * w**n, Vinv)
+        return Superoperator(self.in_space, self.out_space, m)
 
     def __mul__(self, other):
         """
@@ -282,8 +518,8 @@ class Superoperator(object):
         out_space = out_space.ket_space()
 
         m = np.zeros((out_space.dim()**2, in_space.dim()**2), in_space.base_field.dtype)
-        for (i, x) in enumerate(in_space.O.index_iter()):
-            m[:, i] = f(in_space.O.basis_vec(x)).nparray.flatten()
+        for (i, x) in enumerate(in_space.O.basis_iter()):
+            m[:, i] = f(x).nparray.flatten()
 
         E = Superoperator(in_space, out_space, m)
 
@@ -367,17 +603,14 @@ class CP_Map(Superoperator):
 
         assert J.space == out_space * env_space * in_space.H
 
-        da = in_space.dim()
-        db = out_space.dim()
-        t = np.zeros((db, da, db, da), dtype=in_space.base_field.dtype)
-        for j in env_space.index_iter():
-            op = J[{ env_space: j }].as_np_matrix(row_space=in_space.H)
-            t += np.tensordot(op, op.conj(), axes=([],[]))
-        t = t.transpose([0,2,1,3])
-        t = t.reshape(db**2, da**2)
-        t = np.matrix(t)
-
-        super(CP_Map, self).__init__(in_space, out_space, t)
+        # The transfer matrix is only computed if needed, since for a small
+        # environment it is much bigger than J.
+        self._in_space = in_space
+        self._out_space = out_space
+        self._H_S = None
+        self._eig = None
+        self._transfer = None
+        self._kraus = None
 
         self._J = J
         self._env_space = env_space
@@ -406,6 +639,139 @@ class CP_Map(Superoperator):
     def env_space(self):
         return self._env_space
 
+    def _kraus_tensor(self):
+        """
+        Returns the Kraus operators as an ndarray of shape ``(dout, denv,
+        din)``.  This is just ``J`` with its axes grouped.
+        """
+
+        if self._kraus is None:
+            J = self.J
+            axes = self.out_space.axes + self.env_space.axes + self.in_space.H.axes
+            nd = J.nparray.transpose([ J.axes.index(x) for x in axes ])
+            self._kraus = nd.reshape(self.out_space.dim(), self.env_space.dim(),
+                self.in_space.dim())
+        return self._kraus
+
+    @property
+    def _m(self):
+        if self._transfer is None:
+            K = self._kraus_tensor()
+            (db, _, da) = K.shape
+            # t[b, b', a, a'] = sum_e K[b, e, a] K[b', e, a']^*
+            t = np.tensordot(K, K.conj(), axes=([1], [1])).transpose(0, 2, 1, 3)
+            self._transfer = np.matrix(t.reshape(db*db, da*da))
+        return self._transfer
+
+    def apply_costs(self, spectator_dim=1):
+        """
+        Estimates the number of multiply-adds needed to apply this channel to
+        an operator with the given dimension of spectator spaces (spaces not
+        acted on by the channel, counting both the ket and bra sides), for
+        each of the methods that ``__call__`` can use:
+
+        ``'kraus'``
+            Apply the Kraus operators, taken as a stack from the Stinespring
+            isometry ``J``: ``sum_k K_k rho K_k^dagger``.  Costs about
+            ``s*dout*denv*din*(din+dout)``.  Doing the same contraction as
+            ``tr_env(J rho J^dagger)`` would also compute the off-diagonal
+            environment blocks, so that is never cheaper.
+        ``'matrix'``
+            Multiply by the ``(dout^2, din^2)`` transfer matrix.  Costs
+            ``s*dout^2*din^2``, plus ``denv*dout^2*din^2`` to build the matrix
+            if that has not been done yet.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 4)
+        >>> E = CP_Map.decohere(ha)
+        >>> sorted(E.apply_costs().items())
+        [('kraus', 512), ('matrix', 1280)]
+        >>> E.as_matrix().shape
+        (16, 16)
+        >>> sorted(E.apply_costs(100).items())
+        [('kraus', 51200), ('matrix', 25600)]
+        """
+
+        s = spectator_dim
+        da = self.in_space.dim()
+        db = self.out_space.dim()
+        de = self.env_space.dim()
+        costs = {
+            'kraus': s*db*de*da*(da+db),
+            'matrix': s*db*db*da*da,
+        }
+        if self._transfer is None:
+            costs['matrix'] += de*db*db*da*da
+        return costs
+
+    def __call__(self, rho, method=None):
+        """
+        Applies the channel to ``rho``, which may also have spaces other than
+        the input space of the channel; those are left alone.
+
+        Unless ``method`` is given, the cheapest method according to
+        :func:`apply_costs` is used.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 3)
+        >>> hb = qudit('b', 2)
+        >>> hd = qudit('d', 2)
+        >>> E = CP_Map.random(ha, hb, 'c')
+        >>> rho = (ha*hd).O.random_array()
+        >>> x = E(rho, method='kraus')
+        >>> x.space
+        |b,d><b,d|
+        >>> (x - E(rho, method='matrix')).norm() < 1e-14
+        True
+        >>> (x - (E.J * rho * E.J.H).trace(E.env_space)).norm() < 1e-14
+        True
+        >>> E(rho, method='dense')
+        Traceback (most recent call last):
+            ...
+        HilbertError: "unknown method 'dense'"
+        """
+
+        if not rho.space.bra_ket_set >= self.in_space.O.bra_ket_set:
+            raise MismatchedSpaceError("argument space "+repr(rho.space)+
+                    " does not contain superop domain "+repr(self.in_space.O))
+
+        (R, rest) = _split_operand(self.in_space, rho)
+        return _join_output(self.out_space, self._apply_data(R, method), rest)
+
+    def _apply_data(self, R, method=None):
+        (da, _, s) = R.shape
+        if method is None:
+            costs = self.apply_costs(s)
+            method = min(costs, key=costs.get)
+
+        if method == 'kraus':
+            K = self._kraus_tensor()
+            (db, de, _) = K.shape
+            T = np.dot(K.reshape(db*de, da), R.reshape(da, da*s)).reshape(db, de, da, s)
+            return np.tensordot(T, K.conj(), axes=([1, 2], [1, 2])).transpose(0, 2, 1)
+        elif method == 'matrix':
+            return super(CP_Map, self)._apply_data(R)
+        else:
+            raise HilbertError('unknown method '+repr(method))
+
+    def __pow__(self, n):
+        """
+        Returns this channel composed with itself ``n`` times, as a CP_Map
+        with a new environment.
+
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 2)
+        >>> E = CP_Map.random(ha, ha, 2)
+        >>> rho = ha.random_density()
+        >>> E3 = E**3
+        >>> E3
+        CP_Map( |a><a| to |a><a| )
+        >>> (E3(rho) - E(E(E(rho)))).norm() < 1e-12
+        True
+        """
+
+        return super(CP_Map, self).__pow__(n).upgrade_to_cp_map()
+
     @property
     def J(self):
         """The channel isometry."""
@@ -475,7 +841,9 @@ class CP_Map(Superoperator):
         True
         """
 
-        return [ self.J[{ self.env_space: x }] for x in self.env_space.indices ]
+        op_spc = self.out_space * self.in_space.H
+        K = np.ascontiguousarray(self._kraus_tensor().transpose(1, 0, 2))
+        return [ op_spc.array_from_buffer(k, reshape=True) for k in K ]
 
     def __str__(self):
         return 'CP_Map( '+str(self.in_space.O)+' to '+str(self.out_space.O)+' )'
@@ -705,22 +1073,42 @@ class CP_Map(Superoperator):
 
         env_space = cls._make_environ_spc(espc_def, in_space.base_field, dc)
 
-        J = (out_space * env_space * in_space.H).array()
-
-        for (i, j) in enumerate(nonzero):
-            J[{ env_space: i }] = (out_space * in_space.H).array(ev[:,j] * field.sqrt(ew[j]), reshape=True)
+        # column j of ev, indexed by (b, a), gives the Kraus operator for
+        # environment state j
+        K = np.asarray(ev)[:, nonzero] * np.sqrt(ew[nonzero])
+        K = K.reshape(db, da, dc).transpose(0, 2, 1)
+        J = _isometry_from_kraus(out_space, env_space, in_space, K)
 
         return CP_Map(J, env_space)
 
     @classmethod
     def from_kraus(cls, ops, espc_def=None):
+        """
+        >>> from qitensor import qudit, CP_Map
+        >>> ha = qudit('a', 3)
+        >>> hb = qudit('b', 2)
+        >>> E = CP_Map.random(ha, hb, 5)
+        >>> F = CP_Map.from_kraus(E.krauses())
+        >>> F.env_space.dim()
+        5
+        >>> rho = ha.random_density()
+        >>> (E(rho) - F(rho)).norm() < 1e-14
+        True
+        """
+
         ops = list(ops)
         op_spc = ops[0].space
+        for op in ops:
+            if op.space != op_spc:
+                raise MismatchedSpaceError('Kraus operators not all on the same space: '+
+                    repr(op_spc)+' vs. '+repr(op.space))
+        out_space = op_spc.ket_space()
+        in_space = op_spc.bra_space().H
         dc = len(ops)
         env_space = cls._make_environ_spc(espc_def, op_spc.base_field, dc)
-        J = (op_spc * env_space).array()
-        for (i, op) in enumerate(ops):
-            J[{ env_space: i }] = op
+        K = np.array([ op.nparray for op in ops ])
+        K = K.reshape(dc, out_space.dim(), in_space.dim()).transpose(1, 0, 2)
+        J = _isometry_from_kraus(out_space, env_space, in_space, K)
 
         return CP_Map(J, env_space)
 
@@ -794,9 +1182,11 @@ class CP_Map(Superoperator):
         d = in_space.dim()
         d2 = d*d
         env_space = cls._make_environ_spc(espc_def, in_space.base_field, d2)
-        J = (in_space.O*env_space).array()
-        for (i, (j, k)) in enumerate(itertools.product(in_space.index_iter(), repeat=2)):
-            J[{ in_space.H: j, in_space: k, env_space: i }] = 1
+        # the Kraus operator for environment state (j, k) is |k><j|
+        K = np.zeros((d, d2, d))
+        (j, k) = np.divmod(np.arange(d2), d)
+        K[k, np.arange(d2), j] = 1
+        J = _isometry_from_kraus(in_space, env_space, in_space, K)
         J /= in_space.base_field.sqrt(d)
         return CP_Map(J, env_space)
 
@@ -832,9 +1222,10 @@ class CP_Map(Superoperator):
         in_space = cls._to_ket_space(spc)
         d = in_space.dim()
         env_space = cls._make_environ_spc(espc_def, in_space.base_field, d)
-        J = (in_space.O*env_space).array()
-        for (i, a) in enumerate(in_space.index_iter()):
-            J[{ in_space.H: a, in_space: a, env_space: i }] = 1
+        # the Kraus operator for environment state a is |a><a|
+        K = np.zeros((d, d, d))
+        K[np.arange(d), np.arange(d), np.arange(d)] = 1
+        J = _isometry_from_kraus(in_space, env_space, in_space, K)
         return CP_Map(J, env_space)
 
     @classmethod
@@ -58,6 +58,9 @@ cdef class SympyHilbertBaseField(HilbertBaseField):
     cpdef input_cast_function(self):
         return do_cast_to_sympy
 
+    cpdef np.ndarray cast_array(self, np.ndarray arr):
+        return np.vectorize(do_cast_to_sympy, otypes=[self.dtype])(arr)
+
     cpdef fractional_phase(self, int a, int b):
         return sympy.exp(2 * sympy.pi * sympy.I * sympy.Rational(a, b))
 
@@ -76,6 +79,9 @@ cdef class SympyHilbertBaseField(HilbertBaseField):
     cpdef xlog2x(self, x):
         return 0 if x<=0 else x*sympy.log(x)/sympy.log(2)
 
+    cpdef spectrum_entropy(self, np.ndarray p):
+        return sum([-self.xlog2x(x) for x in p])
+
     cpdef np.ndarray mat_n(self, np.ndarray m, prec=None, digits=None):
         # FIXME - handle digits param
         return np.vectorize(to_n, otypes=[self.dtype])(m)
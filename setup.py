@@ -65,6 +65,7 @@ ext_names = [
     "atom",
     "basefield",
     "benchmark_cy",
+    "cache",
     "factory",
     "sagebasefield",
     "sympybasefield",
@@ -92,6 +93,7 @@ if use_cython:
             "qitensor/array.pxd",
             "qitensor/atom.pxd",
             "qitensor/basefield.pxd",
+            "qitensor/cache.pxd",
             "qitensor/factory.pxd",
             "qitensor/space.pxd",
         ]